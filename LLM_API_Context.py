@@ -1,6 +1,19 @@
 import os
+import time
 import google.generativeai as genai
 from dotenv import load_dotenv
+from metrics import llm_request_seconds, llm_tokens, llm_tokens_total
+
+def record_token_usage(model_name, response):
+    """Record the prompt and response token counts Gemini reports for a request"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    for kind, count in (("prompt", usage.prompt_token_count), ("response", usage.candidates_token_count)):
+        if count:
+            llm_tokens.observe(count, model=model_name, kind=kind)
+            llm_tokens_total.inc(count, model=model_name, kind=kind)
+
 
 # --- 1. Define Your Context and Query ---
 
@@ -43,13 +56,12 @@ from dotenv import load_dotenv
 # Common methods include:
 # - "Context: [your context]\n\nQuestion: [your query]"
 # - "Based on the following text:\n[your context]\n\nAnswer this: [your query]"
-def get_LLM_response(direct_context, user_query):
-    print("direct_context", direct_context)
-    
-    load_dotenv()
-    api_key = os.getenv("GOOGLE_API_KEY")
-    genai.configure(api_key=api_key)
+# --- 3. Interact with Gemini Generative Model ---
+# We'll use Gemini 1.5 Flash, which has a large context window.
+generative_model_name = "gemini-2.0-flash"
+# generative_model_name = 'gemini-1.5-flash-latest'
 
+def build_prompt(direct_context, user_query):
     prompt_with_direct_context = f"""Please read the following text carefully:
 
     --- BEGIN PROVIDED TEXT ---
@@ -72,41 +84,75 @@ def get_LLM_response(direct_context, user_query):
 
     # If the answer cannot be found in the text, please state that clearly.
     # """
+    return prompt_with_direct_context
 
-    # --- 3. Interact with Gemini Generative Model ---
-    # We'll use Gemini 1.5 Flash, which has a large context window.
-    generative_model_name = "gemini-2.0-flash"
-    # generative_model_name = 'gemini-1.5-flash-latest'
+def get_model():
+    load_dotenv()
+    api_key = os.getenv("GOOGLE_API_KEY")
+    genai.configure(api_key=api_key)
     print(f"\nUsing Gemini generative model: {generative_model_name}")
+    return genai.GenerativeModel(generative_model_name)
+
+def response_text(response):
+    """The answer in a Gemini response, None when it was blocked or empty"""
+    # --- 4. Print the Response ---
+    print("\n--- Gemini's Response ---")
+    if response.parts:
+        print(response.text)
+        return response.text
+        # return str(response.parts).split("\"")[1][:-2]
+    elif response.candidates and response.candidates[0].finish_reason != "SAFETY":
+        # Handle cases where content might be in candidates
+        if response.candidates[0].content and response.candidates[0].content.parts:
+            print("".join(part.text for part in response.candidates[0].content.parts))
+            # return "".join(part.text for part in response.candidates[0].content.parts)
+    else:
+        # Handle blocked responses or other issues
+        if response.prompt_feedback and response.prompt_feedback.block_reason:
+            print(f"Response blocked due to: {response.prompt_feedback.block_reason_message or response.prompt_feedback.block_reason}")
+        else:
+            for candidate in response.candidates: # Iterate through candidates for safety feedback
+                if candidate.finish_reason == "SAFETY":
+                    print(f"Response content filtered due to safety concerns: {candidate.safety_ratings}")
+                    break # Stop after finding the first safety-related blockage
+            else: # If no candidate was blocked for safety but parts are still empty
+                print("Gemini produced an empty response or the content was filtered for other reasons.")
+    return None
+
+def get_LLM_response(direct_context, user_query):
+    print("direct_context", direct_context)
+    prompt_with_direct_context = build_prompt(direct_context, user_query)
     try:
-        model = genai.GenerativeModel(generative_model_name)
+        model = get_model()
 
         # Generate content
-        # You can also use generate_content_async for asynchronous calls
-        response = model.generate_content(prompt_with_direct_context)
-
-        # --- 4. Print the Response ---
-        print("\n--- Gemini's Response ---")
-        if response.parts:
-            print(response.text)
-            return response.text
-            # return str(response.parts).split("\"")[1][:-2]
-        elif response.candidates and response.candidates[0].finish_reason != "SAFETY":
-            # Handle cases where content might be in candidates
-            if response.candidates[0].content and response.candidates[0].content.parts:
-                print("".join(part.text for part in response.candidates[0].content.parts))
-                # return "".join(part.text for part in response.candidates[0].content.parts)
-        else:
-            # Handle blocked responses or other issues
-            if response.prompt_feedback and response.prompt_feedback.block_reason:
-                print(f"Response blocked due to: {response.prompt_feedback.block_reason_message or response.prompt_feedback.block_reason}")
-            else:
-                for candidate in response.candidates: # Iterate through candidates for safety feedback
-                    if candidate.finish_reason == "SAFETY":
-                        print(f"Response content filtered due to safety concerns: {candidate.safety_ratings}")
-                        break # Stop after finding the first safety-related blockage
-                else: # If no candidate was blocked for safety but parts are still empty
-                    print("Gemini produced an empty response or the content was filtered for other reasons.")
+        start = time.perf_counter()
+        try:
+            response = model.generate_content(prompt_with_direct_context)
+        except Exception:
+            llm_request_seconds.observe(time.perf_counter() - start, model=generative_model_name, outcome="error")
+            raise
+        llm_request_seconds.observe(time.perf_counter() - start, model=generative_model_name, outcome="ok")
+        record_token_usage(generative_model_name, response)
+        return response_text(response)
+
+    except Exception as e:
+        print(f"\nAn error occurred during Gemini API interaction: {e}")
+
+async def get_LLM_response_async(direct_context, user_query):
+    """get_LLM_response for asyncio callers: the request does not block the event loop"""
+    prompt_with_direct_context = build_prompt(direct_context, user_query)
+    try:
+        model = get_model()
+        start = time.perf_counter()
+        try:
+            response = await model.generate_content_async(prompt_with_direct_context)
+        except Exception:
+            llm_request_seconds.observe(time.perf_counter() - start, model=generative_model_name, outcome="error")
+            raise
+        llm_request_seconds.observe(time.perf_counter() - start, model=generative_model_name, outcome="ok")
+        record_token_usage(generative_model_name, response)
+        return response_text(response)
 
     except Exception as e:
         print(f"\nAn error occurred during Gemini API interaction: {e}")
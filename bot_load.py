@@ -0,0 +1,163 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from aiohttp import web
+from fake_bot_api import FakeBotAPI
+
+# Load test of the bot's question path: simulated users each ask one question
+# at the same time, against a fake Bot API, a fake /users API and an LLM that
+# takes llm_latency seconds. Compares the threaded-polling bot the handlers
+# used to run on (telebot.TeleBot, blocking requests and LLM calls) with the
+# asyncio bot in telegram_bot.py.
+#   python bot_load.py [users] [llm_latency]
+users = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+llm_latency = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+token = "123456:load-test"
+
+
+def users_payload():
+    messages = [
+        {"id": index, "sender_id": chat, "sender": f"User{chat}", "text": f"message {index} of chat {chat}",
+         "date": "2024-01-01T12:00:00Z", "ts": 1704110400 + index}
+        for chat in range(3) for index in range(5)
+    ]
+    chats = {f"Chat{chat}": messages[chat * 5:(chat + 1) * 5] for chat in range(3)}
+    return json.dumps({"messages": {"most_recent": chats, "unread": {}}}).encode("utf-8")
+
+
+users_body = users_payload()
+
+
+async def read_users(request):
+    return web.Response(body=users_body, content_type="application/json")
+
+
+def start_api():
+    """Fake Bot API with the fake /users next to it, both off the threads being counted"""
+    api = FakeBotAPI(routes=[web.get("/users", read_users)]).start()
+    telegram_bot.API_BASE_URL = api.url
+    return api
+
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", token)
+os.environ["bot_live_view"] = "0"
+# The LLM is simulated, there is no quota for the question queue to protect
+os.environ.setdefault("llm_max_concurrent", str(users))
+
+import telebot
+from telebot import apihelper, asyncio_helper
+import telegram_bot
+
+
+def threaded_bot():
+    """The question handler as it ran on the threaded-polling bot"""
+    import requests
+
+    bot = telebot.TeleBot(token)
+
+    def keep_typing(chat_id, stop_event):
+        while not stop_event.is_set():
+            bot.send_chat_action(chat_id, 'typing')
+            time.sleep(3)
+
+    @bot.message_handler(func=lambda message: message.text != "")
+    def get_messages(message):
+        start_time = time.time()
+        stop_typing = threading.Event()
+        typing_thread = threading.Thread(target=keep_typing, args=(message.chat.id, stop_typing))
+        typing_thread.start()
+        try:
+            response = requests.get(f"{telegram_bot.API_BASE_URL}/users", params={"per_chat_limit": telegram_bot.messages_per_chat})
+            data_formatted = telegram_bot.format_messages(response.json(), "recent")
+            time.sleep(llm_latency)  # get_LLM_response
+            bot.reply_to(message, f"answer\n\n⏱️ Time: {time.time() - start_time:.2f}s")
+        finally:
+            stop_typing.set()
+            typing_thread.join()
+
+    return bot
+
+
+def report(name, api, pushed_at, started, peak_threads):
+    replies = {int(params["chat_id"]): sent_at for method, params, sent_at in api.calls if method == "sendMessage"}
+    latencies = sorted(replies[user] - pushed_at[user] for user in pushed_at if user in replies)
+    elapsed = max(replies.values()) - started if replies else float("inf")
+    p50 = latencies[len(latencies) // 2] if latencies else float("nan")
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else float("nan")
+    chat_actions = len(api.calls_to("sendChatAction"))
+    print(f"{name}: {len(latencies)}/{len(pushed_at)} answered in {elapsed:.2f}s, "
+          f"{len(latencies) / elapsed:.2f} questions/s, latency p50 {p50:.2f}s p95 {p95:.2f}s, "
+          f"peak threads {peak_threads}, {chat_actions} chat actions")
+
+
+def push_questions(api):
+    pushed_at = {}
+    for user in range(users):
+        user_id = 1000 + user
+        pushed_at[user_id] = time.time()
+        api.push_message(user_id, f"question {user}")
+    return pushed_at
+
+
+def watch_threads(stop, peak):
+    while not stop.is_set():
+        peak[0] = max(peak[0], threading.active_count())
+        time.sleep(0.05)
+
+
+def run_threaded():
+    api = start_api()
+    apihelper.API_URL = api.api_url
+    bot = threaded_bot()
+    poll_thread = threading.Thread(target=bot.polling, kwargs={"none_stop": True, "timeout": 1}, daemon=True)
+    poll_thread.start()
+    stop, peak = threading.Event(), [0]
+    threading.Thread(target=watch_threads, args=(stop, peak), daemon=True).start()
+    started = time.time()
+    pushed_at = push_questions(api)
+    api.wait_for("sendMessage", users, timeout=users * llm_latency + 60)
+    stop.set()
+    report("threaded polling", api, pushed_at, started, peak[0])
+    bot.stop_polling()
+    poll_thread.join(10)
+    # Let the worker threads finish their typing loops before the API goes away
+    time.sleep(3)
+    api.stop()
+
+
+async def fake_llm(direct_context, user_query):
+    await asyncio.sleep(llm_latency)
+    return "answer"
+
+
+async def run_async():
+    api = start_api()
+    asyncio_helper.API_URL = api.api_url
+    telegram_bot.get_LLM_response_async = fake_llm
+    polling = asyncio.create_task(telegram_bot.bot.polling(non_stop=True, timeout=1))
+    stop, peak = threading.Event(), [0]
+    threading.Thread(target=watch_threads, args=(stop, peak), daemon=True).start()
+    started = time.time()
+    pushed_at = push_questions(api)
+    await asyncio.to_thread(api.wait_for, "sendMessage", users, users * llm_latency + 60)
+    stop.set()
+    report("asyncio", api, pushed_at, started, peak[0])
+    # Let the handlers finish their replies
+    await asyncio.sleep(1)
+    polling.cancel()
+    try:
+        await polling
+    except asyncio.CancelledError:
+        pass
+    await telegram_bot.api_session.close()
+    await telegram_bot.bot.close_session()
+    api.stop()
+
+
+if __name__ == "__main__":
+    print(f"{users} users asking at once, LLM latency {llm_latency}s")
+    run_threaded()
+    asyncio.run(run_async())
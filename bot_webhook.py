@@ -0,0 +1,174 @@
+import asyncio
+import hmac
+import os
+import secrets
+from urllib.parse import urlparse
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from telebot import types
+from metrics import webhook_updates, webhook_queue_depth
+
+# Public HTTPS URL Telegram posts updates to, e.g. https://bot.example.com/telegram;
+# its path is the route served here. Unset, the bot polls instead.
+webhook_url = os.getenv('bot_webhook_url')
+
+# Telegram sends it back in X-Telegram-Bot-Api-Secret-Token with every update.
+# Set it when several bot processes share the webhook, they all need the same one.
+webhook_secret = os.getenv('bot_webhook_secret') or secrets.token_urlsafe(32)
+
+# Address the receiver listens on, behind the TLS proxy webhook_url points at
+webhook_host = os.getenv('bot_webhook_host', '127.0.0.1')
+webhook_port = int(os.getenv('bot_webhook_port', 8443))
+
+# Updates are handed to the handlers in batches of up to webhook_batch_size, collected
+# for at most webhook_batch_delay seconds; past webhook_max_queue Telegram is asked to retry
+webhook_batch_size = int(os.getenv('bot_webhook_batch_size', 100))
+webhook_batch_delay = float(os.getenv('bot_webhook_batch_delay', 0.01))
+webhook_max_queue = int(os.getenv('bot_webhook_max_queue', 10000))
+
+# Simultaneous deliveries Telegram may open to the receiver
+webhook_max_connections = int(os.getenv('bot_webhook_max_connections', 40))
+
+
+class UpdateDispatcher:
+    """
+    Queue between the webhook receiver and the bot's handlers. The receiver
+    only parses and enqueues, so Telegram gets its 200 at once; updates are
+    then dispatched in batches, each batch as its own task the way the
+    polling loop does, so a slow handler never holds up the next batch.
+    """
+
+    def __init__(self, bot, batch_size=webhook_batch_size, batch_delay=webhook_batch_delay,
+                 max_queue=webhook_max_queue):
+        self.bot = bot
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.queue = asyncio.Queue(max_queue)
+        self.tasks = set()
+        self.task = None
+
+        # Counters for reporting
+        self.batches = 0
+        self.dispatched = 0
+
+    def put(self, update):
+        """Queue an update; False when the queue is full"""
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            return False
+        webhook_queue_depth.set(self.queue.qsize())
+        return True
+
+    async def next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.batch_delay
+        while len(batch) < self.batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        webhook_queue_depth.set(self.queue.qsize())
+        return batch
+
+    async def run(self):
+        while True:
+            batch = await self.next_batch()
+            self.batches += 1
+            self.dispatched += len(batch)
+            task = asyncio.create_task(self.bot.process_new_updates(batch))
+            # Strong references until done, the loop only keeps weak ones
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+def create_app(dispatcher, secret=webhook_secret, path="/"):
+    """ASGI app receiving Telegram's webhook POSTs on path"""
+    app = FastAPI()
+
+    @app.on_event("startup")
+    async def startup():
+        dispatcher.start()
+
+    @app.on_event("shutdown")
+    async def shutdown():
+        await dispatcher.stop()
+
+    @app.post(path)
+    async def receive_update(request: Request):
+        token = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token.encode(), secret.encode()):
+            webhook_updates.inc(outcome="forbidden")
+            return JSONResponse({"detail": "Invalid secret token"}, status_code=403)
+        try:
+            update = types.Update.de_json((await request.body()).decode("utf-8"))
+        except Exception as e:
+            webhook_updates.inc(outcome="invalid")
+            return JSONResponse({"detail": f"Invalid update: {str(e)}"}, status_code=400)
+        if not dispatcher.put(update):
+            # Telegram redelivers after a non-2xx answer
+            webhook_updates.inc(outcome="dropped")
+            return JSONResponse({"detail": "Too many pending updates"}, status_code=503)
+        webhook_updates.inc(outcome="accepted")
+        return {"ok": True}
+
+    @app.get("/health")
+    async def health():
+        return {"queued": dispatcher.queue.qsize(), "running": len(dispatcher.tasks),
+                "dispatched": dispatcher.dispatched, "batches": dispatcher.batches}
+
+    return app
+
+
+async def run_webhook(bot, url=webhook_url, secret=webhook_secret, host=webhook_host, port=webhook_port):
+    """
+    Serve updates on host:port, then point Telegram at url, until stopped.
+    Raises if the receiver cannot listen, Telegram does not accept the
+    webhook or the receiver fails, so the caller can poll instead.
+    """
+    import uvicorn
+
+    dispatcher = UpdateDispatcher(bot)
+    app = create_app(dispatcher, secret, urlparse(url).path or "/")
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+
+    async def serve():
+        try:
+            await server.serve()
+        except SystemExit as e:
+            # uvicorn exits the process when it cannot bind, the bot should poll instead
+            raise RuntimeError(f"Could not receive updates on {host}:{port}") from e
+
+    serving = asyncio.create_task(serve())
+    # Telegram is only pointed at the receiver once it is listening
+    while not server.started:
+        if serving.done():
+            serving.result()
+            raise RuntimeError(f"Webhook receiver on {host}:{port} stopped before it started")
+        await asyncio.sleep(0.05)
+    try:
+        if not await bot.set_webhook(url=url, secret_token=secret, max_connections=webhook_max_connections):
+            raise RuntimeError(f"Telegram did not accept the webhook {url}")
+    except BaseException:
+        server.should_exit = True
+        await asyncio.gather(serving, return_exceptions=True)
+        raise
+    print(f"Receiving updates for {url} on {host}:{port}")
+    await serving
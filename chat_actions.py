@@ -0,0 +1,153 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from rate_limiter import RateLimiter
+from metrics import chat_actions_sent, chat_actions_active
+
+# Telegram shows a chat action for about 5 seconds, so it is renewed a bit sooner
+chat_action_interval = float(os.getenv('chat_action_interval', 4))
+
+# Chat actions per second across every chat, well under the Bot API's ~30 requests per second
+chat_action_rate = float(os.getenv('chat_action_rate', 20))
+
+
+class ChatAction:
+    """A chat's action and how many requests in it still want it shown"""
+
+    def __init__(self, action):
+        self.action = action
+        self.requests = 1
+        self.next_at = 0.0
+
+
+def retry_after(error):
+    """Seconds a Bot API 429 error asks to wait, None for any other error"""
+    if getattr(error, "error_code", None) != 429:
+        return None
+    parameters = (getattr(error, "result_json", None) or {}).get("parameters") or {}
+    return parameters.get("retry_after", 1)
+
+
+class ChatActionScheduler:
+    """
+    Keeps "typing..." showing in every chat with a request in flight, from
+    a single timer loop instead of a loop per request. Every due chat's
+    action goes through one token bucket; a 429 from the Bot API pauses all
+    of them for its retry_after. A chat is dropped as soon as its last
+    request finishes or fails, and for good if the bot may not post in it.
+    """
+
+    def __init__(self, send, interval=chat_action_interval, rate=chat_action_rate):
+        self.send = send
+        self.interval = interval
+        # Its 429 backoffs are counted as Bot API ones, apart from Telethon's FloodWaits
+        self.limiter = RateLimiter(rate, api="bot")
+        self.chats = {}
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+        # Counters for reporting
+        self.sent = 0
+        self.failed = 0
+
+    def start(self, chat_id, action="typing"):
+        """Show the action in the chat until the matching stop()"""
+        entry = self.chats.get(chat_id)
+        if entry is not None:
+            entry.requests += 1
+            return
+        self.chats[chat_id] = ChatAction(action)
+        chat_actions_active.set(len(self.chats))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        self.wakeup.set()
+
+    def stop(self, chat_id):
+        entry = self.chats.get(chat_id)
+        if entry is None:
+            return
+        entry.requests -= 1
+        if entry.requests <= 0:
+            del self.chats[chat_id]
+            chat_actions_active.set(len(self.chats))
+
+    @asynccontextmanager
+    async def typing(self, chat_id, action="typing"):
+        """Show the action while the with block runs, however it exits"""
+        self.start(chat_id, action)
+        try:
+            yield
+        finally:
+            self.stop(chat_id)
+
+    async def send_action(self, chat_id, action):
+        await self.limiter.acquire()
+        # The request may have finished while waiting for a token
+        if chat_id not in self.chats:
+            return
+        try:
+            await self.send(chat_id, action)
+            self.sent += 1
+            chat_actions_sent.inc(outcome="sent")
+        except Exception as e:
+            self.failed += 1
+            seconds = retry_after(e)
+            if seconds is not None:
+                chat_actions_sent.inc(outcome="rate_limited")
+                print(f"Bot API rate limit, pausing chat actions for {seconds} seconds")
+                self.limiter.backoff(seconds)
+            elif getattr(e, "error_code", None) in (400, 403):
+                # Blocked by the user or the chat is gone, the request's replies will fail too
+                chat_actions_sent.inc(outcome="rejected")
+                self.chats.pop(chat_id, None)
+                chat_actions_active.set(len(self.chats))
+            else:
+                chat_actions_sent.inc(outcome="error")
+                print(f"Error sending chat action to {chat_id}: {str(e)}")
+
+    async def run(self):
+        """Send every due chat's action, then sleep until the next one is due or a chat starts"""
+        while self.chats:
+            now = time.monotonic()
+            due = [(chat_id, entry.action) for chat_id, entry in self.chats.items() if entry.next_at <= now]
+            for chat_id, _ in due:
+                self.chats[chat_id].next_at = now + self.interval
+            if due:
+                await asyncio.gather(*(self.send_action(chat_id, action) for chat_id, action in due))
+
+            next_at = min((entry.next_at for entry in self.chats.values()), default=None)
+            if next_at is None:
+                break
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), max(0.0, next_at - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+        self.task = None
+
+    def stats(self):
+        return {"active": len(self.chats), "sent": self.sent, "failed": self.failed}
+
+
+if __name__ == "__main__":
+    # Keep typing in 500 chats for 10 seconds with a fake Bot API call and count the sends
+    import threading
+
+    async def benchmark(chats=500, seconds=10):
+        async def send(chat_id, action):
+            await asyncio.sleep(0.05)
+
+        scheduler = ChatActionScheduler(send, rate=1000)
+
+        async def request(chat_id):
+            async with scheduler.typing(chat_id):
+                await asyncio.sleep(seconds)
+
+        start = time.perf_counter()
+        threads = threading.active_count()
+        await asyncio.gather(*(request(chat_id) for chat_id in range(chats)))
+        print(f"{chats} chats for {time.perf_counter() - start:.1f}s: {scheduler.sent} actions sent, "
+              f"threads {threads} -> {threading.active_count()}, active after {len(scheduler.chats)}")
+
+    asyncio.run(benchmark())
@@ -0,0 +1,251 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from telethon import TelegramClient, utils
+from file_lock import FileLock
+from metrics import telegram_api_calls
+
+# Seconds a login flow may wait in each state before its client is disconnected:
+# a fresh unauthorized client, waiting for the code, waiting for the 2FA password
+default_login_timeouts = {
+    "new": 2 * 60,
+    "code_sent": 5 * 60,
+    "password_needed": 10 * 60
+}
+
+
+class SessionLockedError(Exception):
+    """The account's session file is in use by another process"""
+
+
+class CountingTelegramClient(TelegramClient):
+    """
+    TelegramClient that counts every request it sends, by TL request type.
+    All of Telethon's methods go through __call__, so calls made outside the
+    RateLimiter (iter_messages, get_me, login steps) are counted too.
+    """
+
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        for item in (request if utils.is_list_like(request) else (request,)):
+            telegram_api_calls.inc(method=type(item).__name__)
+        return await super().__call__(request, ordered, flood_sleep_threshold)
+
+
+class PooledClient:
+    """A connected client plus the bookkeeping the pool needs for eviction"""
+
+    def __init__(self, phone, client, session_lock=None):
+        self.phone = phone
+        self.client = client
+        self.session_lock = session_lock
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.busy = 0
+        self.login_state = None
+        self.state_since = self.created_at
+
+
+class ClientPool:
+    """
+    Keeps TelegramClients connected across calls so login steps and syncs reuse
+    the same MTProto connection instead of paying the handshake every time.
+    Idle clients are disconnected after idle_timeout seconds and the least
+    recently used client is evicted once more than max_clients are open.
+    Clients in the middle of a login flow are never evicted for capacity, so
+    every login step reaches the same client, but each login state has its
+    own timeout after which an abandoned flow is disconnected.
+
+    Telethon sessions are SQLite files, so a client holds a lock on its
+    session for as long as it is pooled; another process (an API worker,
+    the scheduler) asking for the same account gets SessionLockedError
+    instead of a second writer on the file.
+    """
+
+    def __init__(self, api_id, api_hash, sessions_dir="sessions", max_clients=20,
+                 idle_timeout=30 * 60, health_check_interval=60, login_timeouts=None):
+        self.api_id = api_id
+        self.api_hash = api_hash
+        self.sessions_dir = sessions_dir
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.login_timeouts = dict(default_login_timeouts, **(login_timeouts or {}))
+        self.entries = OrderedDict()
+        self.lock = asyncio.Lock()
+        self.maintenance_task = None
+
+        # Counters for reporting
+        self.created = 0
+        self.reconnects = 0
+        self.evictions = {"idle": 0, "lru": 0, "login_timeout": 0, "unhealthy": 0}
+
+    def session_path(self, phone):
+        return os.path.join(self.sessions_dir, phone)
+
+    def lock_session(self, phone):
+        lock = FileLock(self.session_path(phone) + ".lock")
+        if not lock.acquire():
+            raise SessionLockedError(f"Session of {phone} is in use by process {lock.holder()}")
+        return lock
+
+    async def get(self, phone):
+        """Get a connected client for the phone number, creating it if needed"""
+        async with self.lock:
+            entry = self.entries.get(phone)
+            if entry is None:
+                session_lock = self.lock_session(phone)
+                try:
+                    # Telethon would sleep through FloodWaits under 60s inside the one request;
+                    # raise them all so the RateLimiter pauses every chat, not just this call
+                    client = CountingTelegramClient(self.session_path(phone), self.api_id, self.api_hash,
+                                                    flood_sleep_threshold=0)
+                    await client.connect()
+                except BaseException:
+                    session_lock.release()
+                    raise
+                entry = PooledClient(phone, client, session_lock)
+                self.entries[phone] = entry
+                self.created += 1
+                await self._evict_over_capacity(keep=phone)
+            elif not entry.client.is_connected():
+                print(f"Reconnecting client for {phone}")
+                await entry.client.connect()
+                self.reconnects += 1
+
+            self.entries.move_to_end(phone)
+            entry.last_used = time.time()
+            return entry.client
+
+    @asynccontextmanager
+    async def use(self, phone):
+        """Borrow a client; it is not evicted while borrowed"""
+        client = await self.get(phone)
+        entry = self.entries.get(phone)
+        if entry is not None:
+            entry.busy += 1
+        try:
+            yield client
+        finally:
+            if entry is not None:
+                entry.busy -= 1
+                entry.last_used = time.time()
+
+    def set_login_state(self, phone, state):
+        """
+        Record where the phone's login flow is: one of login_timeouts' states
+        while it is pending, "authorized" once it is done
+        """
+        entry = self.entries.get(phone)
+        if entry is not None:
+            entry.login_state = state
+            entry.state_since = time.time()
+
+    def login_state(self, phone):
+        """Login state of the phone's pooled client, None when it has none or is not pooled"""
+        entry = self.entries.get(phone)
+        return entry.login_state if entry is not None else None
+
+    def is_pending_login(self, entry):
+        return entry.login_state in self.login_timeouts
+
+    def expired(self, entry, now):
+        if self.is_pending_login(entry):
+            return now - entry.state_since > self.login_timeouts[entry.login_state]
+        return now - entry.last_used > self.idle_timeout
+
+    async def _close_entry(self, entry, reason=None):
+        if reason is not None:
+            self.evictions[reason] += 1
+        self.entries.pop(entry.phone, None)
+        try:
+            await entry.client.disconnect()
+        except Exception as e:
+            print(f"Error disconnecting client for {entry.phone}: {str(e)}")
+        if entry.session_lock is not None:
+            entry.session_lock.release()
+
+    async def _evict_over_capacity(self, keep=None):
+        # Least recently used entries come first in the OrderedDict
+        for entry in list(self.entries.values()):
+            if len(self.entries) <= self.max_clients:
+                break
+            if entry.busy or self.is_pending_login(entry) or entry.phone == keep:
+                continue
+            print(f"Evicting least recently used client for {entry.phone}")
+            await self._close_entry(entry, "lru")
+        if len(self.entries) > self.max_clients:
+            print(f"{len(self.entries)} clients open, over the limit of {self.max_clients} while logins are pending")
+
+    async def evict_idle(self):
+        """Disconnect idle clients and login flows that stayed too long in one state"""
+        now = time.time()
+        async with self.lock:
+            for entry in list(self.entries.values()):
+                if entry.busy or not self.expired(entry, now):
+                    continue
+                if self.is_pending_login(entry):
+                    print(f"Login for {entry.phone} timed out waiting in state {entry.login_state}")
+                    await self._close_entry(entry, "login_timeout")
+                else:
+                    print(f"Evicting idle client for {entry.phone}")
+                    await self._close_entry(entry, "idle")
+
+    async def health_check(self):
+        """Reconnect clients whose connection has dropped"""
+        async with self.lock:
+            for entry in list(self.entries.values()):
+                if entry.client.is_connected():
+                    continue
+                try:
+                    print(f"Reconnecting client for {entry.phone}")
+                    await entry.client.connect()
+                    self.reconnects += 1
+                except Exception as e:
+                    print(f"Error reconnecting client for {entry.phone}: {str(e)}")
+                    await self._close_entry(entry, "unhealthy")
+
+    async def run_maintenance(self):
+        """Periodically evict idle clients and reconnect dropped ones"""
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            try:
+                await self.evict_idle()
+                await self.health_check()
+            except Exception as e:
+                print(f"Error during client pool maintenance: {str(e)}")
+
+    def stats(self):
+        """Open clients by login state plus lifetime counters"""
+        states = {}
+        for entry in self.entries.values():
+            state = entry.login_state or "active"
+            states[state] = states.get(state, 0) + 1
+        return {
+            "open": len(self.entries),
+            "max_clients": self.max_clients,
+            "busy": sum(1 for entry in self.entries.values() if entry.busy),
+            "states": states,
+            "created": self.created,
+            "reconnects": self.reconnects,
+            "evictions": dict(self.evictions)
+        }
+
+    def start_maintenance(self):
+        if self.maintenance_task is None or self.maintenance_task.done():
+            self.maintenance_task = asyncio.create_task(self.run_maintenance())
+
+    async def close(self, phone):
+        async with self.lock:
+            entry = self.entries.get(phone)
+            if entry is not None:
+                await self._close_entry(entry)
+
+    async def close_all(self):
+        if self.maintenance_task is not None:
+            self.maintenance_task.cancel()
+            self.maintenance_task = None
+        async with self.lock:
+            for entry in list(self.entries.values()):
+                await self._close_entry(entry)
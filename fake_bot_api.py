@@ -0,0 +1,231 @@
+import asyncio
+import itertools
+import json
+import threading
+import time
+import aiohttp
+from aiohttp import web
+
+# The bot's own user, returned by getMe and as the sender of its messages
+bot_user = {"id": 1, "is_bot": True, "first_name": "Trok", "username": "trok_bot"}
+
+
+class FakeBotAPI:
+    """
+    Local stand-in for the Telegram Bot API, for tests and load tests of
+    telegram_bot.py. Updates pushed with push_message are served by
+    getUpdates, or POSTed to the webhook once setWebhook was called, with
+    its secret token header and redelivered after a failure; every other
+    call is recorded and answered like Telegram would (sendMessage returns
+    a message object, the rest True). It runs
+    its own event loop in a background thread, so both threaded and
+    asyncio bots can use it. Extra aiohttp routes (e.g. a fake /users)
+    can be served on the same port.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, routes=()):
+        self.host = host
+        self.port = port
+        self.routes = list(routes)
+        self.loop = None
+        self.thread = None
+        self.runner = None
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.calls = []
+        self.condition = threading.Condition()
+        self.new_updates = None
+        self.webhook = None
+        self.webhook_secret = None
+        self.deliveries = []
+        self.session = None
+        self.delivery_slots = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def api_url(self):
+        """Bot API URL template in the format telebot's API_URL settings take"""
+        return self.url + "/bot{0}/{1}"
+
+    def start(self):
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(ready,), daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self
+
+    def run(self, ready):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.serve())
+        ready.set()
+        self.loop.run_forever()
+
+    async def serve(self):
+        self.new_updates = asyncio.Event()
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        app.add_routes(self.routes)
+        self.runner = web.AppRunner(app, access_log=None, shutdown_timeout=1)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.cleanup(), self.loop).result(15)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(10)
+        self.loop = None
+
+    async def cleanup(self):
+        if self.session is not None:
+            await self.session.close()
+        await self.runner.cleanup()
+
+    async def params(self, request):
+        params = dict(request.query)
+        if request.content_type == "application/json":
+            params.update(await request.json())
+        elif request.can_read_body:
+            # telebot's asyncio client sends form bodies with GET requests too
+            params.update(await request.clone(method="POST").post())
+        return params
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = await self.params(request)
+        if method == "getUpdates":
+            if self.webhook is not None:
+                return web.json_response({
+                    "ok": False, "error_code": 409,
+                    "description": "Conflict: can't use getUpdates method while webhook is active"
+                }, status=409)
+            result = await self.get_updates(params)
+        else:
+            result = self.call(method, params)
+        return web.json_response({"ok": True, "result": result})
+
+    async def get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        while True:
+            # Telegram forgets updates once a later offset confirms them
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            if self.updates or time.monotonic() >= deadline:
+                return self.updates[:limit]
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                pass
+
+    def call(self, method, params):
+        with self.condition:
+            self.calls.append((method, params, time.time()))
+            self.condition.notify_all()
+        if method == "getMe":
+            return bot_user
+        if method == "setWebhook":
+            self.webhook = params.get("url") or None
+            self.webhook_secret = params.get("secret_token")
+            self.delivery_slots = asyncio.Semaphore(int(params.get("max_connections") or 40))
+            # Updates queued for getUpdates go to the webhook now
+            pending, self.updates = self.updates, []
+            for update in pending:
+                self.loop.create_task(self.deliver(update))
+            return True
+        if method == "deleteWebhook":
+            self.webhook = None
+            return True
+        if method == "getWebhookInfo":
+            return {"url": self.webhook or "", "pending_update_count": len(self.updates)}
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id") or 0)
+            return {
+                "message_id": int(params.get("message_id") or next(self.message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": bot_user,
+                "text": params.get("text", "")
+            }
+        return True
+
+    def message_update(self, user_id, text):
+        return {
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": f"User{user_id}"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+                "text": text
+            }
+        }
+
+    def push(self, update):
+        """Queue an update for the bot; safe to call from any thread"""
+        def add():
+            if self.webhook is not None:
+                self.loop.create_task(self.deliver(update))
+                return
+            self.updates.append(update)
+            self.new_updates.set()
+        self.loop.call_soon_threadsafe(add)
+        return update
+
+    async def deliver(self, update, attempts=5):
+        """POST an update to the webhook like Telegram: one per request, retried until it gets a 2xx"""
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.webhook_secret} if self.webhook_secret else {}
+        for attempt in range(attempts):
+            status = None
+            try:
+                async with self.delivery_slots:
+                    async with self.session.post(self.webhook, json=update, headers=headers) as response:
+                        status = response.status
+            except aiohttp.ClientError:
+                pass
+            with self.condition:
+                self.deliveries.append((update["update_id"], status))
+                self.condition.notify_all()
+            if status is not None and 200 <= status < 300:
+                return
+            await asyncio.sleep(0.5 * (attempt + 1))
+
+    def push_message(self, user_id, text):
+        """A private text message from user_id to the bot"""
+        return self.push(self.message_update(user_id, text))
+
+    def calls_to(self, method):
+        with self.condition:
+            return [params for name, params, _ in self.calls if name == method]
+
+    def wait_for(self, method, count, timeout=60):
+        """Block until method has been called count times; False on timeout"""
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: sum(1 for name, _, _ in self.calls if name == method) >= count, timeout
+            )
+
+
+if __name__ == "__main__":
+    # Serve a fake Bot API for manual testing: python fake_bot_api.py [port]
+    import sys
+
+    api = FakeBotAPI(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8081).start()
+    print(f"Fake Bot API on {api.url}, set telebot's API_URL to {api.api_url}")
+    try:
+        while True:
+            time.sleep(5)
+            print(json.dumps([name for name, _, _ in api.calls[-10:]]))
+    except KeyboardInterrupt:
+        api.stop()
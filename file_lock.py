@@ -0,0 +1,58 @@
+import os
+
+try:
+    import fcntl
+except ImportError:  # No advisory locks (Windows): a single process is assumed
+    fcntl = None
+
+
+class FileLock:
+    """
+    Exclusive advisory lock on a lock file, shared by every process on the
+    host. It is released by release() or when the holding process exits,
+    so a crashed process never leaves a stale lock behind.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    @property
+    def locked(self):
+        return self.fd is not None
+
+    def acquire(self, blocking=False):
+        """Take the lock; without blocking, return False at once when another process holds it"""
+        if self.fd is not None:
+            return True
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+        # Holder's pid, for whoever finds the lock taken
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def holder(self):
+        """Pid written by the process holding the lock, None when unknown"""
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip() or 0) or None
+        except (OSError, ValueError):
+            return None
@@ -0,0 +1,191 @@
+import asyncio
+import os
+import sys
+import time
+from telethon import events
+from telegram_sender import client_pool, default_phone, message_row
+from message_store import message_store, to_timestamp
+from sender_cache import sender_cache
+
+# Flush buffered updates every flush_size updates or flush_interval_ms milliseconds
+flush_size = int(os.getenv('ingest_flush_size', 200))
+flush_interval_ms = int(os.getenv('ingest_flush_interval_ms', 500))
+
+
+class IngestBuffer:
+    """Live updates waiting to be written to the message store in one transaction"""
+
+    def __init__(self):
+        self.senders = {}
+        self.messages = {}
+        self.activity = []
+        self.deleted = []
+        self.reads = []
+
+    def __len__(self):
+        return len(self.messages) + len(self.activity) + len(self.deleted) + len(self.reads)
+
+    def drop_deleted(self, chat_id, message_ids):
+        # A deletion wins over an edit that is still waiting in the buffer
+        for key in list(self.messages):
+            if key[1] in message_ids and (chat_id is None or key[0] == chat_id):
+                del self.messages[key]
+
+
+class IngestService:
+    """
+    Keeps the message store current by subscribing to Telethon updates
+    (new, edited and deleted messages and inbox read receipts) on a pooled
+    client, writing them in batches.
+    """
+
+    def __init__(self, phone, flush_size=flush_size, flush_interval_ms=flush_interval_ms):
+        self.phone = phone
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.buffer = IngestBuffer()
+        self.flush_event = asyncio.Event()
+        self.running = False
+        self.ingested = 0
+
+    def register(self, client):
+        client.add_event_handler(self.on_message, events.NewMessage())
+        client.add_event_handler(self.on_message, events.MessageEdited())
+        client.add_event_handler(self.on_deleted, events.MessageDeleted())
+        client.add_event_handler(self.on_read, events.MessageRead(inbox=True))
+
+    def unregister(self, client):
+        client.remove_event_handler(self.on_message)
+        client.remove_event_handler(self.on_deleted)
+        client.remove_event_handler(self.on_read)
+
+    def buffered(self):
+        if len(self.buffer) >= self.flush_size:
+            self.flush_event.set()
+
+    async def on_message(self, event):
+        """Handle new and edited messages in private chats"""
+        try:
+            if not event.is_private or not event.message.text:
+                return
+
+            chat = await event.get_chat()
+            if getattr(chat, 'bot', False):
+                return
+
+            message = event.message
+            # Only look the sender up when the cache has no fresh name for it
+            if not sender_cache.is_fresh(message.sender_id):
+                sender = await event.get_sender()
+                for row in sender_cache.stale_rows([sender]):
+                    self.buffer.senders[row["sender_id"]] = row
+            self.buffer.messages[(event.chat_id, message.id)] = message_row(event.chat_id, message)
+
+            # MessageEdited.Event subclasses NewMessage.Event; an edit is not new activity
+            if isinstance(event, events.NewMessage.Event) and not isinstance(event, events.MessageEdited.Event):
+                name = " ".join(part for part in (getattr(chat, 'first_name', None), getattr(chat, 'last_name', None)) if part)
+                self.buffer.activity.append({
+                    "chat_id": event.chat_id,
+                    "name": name,
+                    "safe_name": "".join(c for c in name if c.isalnum()).rstrip(),
+                    "message_id": message.id,
+                    "date": to_timestamp(message.date),
+                    "incoming": int(not message.out)
+                })
+            self.buffered()
+        except Exception as e:
+            print(f"Error ingesting message: {str(e)}")
+
+    async def on_deleted(self, event):
+        """Handle deleted messages; private chat deletions come without a chat id"""
+        chat_id = event.chat_id
+        message_ids = set(event.deleted_ids)
+        self.buffer.drop_deleted(chat_id, message_ids)
+        self.buffer.deleted.extend((chat_id, message_id) for message_id in message_ids)
+        self.buffered()
+
+    async def on_read(self, event):
+        """Handle messages we read on another device"""
+        if event.is_private:
+            self.buffer.reads.append((event.chat_id, event.max_id))
+            self.buffered()
+
+    def flush(self):
+        """Write everything buffered so far in a single transaction"""
+        if not len(self.buffer):
+            return
+        buffer, self.buffer = self.buffer, IngestBuffer()
+        try:
+            message_store.write_batch(
+                self.phone,
+                senders=buffer.senders.values(),
+                messages=buffer.messages.values(),
+                activity=buffer.activity,
+                deleted=buffer.deleted,
+                reads=buffer.reads
+            )
+            self.ingested += len(buffer)
+        except Exception as e:
+            print(f"Error writing ingested updates for {self.phone}: {str(e)}")
+
+    async def flush_loop(self):
+        while self.running:
+            try:
+                await asyncio.wait_for(self.flush_event.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_event.clear()
+            self.flush()
+            message_store.prune_changes()
+
+    async def run(self):
+        """Ingest updates until stopped, reconnecting when the connection drops"""
+        self.running = True
+        flush_task = asyncio.create_task(self.flush_loop())
+        try:
+            while self.running:
+                async with client_pool.use(self.phone) as client:
+                    if not await client.is_user_authorized():
+                        print(f"Account {self.phone} is not logged in, not ingesting")
+                        return
+                    self.register(client)
+                    print(f"Ingesting live updates for {self.phone}")
+                    try:
+                        # Ask Telegram for the updates missed while we were away
+                        await client.catch_up()
+                        await client.run_until_disconnected()
+                    finally:
+                        self.unregister(client)
+                if self.running:
+                    print(f"Connection for {self.phone} dropped, reconnecting")
+                    await asyncio.sleep(1)
+        finally:
+            self.running = False
+            flush_task.cancel()
+            self.flush()
+
+    def stop(self):
+        self.running = False
+
+
+async def run_ingest(phones):
+    """Run an ingest service for every phone until interrupted"""
+    services = [IngestService(phone) for phone in phones]
+    start_time = time.time()
+    try:
+        await asyncio.gather(*(service.run() for service in services))
+    finally:
+        for service in services:
+            service.stop()
+            print(f"Ingested {service.ingested} updates for {service.phone} in {time.time() - start_time:.0f}s")
+        await client_pool.close_all()
+
+def main():
+    phones = sys.argv[1:] or [default_phone]
+    try:
+        asyncio.run(run_ingest(phones))
+    except KeyboardInterrupt:
+        print("\nIngest stopped")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import asyncio
+import os
+import time
+from collections import deque
+from metrics import job_queue_depth, jobs_running, job_wait_seconds, jobs_finished
+
+# Questions answered at once across all users, and per user
+llm_max_concurrent = int(os.getenv('llm_max_concurrent', 4))
+llm_max_per_user = int(os.getenv('llm_max_per_user', 1))
+
+# Questions allowed to wait; past it new ones are turned away
+question_max_waiting = int(os.getenv('question_max_waiting', 100))
+
+
+class JobCancelled(Exception):
+    """A job was superseded by a newer one of the same user, or cancelled"""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class QueueFull(Exception):
+    """Too many jobs are waiting already"""
+
+
+class Job:
+    def __init__(self, user_id, func):
+        self.user_id = user_id
+        self.func = func
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.task = None
+        self.cancel_reason = None
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class JobQueue:
+    """
+    FIFO queue of async jobs with a global and a per-user limit on running
+    jobs. A user's new job supersedes their older ones: waiting ones are
+    dropped and a running one is cancelled, so a user firing questions in a
+    row costs one LLM call, not one per question. Jobs of users already at
+    their limit are skipped over, not blocking the users behind them.
+    """
+
+    def __init__(self, name, max_running=llm_max_concurrent, max_per_user=llm_max_per_user,
+                 max_waiting=question_max_waiting, supersede=True):
+        self.name = name
+        self.max_running = max_running
+        self.max_per_user = max_per_user
+        self.max_waiting = max_waiting
+        self.supersede = supersede
+        self.waiting = deque()
+        self.running = {}
+        self.user_jobs = {}
+
+    def submit(self, user_id, func):
+        """Queue func() (a coroutine function) for the user and return its Job"""
+        if self.supersede:
+            for job in list(self.user_jobs.get(user_id, ())):
+                self.cancel(job, "superseded")
+        if len(self.waiting) >= self.max_waiting:
+            jobs_finished.inc(queue=self.name, outcome="rejected")
+            raise QueueFull(f"{len(self.waiting)} jobs are waiting already")
+        job = Job(user_id, func)
+        self.waiting.append(job)
+        self.user_jobs.setdefault(user_id, []).append(job)
+        self.schedule()
+        self.report()
+        return job
+
+    async def wait(self, job):
+        """The job's result; raises JobCancelled if it was superseded or cancelled"""
+        return await job.future
+
+    def position(self, job):
+        """1-based place of a waiting job in the queue, 0 once it runs or is done"""
+        try:
+            return self.waiting.index(job) + 1
+        except ValueError:
+            return 0
+
+    def cancel(self, job, reason="cancelled"):
+        if job in self.waiting:
+            self.waiting.remove(job)
+            self.finish(job, reason)
+            job.future.set_exception(JobCancelled(reason))
+        elif job.task is not None and not job.task.done():
+            job.cancel_reason = reason
+            job.task.cancel()
+
+    def running_for(self, user_id):
+        return sum(1 for job in self.running.values() if job.user_id == user_id)
+
+    def schedule(self):
+        """Start waiting jobs, oldest first, while the limits allow"""
+        for job in list(self.waiting):
+            if len(self.running) >= self.max_running:
+                break
+            if self.running_for(job.user_id) >= self.max_per_user:
+                continue
+            self.waiting.remove(job)
+            job.started_at = time.monotonic()
+            job_wait_seconds.observe(job.started_at - job.submitted_at, queue=self.name)
+            job.task = asyncio.create_task(job.func())
+            self.running[job.task] = job
+            # A callback rather than try/finally, it also runs for a task cancelled before it started
+            job.task.add_done_callback(lambda task, job=job: self.done(job, task))
+
+    def done(self, job, task):
+        self.running.pop(task, None)
+        if task.cancelled():
+            outcome = job.cancel_reason or "cancelled"
+            job.future.set_exception(JobCancelled(outcome))
+        elif task.exception() is not None:
+            outcome = "failed"
+            job.future.set_exception(task.exception())
+        else:
+            outcome = "completed"
+            job.future.set_result(task.result())
+        self.finish(job, outcome)
+        self.schedule()
+        self.report()
+
+    def finish(self, job, outcome):
+        jobs = self.user_jobs.get(job.user_id, [])
+        if job in jobs:
+            jobs.remove(job)
+        if not jobs:
+            self.user_jobs.pop(job.user_id, None)
+        jobs_finished.inc(queue=self.name, outcome=outcome)
+        # Mark the outcome retrieved, a superseded job may have nobody waiting for it
+        job.future.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+    def report(self):
+        job_queue_depth.set(len(self.waiting), queue=self.name)
+        jobs_running.set(len(self.running), queue=self.name)
+
+    def stats(self):
+        return {"waiting": len(self.waiting), "running": len(self.running), "users": len(self.user_jobs)}
+
+
+if __name__ == "__main__":
+    # 50 users ask 3 questions 0.1s apart with 1s answers and 4 slots: superseded questions never reach the LLM
+    import random
+
+    async def benchmark(users=50, questions=3, latency=1.0):
+        queue = JobQueue("benchmark", max_running=4)
+        calls = []
+        peak = [0]
+
+        async def answer(user_id, question):
+            calls.append((user_id, question))
+            peak[0] = max(peak[0], len(queue.running))
+            await asyncio.sleep(latency)
+            return question
+
+        async def ask(user_id, question):
+            job = queue.submit(user_id, lambda: answer(user_id, question))
+            try:
+                return await queue.wait(job)
+            except JobCancelled:
+                return None
+
+        async def user(user_id):
+            tasks = []
+            for question in range(questions):
+                tasks.append(asyncio.create_task(ask(user_id, question)))
+                await asyncio.sleep(0.1 + random.random() * 0.05)
+            return await asyncio.gather(*tasks)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(user(user_id) for user_id in range(users)))
+        answered = sum(1 for answers in results for answer in answers if answer is not None)
+        print(f"{users * questions} questions, {answered} answered, {len(calls)} LLM calls started, "
+              f"peak running {peak[0]}, {time.perf_counter() - start:.1f}s")
+
+    asyncio.run(benchmark())
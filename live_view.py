@@ -0,0 +1,167 @@
+import asyncio
+import json
+import aiohttp
+from records import MessageBatch, MessageRecord
+
+
+async def parse_events(lines):
+    """Yield (id, event, data) from Server-Sent Events lines"""
+    event_id, event, data = None, "message", []
+    async for line in lines:
+        if not line:
+            if data:
+                yield event_id, event, "\n".join(data)
+            event, data = "message", []
+        elif line.startswith(":"):
+            yield None, "keep-alive", None
+        else:
+            field, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            if field == "id":
+                event_id = value
+            elif field == "event":
+                event = value
+            elif field == "data":
+                data.append(value)
+
+
+async def stream_lines(response):
+    """Decoded lines of a streamed response body, without their line endings"""
+    async for line in response.content:
+        yield line.decode("utf-8").rstrip("\r\n")
+
+
+class LiveView:
+    """
+    Local copy of an account's /users data kept current from the API's
+    /stream endpoint. It is loaded from /users once; new, edited, deleted and
+    read messages are then applied as they are stored, and a reconnect
+    resumes after the last event seen. Messages are kept as MessageRecords;
+    snapshot() has the /users shape with a MessageBatch per chat.
+    It runs as a task on the bot's event loop, over the bot's API session
+    (get_session returns it).
+    """
+
+    def __init__(self, api_url, per_chat_limit, get_session, phone=None, reconnect_delay=5, read_timeout=60):
+        self.api_url = api_url
+        self.per_chat_limit = per_chat_limit
+        self.get_session = get_session
+        self.phone = phone
+        self.reconnect_delay = reconnect_delay
+        self.read_timeout = read_timeout
+        self.most_recent = {}
+        self.unread = {}
+        self.cursor = None
+        self.ready = False
+        self.task = None
+        self.events = 0
+
+    def params(self):
+        return {"phone": self.phone} if self.phone else {}
+
+    def start(self):
+        """Start following the stream; call from inside the event loop"""
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                if self.cursor is None:
+                    await self.load()
+                await self.follow()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                print(f"Live view disconnected: {str(e)}")
+            self.ready = False
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def load(self):
+        """Replace the view with a fresh /users snapshot and the stream cursor it is current up to"""
+        session = await self.get_session()
+        async with session.get(
+            f"{self.api_url}/users", params=dict(self.params(), per_chat_limit=self.per_chat_limit),
+            timeout=aiohttp.ClientTimeout(total=60)
+        ) as response:
+            response.raise_for_status()
+            data = json.loads(await response.text())["messages"]
+            cursor = int(response.headers.get("X-Stream-Cursor", 0))
+        self.most_recent = {
+            chat: {message["id"]: MessageRecord.from_api(message, chat) for message in messages}
+            for chat, messages in data["most_recent"].items()
+        }
+        self.unread = {
+            chat: {message["id"]: MessageRecord.from_api(message, chat) for message in messages}
+            for chat, messages in data["unread"].items()
+        }
+        self.cursor = cursor
+
+    async def follow(self):
+        """Apply stream events until the connection drops"""
+        session = await self.get_session()
+        async with session.get(
+            f"{self.api_url}/stream", params=dict(self.params(), cursor=self.cursor),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=self.read_timeout)
+        ) as response:
+            response.raise_for_status()
+            self.ready = True
+            async for event_id, event, data in parse_events(stream_lines(response)):
+                if event == "keep-alive":
+                    continue
+                if event in ("reset", "rename"):
+                    # Missed more changes than the server keeps, or a chat or sender
+                    # name changed in messages already held: start over
+                    await self.load()
+                    continue
+                self.apply(json.loads(data))
+                self.cursor = int(event_id)
+
+    def apply(self, event):
+        self.events += 1
+        chat = event["chat"]
+        if event["type"] in ("new", "edit"):
+            message = MessageRecord.from_api(event, chat)
+            self.add(self.most_recent, chat, message)
+            if event["type"] == "new" and not event["out"]:
+                self.add(self.unread, chat, message)
+            elif event["id"] in self.unread.get(chat, {}):
+                self.unread[chat][event["id"]] = message
+        elif event["type"] == "delete":
+            for view in (self.most_recent, self.unread):
+                view.get(chat, {}).pop(event["id"], None)
+        elif event["type"] == "read":
+            messages = self.unread.get(chat, {})
+            for message_id in [message_id for message_id in messages if message_id <= event["id"]]:
+                del messages[message_id]
+            if not messages:
+                self.unread.pop(chat, None)
+
+    def add(self, view, chat, message):
+        # Keep only the per_chat_limit newest messages of each chat
+        messages = view.setdefault(chat, {})
+        messages[message.id] = message
+        if len(messages) > self.per_chat_limit:
+            oldest = min(messages.values(), key=lambda item: (item.date, item.id))
+            del messages[oldest.id]
+
+    def snapshot(self):
+        """The view as /users batches: chats by latest activity, most recent newest first, unread oldest first"""
+        def newest(messages):
+            return max((message.date for message in messages.values()), default=0)
+
+        most_recent = {
+            chat: MessageBatch().extend(sorted(messages.values(), key=lambda item: (item.date, item.id), reverse=True))
+            for chat, messages in sorted(self.most_recent.items(), key=lambda item: newest(item[1]), reverse=True)
+            if messages
+        }
+        unread = {
+            chat: MessageBatch().extend(sorted(messages.values(), key=lambda item: item.id))
+            for chat, messages in self.unread.items()
+            if messages
+        }
+        return {"messages": {"most_recent": most_recent, "unread": unread}}
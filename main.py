@@ -1,14 +1,103 @@
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, NamedTuple, Tuple
 from datetime import datetime
+import asyncio
 import json
-import re
-from telegram_sender import submit_code, initiate_login, store_messages, submit_password
+import os
+import time
+from telegram_sender import (
+    default_phone, unread_chats_limit, unread_messages_limit, latest_chats_limit, latest_messages_limit,
+    specific_chat_messages_limit
+)
+from message_store import message_store, record_from_row, to_timestamp, encode_cursor, decode_cursor
+from response_cache import SnapshotCache
+from search_index import hybrid_search, embedding_backend
+from telegram_rpc import LocalTelegram, RPCClient, RPCError
+from file_lock import FileLock
+from client_pool import SessionLockedError
+from sender_cache import sender_cache
+import metrics
+from serialization import (
+    JSONBytesResponse, EncodedBody, dumps, messages_to_json, users_payload, change_to_json, choose_encoding,
+    search_payload
+)
 
 
 app = FastAPI()
 
+# /users snapshots per account: served from cache for users_cache_ttl seconds, then
+# served stale while one background refresh runs, for up to users_cache_max_stale seconds.
+# Only first pages are cached, at most users_cache_max_entries of them
+users_cache = SnapshotCache(
+    ttl=float(os.getenv('users_cache_ttl', 30)),
+    max_stale=float(os.getenv('users_cache_max_stale', 10 * 60)),
+    max_entries=int(os.getenv('users_cache_max_entries', 256))
+)
+
+# Refresh runs an incremental sync first; turn off when ingest_daemon.py or
+# sync_scheduler.py already keeps the store current
+users_sync_on_refresh = os.getenv('users_sync_on_refresh', '1') == '1'
+
+# Telegram clients, login flows and syncs. With telegram_rpc_socket set they live in
+# the owner process (python telegram_rpc.py) and any number of API workers
+# (uvicorn --workers N) call it over that unix socket; otherwise this process owns
+# them and has to be the only worker. Syncs are shared per account for users_cache_ttl.
+telegram_rpc_socket = os.getenv('telegram_rpc_socket')
+telegram = RPCClient(telegram_rpc_socket) if telegram_rpc_socket else LocalTelegram(users_cache.ttl)
+
+# Only one worker embeds new messages, whichever takes this lock first
+indexer_lock = FileLock(os.path.join(os.path.dirname(message_store.path) or '.', 'indexer.lock'))
+
+# /stream and /ws poll the store's change log, which every writer process appends to
+stream_poll_interval = float(os.getenv('stream_poll_interval', 0.5))
+stream_keepalive = float(os.getenv('stream_keepalive', 15))
+stream_batch_size = int(os.getenv('stream_batch_size', 500))
+
+def cache_requests():
+    caches = {"users": users_cache}
+    if isinstance(telegram, LocalTelegram):
+        caches["sync"] = telegram.sync_cache
+    values = {}
+    for name, cache in caches.items():
+        values[(name, "hit")] = cache.hits
+        values[(name, "stale_hit")] = cache.stale_hits
+        values[(name, "miss")] = cache.misses
+    values[("sender", "hit")] = sender_cache.hits
+    values[("sender", "miss")] = sender_cache.misses
+    return values
+
+def cache_hit_ratio():
+    totals = {}
+    for (cache, result), count in cache_requests().items():
+        hits, requests = totals.get(cache, (0, 0))
+        totals[cache] = (hits + (count if result != "miss" else 0), requests + count)
+    return {(cache,): hits / requests for cache, (hits, requests) in totals.items() if requests}
+
+metrics.callback("trok_cache_requests_total", "Cache lookups by result", cache_requests,
+                 ("cache", "result"), kind="counter")
+metrics.callback("trok_cache_hit_ratio", "Share of cache lookups served from the cache", cache_hit_ratio, ("cache",))
+
+@app.exception_handler(RPCError)
+@app.exception_handler(SessionLockedError)
+async def telegram_unavailable(request: Request, exc: Exception):
+    """The account's Telegram client is owned by a process this worker cannot reach"""
+    return JSONBytesResponse(dumps({"detail": str(exc)}), status_code=503)
+
+@app.on_event("startup")
+async def startup():
+    """Keep pooled Telegram clients healthy and stored messages embedded while the API is running"""
+    telegram.start()
+    if embedding_backend != 'none' and indexer_lock.acquire():
+        asyncio.create_task(hybrid_search.run_indexer())
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Disconnect every pooled Telegram client"""
+    await telegram.close()
+    indexer_lock.release()
+
 # Fake user database
 fake_user_db: Dict[str, Dict[str, str]] = {
     "-Nicholas": {"sender": "-Nicholas🖤", "full_sender": "Nicholas Smith"},
@@ -31,111 +120,360 @@ fake_messages_db: Dict[str, List[Dict]] = {
 }
 
 class Message(BaseModel):
+    id: Optional[int] = None
+    sender_id: Optional[int] = None
     sender: str
     text: str
     date: datetime
+    ts: Optional[int] = None
 
 class MessagesResponse(BaseModel):
     messages: Dict[str, Dict[str, List[Message]]]
+    next_cursor: Optional[str] = None
+
+class UsersQuery(NamedTuple):
+    """Pagination and filters of a /users request, hashable so it can key the cache"""
+    limit: Optional[int] = None
+    before: Optional[Tuple[int, int, int]] = None
+    after: Optional[Tuple[int, int, int]] = None
+    chat: Optional[int] = None
+    sender: Optional[int] = None
+    since: Optional[int] = None
+    until: Optional[int] = None
+    per_chat_limit: Optional[int] = None
+
+def parse_cursor(cursor):
+    if cursor is None:
+        return None
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def query_records(account, query, chat_ids):
+    """Filtered, newest-first page of records from the store's indexes"""
+    return message_store.query_messages(
+        account,
+        query.limit,
+        chat_ids=chat_ids,
+        sender_id=query.sender,
+        since=query.since,
+        until=query.until,
+        before=query.before,
+        after=query.after
+    )
+
+def next_page_cursor(query, records):
+    """
+    Cursor continuing in the direction the page was read: pages after a cursor
+    go on after their newest record, all others before their oldest one
+    """
+    if query.after is not None and query.before is None:
+        return encode_cursor(records[0])
+    return encode_cursor(records[-1])
 
-def remove_emoji(text: str) -> str:
-    """Remove emoji characters from text"""
-    emoji_pattern = re.compile("["
-        u"\U0001F600-\U0001F64F"  # emoticons
-        u"\U0001F300-\U0001F5FF"  # symbols & pictographs
-        u"\U0001F680-\U0001F6FF"  # transport & map symbols
-        u"\U0001F1E0-\U0001F1FF"  # flags (iOS)
-        u"\U00002702-\U000027B0"
-        u"\U000024C2-\U0001F251"
-        "]+", flags=re.UNICODE)
-    return emoji_pattern.sub('', text)
-
-@app.get("/users", response_model=MessagesResponse)
-async def read_users():
-    """Return all users' messages categorized by most recent and unread"""
+def build_page(account, query):
+    """
+    Most recent messages per chat (newest first), unread messages per chat and
+    the cursor of the next page. With per_chat_limit (the default), every chat
+    gets its own indexed query; with only a limit, one query pages through all
+    chats in date order and returns a next_cursor when the page is full.
+    """
+    chats_limit = max(unread_chats_limit, latest_chats_limit)
+    chat_ids = [query.chat] if query.chat is not None else None
+    dialogs = message_store.latest_dialogs(account, chats_limit, chat_ids)
+    
     most_recent = {}
+    next_cursor = None
+    if query.limit is not None and query.per_chat_limit is None:
+        records = query_records(account, query, chat_ids)
+        for record in records:
+            most_recent.setdefault(record.chat, []).append(record)
+        if len(records) == query.limit:
+            next_cursor = next_page_cursor(query, records)
+    else:
+        per_chat_limit = query.per_chat_limit or latest_messages_limit
+        remaining = query.limit
+        for dialog in dialogs:
+            if remaining is not None and remaining <= 0:
+                break
+            limit = per_chat_limit if remaining is None else min(per_chat_limit, remaining)
+            records = query_records(account, query._replace(limit=limit), [dialog["chat_id"]])
+            if records:
+                most_recent[dialog["safe_name"]] = records
+                if remaining is not None:
+                    remaining -= len(records)
+    
     unread = {}
-    messages_data = await store_messages()
+    unread_limit = min(unread_messages_limit, query.per_chat_limit or unread_messages_limit)
+    for dialog in dialogs:
+        if dialog["unread_count"] > 0:
+            rows = message_store.unread_messages(
+                account, dialog["chat_id"], dialog["read_inbox_max_id"],
+                min(dialog["unread_count"], unread_limit)
+            )
+            if rows:
+                unread[dialog["safe_name"]] = [record_from_row(row, dialog["safe_name"]) for row in rows]
     
-    # print("Raw messages_data:", messages_data)  # Debug print
+    return most_recent, unread, next_cursor
+
+def version_etag(seq):
+    """Weak ETag for a response built from an account's store at change seq"""
+    return f'W/"{seq}"'
+
+def not_modified(request, etag):
+    """Whether the client's If-None-Match already names this version"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+def versioned_response(request, etag, body, headers=None):
+    """
+    304 when the client already has this version, otherwise the body
+    compressed with the best coding the client accepts
+    """
+    headers = dict(headers or {})
+    headers.update({"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"})
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+    content, encoding = body.encode(choose_encoding(request.headers.get("accept-encoding")))
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return JSONBytesResponse(content, headers=headers)
+
+async def sync_account(account):
+    """Incremental sync of an account, at most once per users_cache_ttl"""
+    try:
+        if not await telegram.sync_account(account, only_if_empty=not users_sync_on_refresh):
+            print(f"Sync of {account} failed, serving the stored messages")
+    except (RPCError, SessionLockedError) as e:
+        # Serve what the store has; the owner process may be restarting, or another
+        # process (the scheduler) holds the session and keeps the store current itself
+        print(f"Error syncing {account}: {str(e)}")
+
+async def build_users_response(account, query):
+    """
+    Sync the account if needed and serialize its /users response from the
+    message store. Returns the change seq the response is current up to,
+    which is both its ETag version and its stream cursor, and the body.
+    """
+    await sync_account(account)
+    # Read before the page so a stream resumed from it may repeat, but never miss, a change
+    seq = message_store.latest_seq(account)
+    with metrics.query_seconds.time(endpoint="users"):
+        most_recent, unread, next_cursor = build_page(account, query)
     
-    # Process most recent messages
-    for user_id, messages in messages_data.get("messages", {}).get("most_recent", {}).items():
-        # print(f"Processing most recent messages for user {user_id}:", messages)  # Debug print
-        message_objects = []
-        for msg in messages:
-            try:
-                if isinstance(msg, str):
-                    msg = json.loads(msg)
-                message_objects.append(Message(
-                    sender=remove_emoji(msg.get("name", msg.get("sender", ""))),
-                    text=remove_emoji(msg.get("text", msg.get("message", ""))),
-                    date=datetime.fromisoformat(msg.get("date", datetime.now().isoformat()))
-                ))
-            except Exception as e:
-                print(f"Error processing message for user {user_id}: {str(e)}")
-                continue
-        
-        if message_objects:
-            most_recent[user_id] = message_objects
+    # Most recent messages newest first, unread messages in the order they arrived.
+    # Text and sender names were normalized (emoji stripped) when they were stored
+    with metrics.serialize_seconds.time(endpoint="users"):
+        body = users_payload(most_recent, unread, next_cursor)
+    return seq, EncodedBody(body)
+
+@app.get("/users", response_model=MessagesResponse, response_class=JSONBytesResponse)
+async def read_users(
+    request: Request,
+    phone: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=latest_chats_limit * latest_messages_limit),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    chat: Optional[int] = None,
+    sender: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    per_chat_limit: Optional[int] = Query(None, ge=1, le=latest_messages_limit)
+):
+    """
+    Return all users' messages categorized by most recent and unread.
+    The ETag changes with the account's store; send it back in If-None-Match
+    to get a 304 instead of the same body again.
+    """
+    account = phone or default_phone
+    query = UsersQuery(
+        limit=limit,
+        before=parse_cursor(before),
+        after=parse_cursor(after),
+        chat=chat,
+        sender=sender,
+        since=to_timestamp(since),
+        until=to_timestamp(until),
+        per_chat_limit=per_chat_limit
+    )
+    if query.before is not None or query.after is not None:
+        # Pages deeper in the history are read once each, caching them would only pile up bodies
+        seq, body = await build_users_response(account, query)
+        return versioned_response(request, version_etag(seq), body, {"X-Stream-Cursor": str(seq)})
+    # Concurrent requests for the same account and query share one refresh
+    key = (account, query)
+    seq, body = await users_cache.get(key, lambda: build_users_response(account, query))
+    if seq < message_store.latest_seq(account):
+        # Another worker or process stored changes since this snapshot: refresh in the background
+        users_cache.refresh(key, lambda: build_users_response(account, query))
+    # Consumers of /stream resume from here to keep the snapshot up to date
+    return versioned_response(request, version_etag(seq), body, {"X-Stream-Cursor": str(seq)})
+
+@app.get("/users/{user_id}", response_model=List[Message], response_class=JSONBytesResponse)
+async def read_user(
+    request: Request,
+    user_id: int,
+    phone: Optional[str] = None,
+    limit: int = Query(specific_chat_messages_limit, ge=1, le=latest_messages_limit),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    sender: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+):
+    """Return a specific user's messages, newest first; X-Next-Cursor points at the next page"""
+    account = phone or default_phone
+    query = UsersQuery(
+        limit=limit,
+        before=parse_cursor(before),
+        after=parse_cursor(after),
+        sender=sender,
+        since=to_timestamp(since),
+        until=to_timestamp(until)
+    )
+    # Nothing stored for the account changed since the client's copy
+    etag = version_etag(message_store.latest_seq(account))
+    if not_modified(request, etag):
+        return versioned_response(request, etag, None)
     
-    # Process unread messages
-    for user_id, messages in messages_data.get("messages", {}).get("unread", {}).items():
-        # print(f"Processing unread messages for user {user_id}:", messages)  # Debug print
-        message_objects = []
-        for msg in messages:
-            try:
-                if isinstance(msg, str):
-                    msg = json.loads(msg)
-                message_objects.append(Message(
-                    sender=remove_emoji(msg.get("name", msg.get("sender", ""))),
-                    text=remove_emoji(msg.get("text", msg.get("message", ""))),
-                    date=datetime.fromisoformat(msg.get("date", datetime.now().isoformat()))
-                ))
-            except Exception as e:
-                print(f"Error processing message for user {user_id}: {str(e)}")
-                continue
-        
-        if message_objects:
-            unread[user_id] = message_objects
+    with metrics.query_seconds.time(endpoint="user"):
+        records = query_records(account, query, [user_id])
     
-    # Sort messages by date
-    for user_id in most_recent:
-        most_recent[user_id] = sorted(most_recent[user_id], key=lambda x: x.date, reverse=True)
+    if not records and not message_store.chat_messages(account, user_id, 1):
+        # Chat not in the store yet, fetch it from Telegram once
+        await telegram.sync_chat(account, user_id)
+        records = query_records(account, query, [user_id])
+        etag = version_etag(message_store.latest_seq(account))
     
-    return MessagesResponse(messages={
-        "most_recent": most_recent,
-        "unread": unread
-    })
-
-@app.get("/users/{user_id}", response_model=List[Message])
-async def read_user(user_id: int):
-    """Return a specific user's messages"""
-    messages_data = await store_messages(user_id)
+    headers = {}
+    if len(records) == limit:
+        headers["X-Next-Cursor"] = next_page_cursor(query, records)
+    with metrics.serialize_seconds.time(endpoint="user"):
+        body = dumps(messages_to_json(records))
+    return versioned_response(request, etag, EncodedBody(body), headers)
+
+@app.get("/search", response_class=JSONBytesResponse)
+async def search_messages(
+    q: str = Query(..., min_length=1),
+    phone: Optional[str] = None,
+    top_k: int = Query(10, ge=1, le=100),
+    context: int = Query(2, ge=0, le=20),
+    chat: Optional[List[int]] = Query(None),
+    sender: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+):
+    """
+    Top-k messages for a query, ranked by full-text (bm25) and embedding
+    similarity fused by reciprocal rank, each with its scores and up to
+    context messages before and after it in its chat
+    """
+    account = phone or default_phone
+    with metrics.query_seconds.time(endpoint="search"):
+        results = await asyncio.to_thread(
+            hybrid_search.search, account, q, top_k, context,
+            chat, sender, to_timestamp(since), to_timestamp(until)
+        )
+    with metrics.serialize_seconds.time(endpoint="search"):
+        body = search_payload(q, results)
+    return JSONBytesResponse(body)
+
+@app.get("/messages/export")
+async def export_messages(phone: Optional[str] = None, since: Optional[datetime] = None, limit: Optional[int] = None):
+    """Stream messages from Telegram as NDJSON while they are being downloaded"""
+    async def ndjson():
+        async for message in telegram.iter_messages(phone=phone, since=to_timestamp(since), limit=limit):
+            yield json.dumps(message, ensure_ascii=False) + "\n"
     
-    # Get messages from the most_recent section
-    # messages = messages_data.get("messages", {}).get("most_recent", {}).get(user_id, [])
-    messages = messages_data
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+async def stream_changes(account, cursor=None):
+    """
+    Yield lists of stream events for an account, oldest first, polling the
+    store's change log after cursor (the latest change when None). A cursor
+    older than the retained log yields a reset event first: the consumer has
+    to reload /users. Empty lists are keep-alive ticks.
+    """
+    if cursor is None:
+        cursor = message_store.latest_seq(account)
+    elif message_store.cursor_expired(cursor):
+        cursor = message_store.latest_seq(account)
+        yield [{"seq": cursor, "type": "reset"}]
     
-    # Convert messages to Message objects
-    message_objects = []
-    for msg in messages:
-        try:
-            if isinstance(msg, str):
-                msg = json.loads(msg)
-            message_objects.append(Message(
-                sender=remove_emoji(msg.get("name", msg.get("sender", ""))),
-                text=remove_emoji(msg.get("text", msg.get("message", ""))),
-                date=datetime.fromisoformat(msg.get("date", datetime.now().isoformat()))
-            ))
-        except Exception as e:
-            print(f"Error processing message for user {user_id}: {str(e)}")
-            continue
+    last_sent = time.monotonic()
+    while True:
+        changes = message_store.changes_since(account, cursor, stream_batch_size)
+        if changes:
+            cursor = changes[-1]["seq"]
+            # Messages deleted since they were added are announced by their delete event
+            events = [change_to_json(change) for change in changes
+                      if change["text"] is not None or change["kind"] in ("delete", "read", "rename")]
+            if events:
+                last_sent = time.monotonic()
+                yield events
+            if len(changes) == stream_batch_size:
+                continue
+        elif time.monotonic() - last_sent >= stream_keepalive:
+            last_sent = time.monotonic()
+            # The API can run for weeks, keep the log at its retention meanwhile
+            message_store.prune_changes()
+            yield []
+        await asyncio.sleep(stream_poll_interval)
+
+def parse_seq(value):
+    try:
+        return int(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@app.get("/stream")
+async def stream(request: Request, phone: Optional[str] = None, cursor: Optional[int] = None):
+    """
+    Server-Sent Events of new, edited, deleted and read messages of an account
+    as they are stored. Resumes after cursor, or after the Last-Event-ID header
+    browsers and SSE clients send on reconnect.
+    """
+    account = phone or default_phone
+    last_event_id = request.headers.get("last-event-id")
+    if cursor is None and last_event_id:
+        cursor = parse_seq(last_event_id)
     
-    # Sort messages by date
-    message_objects.sort(key=lambda x: x.date, reverse=True)
+    async def events():
+        async for batch in stream_changes(account, cursor):
+            if not batch:
+                yield ": keep-alive\n\n"
+                continue
+            yield "".join(
+                f"id: {event['seq']}\nevent: {event['type']}\ndata: {dumps(event).decode('utf-8')}\n\n"
+                for event in batch
+            )
     
-    return message_objects
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.websocket("/ws")
+async def stream_ws(websocket: WebSocket, phone: Optional[str] = None, cursor: Optional[int] = None):
+    """The /stream events over a WebSocket, one JSON array per batch ([] as keep-alive)"""
+    await websocket.accept()
+    try:
+        async for batch in stream_changes(phone or default_phone, cursor):
+            await websocket.send_text(dumps(batch).decode('utf-8'))
+    except WebSocketDisconnect:
+        pass
+
+@app.get("/metrics")
+async def read_metrics():
+    """Prometheus text exposition of the service's metrics"""
+    return Response(metrics.registry.render(), media_type=metrics.content_type)
+
+@app.get("/clients/stats")
+async def client_stats():
+    """Open Telegram clients by login state, with creation, reconnect and eviction counts"""
+    return await telegram.client_stats()
 
 @app.post("/auth/{phone_number}")
 async def auth(phone_number: str):
@@ -155,7 +493,7 @@ async def auth(phone_number: str):
 async def start_login(request: Request):
     data = await request.json()
     phone = data["phone"]
-    result = await initiate_login(phone)
+    result = await telegram.initiate_login(phone)
     return result
 
 @app.post("/submit-code")
@@ -163,7 +501,7 @@ async def submit_code_route(request: Request):
     data = await request.json()
     phone = data["phone"]
     code = data["code"]
-    result = await submit_code(phone, code)
+    result = await telegram.submit_code(phone, code)
     return result
 
 @app.post("/submit-password")
@@ -171,5 +509,5 @@ async def submit_password_route(request: Request):
     data = await request.json()
     phone = data["phone"]
     password = data["password"]
-    result = await submit_password(phone, password)
+    result = await telegram.submit_password(phone, password)
     return result
\ No newline at end of file
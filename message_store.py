@@ -0,0 +1,826 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import timezone
+from records import MessageRecord
+from text_normalizer import normalize_text, NORMALIZER_VERSION
+
+# Location of the SQLite message store
+store_path = os.getenv('message_store_path', 'messages/messages.db')
+
+# Seconds the change log keeps entries for streaming consumers to resume from
+changes_retention = int(os.getenv('changes_retention', 7 * 24 * 3600))
+
+# Long-running writers and streams prune the change log at most this often
+changes_prune_interval = float(os.getenv('changes_prune_interval', 3600))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dialogs (
+    account TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    safe_name TEXT NOT NULL,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    read_inbox_max_id INTEGER NOT NULL DEFAULT 0,
+    top_message_id INTEGER NOT NULL DEFAULT 0,
+    last_message_id INTEGER NOT NULL DEFAULT 0,
+    last_message_date INTEGER,
+    synced_at INTEGER,
+    PRIMARY KEY (account, chat_id)
+);
+
+CREATE TABLE IF NOT EXISTS senders (
+    sender_id INTEGER PRIMARY KEY,
+    first_name TEXT,
+    last_name TEXT,
+    name TEXT NOT NULL DEFAULT '',
+    updated_at INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS messages (
+    account TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    sender_id INTEGER,
+    out INTEGER NOT NULL DEFAULT 0,
+    text TEXT NOT NULL,
+    text_norm TEXT NOT NULL DEFAULT '',
+    date INTEGER NOT NULL,
+    edit_date INTEGER,
+    PRIMARY KEY (account, chat_id, message_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_dialogs_last_message ON dialogs (account, last_message_date);
+CREATE INDEX IF NOT EXISTS idx_messages_account_date ON messages (account, date, chat_id, message_id);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_date ON messages (account, chat_id, date);
+CREATE INDEX IF NOT EXISTS idx_messages_sender_date ON messages (account, sender_id, date);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    text_norm,
+    content='messages',
+    content_rowid='rowid'
+);
+
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, text_norm) VALUES (new.rowid, new.text_norm);
+END;
+
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, text_norm) VALUES ('delete', old.rowid, old.text_norm);
+END;
+
+CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text_norm ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, text_norm) VALUES ('delete', old.rowid, old.text_norm);
+    INSERT INTO messages_fts (rowid, text_norm) VALUES (new.rowid, new.text_norm);
+END;
+
+-- Change log for streaming consumers, written by triggers so every writer process feeds it
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    account TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    created_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+);
+
+CREATE INDEX IF NOT EXISTS idx_changes_account_seq ON changes (account, seq);
+
+CREATE TRIGGER IF NOT EXISTS changes_message_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO changes (account, kind, chat_id, message_id) VALUES (new.account, 'new', new.chat_id, new.message_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS changes_message_update AFTER UPDATE OF text ON messages
+WHEN old.text IS NOT new.text BEGIN
+    INSERT INTO changes (account, kind, chat_id, message_id) VALUES (new.account, 'edit', new.chat_id, new.message_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS changes_message_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO changes (account, kind, chat_id, message_id) VALUES (old.account, 'delete', old.chat_id, old.message_id);
+END;
+
+-- Embeddings of the normalized text, dropped when it changes so the indexer recomputes them.
+-- Ids only grow, so vector indexes can load what was stored after the last id they saw
+CREATE TABLE IF NOT EXISTS message_embeddings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    account TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    model TEXT NOT NULL,
+    vector BLOB NOT NULL,
+    UNIQUE (account, chat_id, message_id)
+);
+
+CREATE TRIGGER IF NOT EXISTS message_embeddings_update AFTER UPDATE OF text_norm ON messages
+WHEN old.text_norm IS NOT new.text_norm BEGIN
+    DELETE FROM message_embeddings
+    WHERE account = old.account AND chat_id = old.chat_id AND message_id = old.message_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS message_embeddings_delete AFTER DELETE ON messages BEGIN
+    DELETE FROM message_embeddings
+    WHERE account = old.account AND chat_id = old.chat_id AND message_id = old.message_id;
+END;
+
+-- Embeddings dropped by the triggers above, so vector indexes can drop their
+-- vectors by reading what was logged after the last id they saw
+CREATE TABLE IF NOT EXISTS embedding_deletions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    account TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    embedding_id INTEGER NOT NULL,
+    created_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+);
+
+CREATE TRIGGER IF NOT EXISTS embedding_deletions_insert AFTER DELETE ON message_embeddings BEGIN
+    INSERT INTO embedding_deletions (account, chat_id, message_id, embedding_id)
+    VALUES (old.account, old.chat_id, old.message_id, old.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS changes_dialog_read AFTER UPDATE OF read_inbox_max_id ON dialogs
+WHEN new.read_inbox_max_id > old.read_inbox_max_id BEGIN
+    INSERT INTO changes (account, kind, chat_id, message_id)
+    VALUES (new.account, 'read', new.chat_id, new.read_inbox_max_id);
+END;
+
+-- Renamed chats and senders change what /users serves without touching a message
+CREATE TRIGGER IF NOT EXISTS changes_dialog_rename AFTER UPDATE OF name, safe_name ON dialogs
+WHEN old.name IS NOT new.name OR old.safe_name IS NOT new.safe_name BEGIN
+    INSERT INTO changes (account, kind, chat_id, message_id) VALUES (new.account, 'rename', new.chat_id, 0);
+END;
+
+-- Senders are shared by the accounts; chat_id is the sender, the private chat with them
+CREATE TRIGGER IF NOT EXISTS changes_sender_rename AFTER UPDATE OF name ON senders
+WHEN old.name IS NOT new.name BEGIN
+    INSERT INTO changes (account, kind, chat_id, message_id)
+    SELECT DISTINCT account, 'rename', new.sender_id, 0 FROM messages WHERE sender_id = new.sender_id;
+END;
+"""
+
+# Stores created before text_norm existed: the FTS index moves from text to text_norm
+TEXT_NORM_MIGRATION = """
+DROP TRIGGER IF EXISTS messages_fts_insert;
+DROP TRIGGER IF EXISTS messages_fts_delete;
+DROP TRIGGER IF EXISTS messages_fts_update;
+DROP TABLE IF EXISTS messages_fts;
+ALTER TABLE messages ADD COLUMN text_norm TEXT NOT NULL DEFAULT '';
+"""
+
+
+# Stores created before embedding ids: SQLite reused the rowids of deleted embeddings,
+# so a re-embedded message could land below the rowid a vector index had loaded up to
+EMBEDDING_ID_MIGRATION = """
+DROP TRIGGER IF EXISTS message_embeddings_update;
+DROP TRIGGER IF EXISTS message_embeddings_delete;
+CREATE TABLE message_embeddings_new (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    account TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    model TEXT NOT NULL,
+    vector BLOB NOT NULL,
+    UNIQUE (account, chat_id, message_id)
+);
+INSERT INTO message_embeddings_new (account, chat_id, message_id, model, vector)
+SELECT account, chat_id, message_id, model, vector FROM message_embeddings ORDER BY rowid;
+DROP TABLE message_embeddings;
+ALTER TABLE message_embeddings_new RENAME TO message_embeddings;
+"""
+
+
+def to_timestamp(date):
+    """Convert a datetime to integer epoch seconds"""
+    if date is None:
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp())
+
+
+def encode_cursor(record):
+    """Opaque pagination cursor for a message: its position in (date, chat, id) order"""
+    return f"{record.date}_{record.chat_id}_{record.id}"
+
+
+def decode_cursor(cursor):
+    """(date, chat_id, message_id) from a cursor; ValueError when it is malformed"""
+    date, chat_id, message_id = cursor.split("_")
+    return int(date), int(chat_id), int(message_id)
+
+
+def migrate(connection):
+    """
+    Bring an existing store up to SCHEMA. Returns True when the FTS index has
+    to be rebuilt once SCHEMA has recreated it.
+    """
+    embedding_columns = {row[1] for row in connection.execute("PRAGMA table_info(message_embeddings)")}
+    if embedding_columns and "id" not in embedding_columns:
+        with connection:
+            connection.executescript(EMBEDDING_ID_MIGRATION)
+
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(messages)")}
+    if not columns or "text_norm" in columns:
+        return False
+    print("Migrating message store: normalizing stored message text")
+    connection.executescript(TEXT_NORM_MIGRATION)
+    connection.create_function("normalize_text", 1, normalize_text, deterministic=True)
+    with connection:
+        connection.execute("UPDATE messages SET text_norm = normalize_text(text)")
+        connection.execute("UPDATE senders SET name = normalize_text(name)")
+        connection.execute(f"PRAGMA user_version = {NORMALIZER_VERSION}")
+    return True
+
+
+def renormalize(connection):
+    """
+    Re-normalize text stored by an older normalize_text (the store's
+    user_version). Only rows whose text changes are written; the triggers
+    update the FTS index and drop their embeddings for the indexer to redo.
+    """
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    if version >= NORMALIZER_VERSION:
+        return
+    connection.create_function("normalize_text", 1, normalize_text, deterministic=True)
+    with connection:
+        updated = connection.execute(
+            "UPDATE messages SET text_norm = normalize_text(text) WHERE text_norm IS NOT normalize_text(text)"
+        ).rowcount
+        connection.execute(
+            """
+            UPDATE senders SET name = normalize_text(TRIM(COALESCE(first_name, '') || ' ' || COALESCE(last_name, '')))
+            WHERE first_name IS NOT NULL OR last_name IS NOT NULL
+            """
+        )
+        connection.execute(f"PRAGMA user_version = {NORMALIZER_VERSION}")
+    if updated:
+        print(f"Re-normalized the text of {updated} stored messages")
+
+
+def fts_query(text):
+    """
+    FTS5 query matching any word of free text, each quoted so user input
+    cannot be parsed as query syntax; None when there are no words
+    """
+    words = re.findall(r"\w+", normalize_text(text))
+    if not words:
+        return None
+    return " OR ".join(f'"{word}"' for word in words)
+
+
+def filter_conditions(chat_ids=None, sender_id=None, since=None, until=None):
+    """SQL conditions on messages m and their parameters for the common message filters"""
+    conditions = []
+    params = []
+    if chat_ids:
+        conditions.append(f"m.chat_id IN ({', '.join('?' * len(chat_ids))})")
+        params.extend(chat_ids)
+    if sender_id is not None:
+        conditions.append("m.sender_id = ?")
+        params.append(sender_id)
+    if since is not None:
+        conditions.append("m.date >= ?")
+        params.append(since)
+    if until is not None:
+        conditions.append("m.date < ?")
+        params.append(until)
+    return conditions, params
+
+
+def record_from_row(row, chat=""):
+    """MessageRecord from a chat_messages/unread_messages row, text is the normalized text"""
+    return MessageRecord(
+        id=row["message_id"],
+        chat_id=row["chat_id"],
+        sender_id=row["sender_id"] or 0,
+        date=row["date"],
+        text=row["text"],
+        sender=row["sender"],
+        chat=chat,
+        out=bool(row["out"])
+    )
+
+
+class MessageStore:
+    """
+    SQLite store (WAL mode) for dialogs, senders and messages.
+    Writes are upserts so a sync can be re-run safely; reads use the
+    (chat, date) and (sender, date) indexes and the FTS5 index.
+    Message text is normalized once on write and kept next to the raw text;
+    reads serve the normalized text.
+    """
+
+    def __init__(self, path=store_path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.connection = None
+        self.pruned_at = 0.0
+
+    def connect(self):
+        if self.connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA busy_timeout=5000")
+            rebuild_fts = migrate(connection)
+            connection.executescript(SCHEMA)
+            renormalize(connection)
+            if rebuild_fts:
+                with connection:
+                    connection.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            self.connection = connection
+            self.prune_changes(force=True)
+        return self.connection
+
+    def prune_changes(self, force=False):
+        """
+        Drop change log and embedding deletion entries older than
+        changes_retention, the same ones cursor_expired and
+        embedding_deletions_expired report as gone. Unless forced, at most
+        once per changes_prune_interval; returns the number of changes dropped.
+        """
+        if not force and time.monotonic() - self.pruned_at < changes_prune_interval:
+            return 0
+        self.pruned_at = time.monotonic()
+        cutoff = int(time.time()) - changes_retention
+        with self.lock, self.connect() as connection:
+            connection.execute("DELETE FROM embedding_deletions WHERE created_at < ?", (cutoff,))
+            return connection.execute("DELETE FROM changes WHERE created_at < ?", (cutoff,)).rowcount
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    # Writes
+
+    def upsert_dialog(self, account, dialog):
+        """Insert or update one dialog row (a dict with the dialogs columns except account)"""
+        with self.lock, self.connect() as connection:
+            connection.execute(
+                """
+                INSERT INTO dialogs (account, chat_id, name, safe_name, unread_count, read_inbox_max_id,
+                                     top_message_id, last_message_id, last_message_date, synced_at)
+                VALUES (:account, :chat_id, :name, :safe_name, :unread_count, :read_inbox_max_id,
+                        :top_message_id, :last_message_id, :last_message_date, :synced_at)
+                ON CONFLICT (account, chat_id) DO UPDATE SET
+                    name = excluded.name,
+                    safe_name = excluded.safe_name,
+                    unread_count = excluded.unread_count,
+                    read_inbox_max_id = excluded.read_inbox_max_id,
+                    top_message_id = excluded.top_message_id,
+                    last_message_id = MAX(dialogs.last_message_id, excluded.last_message_id),
+                    last_message_date = COALESCE(excluded.last_message_date, dialogs.last_message_date),
+                    synced_at = excluded.synced_at
+                """,
+                dict(dialog, account=account, synced_at=dialog.get("synced_at") or int(time.time()))
+            )
+
+    def upsert_senders(self, senders):
+        """Insert or update sender rows (dicts with sender_id, first_name, last_name)"""
+        with self.lock, self.connect() as connection:
+            self._upsert_senders(connection, senders)
+
+    def upsert_messages(self, account, messages):
+        """
+        Insert or update message rows (dicts with chat_id, message_id, sender_id, out, text, date,
+        edit_date and optionally text_norm, which is computed here when missing)
+        """
+        with self.lock, self.connect() as connection:
+            self._upsert_messages(connection, account, messages)
+
+    def write_batch(self, account, senders=(), messages=(), activity=(), deleted=(), reads=()):
+        """
+        Apply a batch of live updates in a single transaction.
+        activity: dicts with chat_id, name, safe_name, message_id, date, incoming
+        deleted: (chat_id or None, message_id) pairs; private chat deletions carry no chat id
+        reads: (chat_id, max_id) pairs for messages read in our inbox
+        """
+        with self.lock, self.connect() as connection:
+            self._upsert_senders(connection, senders)
+            self._upsert_messages(connection, account, messages)
+            self._record_activity(connection, account, activity)
+            self._delete_messages(connection, account, deleted)
+            self._mark_read(connection, account, reads)
+
+    def mark_synced(self, account, chat_ids):
+        """Record that the dialogs were just checked for new messages"""
+        now = int(time.time())
+        with self.lock, self.connect() as connection:
+            connection.executemany(
+                "UPDATE dialogs SET synced_at = ? WHERE account = ? AND chat_id = ?",
+                [(now, account, chat_id) for chat_id in chat_ids]
+            )
+
+    def _upsert_senders(self, connection, senders):
+        now = int(time.time())
+        rows = [
+            dict(sender, name=normalize_text(
+                " ".join(part for part in (sender.get("first_name"), sender.get("last_name")) if part)
+            ), updated_at=now)
+            for sender in senders
+        ]
+        connection.executemany(
+            """
+            INSERT INTO senders (sender_id, first_name, last_name, name, updated_at)
+            VALUES (:sender_id, :first_name, :last_name, :name, :updated_at)
+            ON CONFLICT (sender_id) DO UPDATE SET
+                first_name = excluded.first_name,
+                last_name = excluded.last_name,
+                name = excluded.name,
+                updated_at = excluded.updated_at
+            """,
+            rows
+        )
+
+    def _upsert_messages(self, connection, account, messages):
+        rows = [
+            dict(message, account=account, text_norm=message.get("text_norm") or normalize_text(message["text"]))
+            for message in messages
+        ]
+        connection.executemany(
+            """
+            INSERT INTO messages (account, chat_id, message_id, sender_id, out, text, text_norm, date, edit_date)
+            VALUES (:account, :chat_id, :message_id, :sender_id, :out, :text, :text_norm, :date, :edit_date)
+            ON CONFLICT (account, chat_id, message_id) DO UPDATE SET
+                sender_id = excluded.sender_id,
+                out = excluded.out,
+                text = excluded.text,
+                text_norm = excluded.text_norm,
+                date = excluded.date,
+                edit_date = excluded.edit_date
+            """,
+            rows
+        )
+
+    def _record_activity(self, connection, account, activity):
+        # New messages move the dialog's top message and high-water mark forward
+        rows = [dict(row, account=account, synced_at=int(time.time())) for row in activity]
+        connection.executemany(
+            """
+            INSERT INTO dialogs (account, chat_id, name, safe_name, unread_count, top_message_id,
+                                 last_message_id, last_message_date, synced_at)
+            VALUES (:account, :chat_id, :name, :safe_name, :incoming, :message_id,
+                    :message_id, :date, :synced_at)
+            ON CONFLICT (account, chat_id) DO UPDATE SET
+                unread_count = dialogs.unread_count + excluded.unread_count,
+                top_message_id = MAX(dialogs.top_message_id, excluded.top_message_id),
+                last_message_id = MAX(dialogs.last_message_id, excluded.last_message_id),
+                last_message_date = MAX(COALESCE(dialogs.last_message_date, 0), excluded.last_message_date),
+                synced_at = excluded.synced_at
+            """,
+            rows
+        )
+
+    def _delete_messages(self, connection, account, deleted):
+        for chat_id, message_id in deleted:
+            if chat_id is None:
+                connection.execute(
+                    "DELETE FROM messages WHERE account = ? AND message_id = ? AND chat_id > 0",
+                    (account, message_id)
+                )
+            else:
+                connection.execute(
+                    "DELETE FROM messages WHERE account = ? AND chat_id = ? AND message_id = ?",
+                    (account, chat_id, message_id)
+                )
+
+    def _mark_read(self, connection, account, reads):
+        for chat_id, max_id in reads:
+            connection.execute(
+                """
+                UPDATE dialogs SET
+                    read_inbox_max_id = MAX(read_inbox_max_id, :max_id),
+                    unread_count = (
+                        SELECT COUNT(*) FROM messages
+                        WHERE account = :account AND chat_id = :chat_id AND out = 0
+                          AND message_id > MAX(dialogs.read_inbox_max_id, :max_id)
+                    )
+                WHERE account = :account AND chat_id = :chat_id
+                """,
+                {"account": account, "chat_id": chat_id, "max_id": max_id}
+            )
+
+    # Reads
+
+    def get_dialog_states(self, account):
+        """Return the stored dialog rows of an account keyed by chat id"""
+        with self.lock:
+            rows = self.connect().execute(
+                "SELECT * FROM dialogs WHERE account = ?", (account,)
+            ).fetchall()
+        return {row["chat_id"]: dict(row) for row in rows}
+
+    def load_senders(self, min_updated_at):
+        """Sender rows refreshed at or after min_updated_at"""
+        with self.lock:
+            rows = self.connect().execute(
+                "SELECT sender_id, name, updated_at FROM senders WHERE updated_at >= ?", (min_updated_at,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def has_messages(self, account):
+        with self.lock:
+            row = self.connect().execute(
+                "SELECT 1 FROM messages WHERE account = ? LIMIT 1", (account,)
+            ).fetchone()
+        return row is not None
+
+    def chat_messages(self, account, chat_id, limit):
+        """Latest messages of one chat, oldest first, with the sender name resolved"""
+        with self.lock:
+            rows = self.connect().execute(
+                """
+                SELECT m.chat_id, m.message_id, m.sender_id, m.text_norm AS text, m.date, m.out, COALESCE(s.name, '') AS sender
+                FROM messages m
+                LEFT JOIN senders s ON s.sender_id = m.sender_id
+                WHERE m.account = ? AND m.chat_id = ?
+                ORDER BY m.date DESC, m.message_id DESC
+                LIMIT ?
+                """,
+                (account, chat_id, limit)
+            ).fetchall()
+        return rows[::-1]
+
+    def unread_messages(self, account, chat_id, read_inbox_max_id, limit):
+        """Latest incoming messages newer than the dialog's read marker, oldest first"""
+        with self.lock:
+            rows = self.connect().execute(
+                """
+                SELECT m.chat_id, m.message_id, m.sender_id, m.text_norm AS text, m.date, m.out, COALESCE(s.name, '') AS sender
+                FROM messages m
+                LEFT JOIN senders s ON s.sender_id = m.sender_id
+                WHERE m.account = ? AND m.chat_id = ? AND m.message_id > ? AND m.out = 0
+                ORDER BY m.message_id DESC
+                LIMIT ?
+                """,
+                (account, chat_id, read_inbox_max_id, limit)
+            ).fetchall()
+        return rows[::-1]
+
+    def latest_dialogs(self, account, chats_limit, chat_ids=None):
+        """Dialogs of an account with the most recent activity first"""
+        conditions = ["account = ?"]
+        params = [account]
+        if chat_ids:
+            conditions.append(f"chat_id IN ({', '.join('?' * len(chat_ids))})")
+            params.extend(chat_ids)
+        params.append(chats_limit)
+        with self.lock:
+            rows = self.connect().execute(
+                f"""
+                SELECT chat_id, safe_name, unread_count, read_inbox_max_id
+                FROM dialogs
+                WHERE {' AND '.join(conditions)}
+                ORDER BY last_message_date DESC
+                LIMIT ?
+                """,
+                params
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def query_messages(self, account, limit, chat_ids=None, sender_id=None, since=None, until=None,
+                       before=None, after=None):
+        """
+        One page of messages, newest first, in (date, chat, id) order.
+        since/until are epoch seconds; before/after are decoded cursors and
+        select messages strictly older/newer than that position. Each filter
+        maps onto the (account, date), (chat, date) or (sender, date) index,
+        so the cost depends on the page size rather than the history.
+        """
+        conditions, params = filter_conditions(chat_ids, sender_id, since, until)
+        conditions.insert(0, "m.account = ?")
+        params.insert(0, account)
+        if before is not None:
+            conditions.append("(m.date, m.chat_id, m.message_id) < (?, ?, ?)")
+            params.extend(before)
+        if after is not None:
+            conditions.append("(m.date, m.chat_id, m.message_id) > (?, ?, ?)")
+            params.extend(after)
+
+        # Paging forward from an "after" cursor walks the index upwards from the cursor
+        order = "ASC" if after is not None and before is None else "DESC"
+        params.append(limit)
+        with self.lock:
+            rows = self.connect().execute(
+                f"""
+                SELECT m.chat_id, m.message_id, m.sender_id, m.text_norm AS text, m.date, m.out,
+                       COALESCE(s.name, '') AS sender, COALESCE(d.safe_name, CAST(m.chat_id AS TEXT)) AS chat
+                FROM messages m
+                LEFT JOIN senders s ON s.sender_id = m.sender_id
+                LEFT JOIN dialogs d ON d.account = m.account AND d.chat_id = m.chat_id
+                WHERE {' AND '.join(conditions)}
+                ORDER BY m.date {order}, m.chat_id {order}, m.message_id {order}
+                LIMIT ?
+                """,
+                params
+            ).fetchall()
+        if order == "ASC":
+            rows = rows[::-1]
+        return [record_from_row(row, row["chat"]) for row in rows]
+
+    def latest_seq(self, account):
+        """Sequence number of the account's latest change, 0 when there is none"""
+        with self.lock:
+            row = self.connect().execute(
+                "SELECT MAX(seq) AS seq FROM changes WHERE account = ?", (account,)
+            ).fetchone()
+        return row["seq"] or 0
+
+    def cursor_expired(self, seq):
+        """Whether changes after seq may already have been pruned from the log"""
+        with self.lock:
+            row = self.connect().execute(
+                """
+                SELECT MIN(seq) AS oldest, (SELECT seq FROM sqlite_sequence WHERE name = 'changes') AS latest
+                FROM changes
+                """
+            ).fetchone()
+        oldest = row["oldest"] if row["oldest"] is not None else (row["latest"] or 0) + 1
+        return seq + 1 < oldest
+
+    def changes_since(self, account, seq, limit=500):
+        """
+        Changes of an account after seq, oldest first, with the message as it
+        is now. Messages deleted since a new/edit change have no text.
+        """
+        with self.lock:
+            rows = self.connect().execute(
+                """
+                SELECT c.seq, c.kind, c.chat_id, c.message_id, m.sender_id, m.text_norm AS text, m.date, m.out,
+                       COALESCE(s.name, '') AS sender, COALESCE(d.safe_name, CAST(c.chat_id AS TEXT)) AS chat
+                FROM changes c
+                LEFT JOIN messages m ON m.account = c.account AND m.chat_id = c.chat_id AND m.message_id = c.message_id
+                LEFT JOIN senders s ON s.sender_id = m.sender_id
+                LEFT JOIN dialogs d ON d.account = c.account AND d.chat_id = c.chat_id
+                WHERE c.account = ? AND c.seq > ?
+                ORDER BY c.seq
+                LIMIT ?
+                """,
+                (account, seq, limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def accounts(self):
+        """Every account with stored dialogs"""
+        with self.lock:
+            rows = self.connect().execute("SELECT DISTINCT account FROM dialogs").fetchall()
+        return [row["account"] for row in rows]
+
+    def search(self, account, query, limit=20, chat_ids=None, sender_id=None, since=None, until=None):
+        """
+        Full-text search over the normalized message text, best matches first.
+        Rows carry the bm25 rank (lower is better) and the message as a record.
+        """
+        match = fts_query(query)
+        if match is None:
+            return []
+        conditions, params = filter_conditions(chat_ids, sender_id, since, until)
+        conditions[:0] = ["messages_fts MATCH ?", "m.account = ?"]
+        params[:0] = [match, account]
+        params.append(limit)
+        with self.lock:
+            rows = self.connect().execute(
+                f"""
+                SELECT m.chat_id, m.message_id, m.sender_id, m.text_norm AS text, m.date, m.out,
+                       COALESCE(s.name, '') AS sender, COALESCE(d.safe_name, CAST(m.chat_id AS TEXT)) AS chat,
+                       bm25(messages_fts) AS rank
+                FROM messages_fts
+                JOIN messages m ON m.rowid = messages_fts.rowid
+                LEFT JOIN senders s ON s.sender_id = m.sender_id
+                LEFT JOIN dialogs d ON d.account = m.account AND d.chat_id = m.chat_id
+                WHERE {' AND '.join(conditions)}
+                ORDER BY rank
+                LIMIT ?
+                """,
+                params
+            ).fetchall()
+        return [{"rank": row["rank"], "record": record_from_row(row, row["chat"])} for row in rows]
+
+    def get_messages(self, account, keys):
+        """Records for (chat_id, message_id) keys that still exist, keyed the same way"""
+        if not keys:
+            return {}
+        values = ", ".join("(?, ?)" for _ in keys)
+        params = [account] + [value for key in keys for value in key]
+        with self.lock:
+            rows = self.connect().execute(
+                f"""
+                SELECT m.chat_id, m.message_id, m.sender_id, m.text_norm AS text, m.date, m.out,
+                       COALESCE(s.name, '') AS sender, COALESCE(d.safe_name, CAST(m.chat_id AS TEXT)) AS chat
+                FROM messages m
+                LEFT JOIN senders s ON s.sender_id = m.sender_id
+                LEFT JOIN dialogs d ON d.account = m.account AND d.chat_id = m.chat_id
+                WHERE m.account = ? AND (m.chat_id, m.message_id) IN (VALUES {values})
+                """,
+                params
+            ).fetchall()
+        return {(row["chat_id"], row["message_id"]): record_from_row(row, row["chat"]) for row in rows}
+
+    def message_context(self, account, record, before=2, after=2):
+        """Up to before/after messages around a record in its chat, oldest first"""
+        query = """
+            SELECT m.chat_id, m.message_id, m.sender_id, m.text_norm AS text, m.date, m.out,
+                   COALESCE(s.name, '') AS sender
+            FROM messages m
+            LEFT JOIN senders s ON s.sender_id = m.sender_id
+            WHERE m.account = ? AND m.chat_id = ? AND (m.date, m.message_id) {} (?, ?)
+            ORDER BY m.date {order}, m.message_id {order}
+            LIMIT ?
+        """
+        params = (account, record.chat_id, record.date, record.id)
+        with self.lock:
+            connection = self.connect()
+            older = connection.execute(query.format("<", order="DESC"), params + (before,)).fetchall()
+            newer = connection.execute(query.format(">", order="ASC"), params + (after,)).fetchall()
+        return [record_from_row(row, record.chat) for row in older[::-1] + newer]
+
+    def pending_embeddings(self, account, model, limit):
+        """Newest messages of an account without an embedding from model"""
+        with self.lock:
+            rows = self.connect().execute(
+                """
+                SELECT m.chat_id, m.message_id, m.text_norm
+                FROM messages m
+                LEFT JOIN message_embeddings e
+                    ON e.account = m.account AND e.chat_id = m.chat_id AND e.message_id = m.message_id
+                   AND e.model = ?
+                WHERE m.account = ? AND m.text_norm != '' AND e.message_id IS NULL
+                ORDER BY m.date DESC
+                LIMIT ?
+                """,
+                (model, account, limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def save_embeddings(self, account, model, embeddings):
+        """Store (chat_id, message_id, vector bytes) embeddings"""
+        with self.lock, self.connect() as connection:
+            connection.executemany(
+                """
+                INSERT OR REPLACE INTO message_embeddings (account, chat_id, message_id, model, vector)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                [(account, chat_id, message_id, model, vector) for chat_id, message_id, vector in embeddings]
+            )
+
+    def load_embeddings(self, account, model, after_id=0):
+        """Embeddings stored after the one with id after_id, with the columns vector search filters on"""
+        with self.lock:
+            rows = self.connect().execute(
+                """
+                SELECT e.id, e.chat_id, e.message_id, m.sender_id, m.date, e.vector
+                FROM message_embeddings e
+                JOIN messages m ON m.account = e.account AND m.chat_id = e.chat_id AND m.message_id = e.message_id
+                WHERE e.account = ? AND e.model = ? AND e.id > ?
+                ORDER BY e.id
+                """,
+                (account, model, after_id)
+            ).fetchall()
+        return rows
+
+    def latest_embedding_deletion(self):
+        """Id of the newest embedding deletion ever logged, pruned or not"""
+        with self.lock:
+            row = self.connect().execute(
+                "SELECT seq FROM sqlite_sequence WHERE name = 'embedding_deletions'"
+            ).fetchone()
+        return row["seq"] if row else 0
+
+    def embedding_deletions(self, account, after_id=0):
+        """Embeddings of an account deleted after the deletion with id after_id, oldest first"""
+        with self.lock:
+            rows = self.connect().execute(
+                """
+                SELECT id, chat_id, message_id, embedding_id
+                FROM embedding_deletions
+                WHERE account = ? AND id > ?
+                ORDER BY id
+                """,
+                (account, after_id)
+            ).fetchall()
+        return rows
+
+    def embedding_deletions_expired(self, after_id):
+        """Whether deletions after after_id may already have been pruned"""
+        with self.lock:
+            row = self.connect().execute(
+                """
+                SELECT MIN(id) AS oldest,
+                       (SELECT seq FROM sqlite_sequence WHERE name = 'embedding_deletions') AS latest
+                FROM embedding_deletions
+                """
+            ).fetchone()
+        oldest = row["oldest"] if row["oldest"] is not None else (row["latest"] or 0) + 1
+        return after_id + 1 < oldest
+
+
+# Shared store used by the scraper and the API
+message_store = MessageStore()
@@ -0,0 +1,284 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from a cache hit to a full sync
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Token count buckets for LLM prompts and responses
+token_buckets = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """A metric family: one value per combination of label values"""
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, self.labels, key, value) for key, value in self.values.items()]
+
+    def get(self, **labels):
+        """Current value for the label values (tests and reports)"""
+        return self.values.get(self.key(labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, label_names, label_values, value, *extra in self.samples():
+            lines.append(f"{name}{format_labels(label_names, label_values, *extra)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = {"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            series["buckets"][bisect.bisect_left(self.buckets, value)] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in the with block, also when it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get(self, **labels):
+        """(count, sum) of observations for the label values"""
+        series = self.values.get(self.key(labels))
+        if series is None:
+            return 0, 0.0
+        return series["count"], series["sum"]
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, series in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), series["buckets"]):
+                    cumulative += count
+                    samples.append((f"{self.name}_bucket", self.labels, key, cumulative,
+                                    (("le", format_value(bound)),)))
+                samples.append((f"{self.name}_sum", self.labels, key, series["sum"]))
+                samples.append((f"{self.name}_count", self.labels, key, series["count"]))
+        return samples
+
+
+class CallbackMetric(Metric):
+    """
+    A counter or gauge read at scrape time from counters objects already keep,
+    e.g. cache hits; the callback returns {label values tuple: value}
+    """
+
+    def __init__(self, name, help, labels=(), kind="gauge", callback=None):
+        super().__init__(name, help, labels)
+        self.kind = kind
+        self.callback = callback
+
+    def samples(self):
+        try:
+            values = self.callback()
+        except Exception as e:
+            print(f"Error collecting metric {self.name}: {str(e)}")
+            return []
+        return [(self.name, self.labels, tuple(str(value) for value in key), value)
+                for key, value in values.items()]
+
+
+class Registry:
+    """Named metrics of a process, rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                # Modules may be imported by more than one entry point
+                if type(existing) is not type(metric) or existing.labels != metric.labels:
+                    raise ValueError(f"Metric {metric.name} is already registered differently")
+                if isinstance(metric, CallbackMetric):
+                    existing.callback = metric.callback
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def get(self, name):
+        return self.metrics.get(name)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+    def reset(self):
+        """Clear every recorded value (test harnesses)"""
+        for metric in self.metrics.values():
+            with metric.lock:
+                metric.values.clear()
+
+
+# Shared registry of the process
+registry = Registry()
+
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def counter(name, help, labels=()):
+    return registry.register(Counter(name, help, labels))
+
+
+def gauge(name, help, labels=()):
+    return registry.register(Gauge(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=default_buckets):
+    return registry.register(Histogram(name, help, labels, buckets))
+
+
+def callback(name, help, callback, labels=(), kind="gauge"):
+    return registry.register(CallbackMetric(name, help, labels, kind, callback))
+
+
+def start_http_server(port, host="0.0.0.0"):
+    """Serve /metrics from a background thread, for processes without the API (the bot)"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on port {port}")
+    return server
+
+
+# Metrics shared by the scraper, the API and the bot
+
+store_messages_seconds = histogram(
+    "trok_store_messages_seconds", "Duration of store_messages runs", ("mode",))
+sync_dialog_seconds = histogram(
+    "trok_sync_dialog_seconds", "Duration of syncing one dialog within store_messages")
+dialogs_skipped = counter(
+    "trok_dialogs_skipped_total", "Dialogs skipped by store_messages because nothing changed")
+
+telegram_api_calls = counter(
+    "trok_telegram_api_calls_total", "Telegram API requests sent by the pooled clients, by TL request type",
+    ("method",))
+# api is "mtproto" for Telethon's FloodWaits, "bot" for the Bot API's 429s
+telegram_flood_waits = counter(
+    "trok_telegram_flood_waits_total", "FloodWaits (MTProto) and 429s (Bot API) returned by Telegram", ("api",))
+telegram_flood_wait_seconds = counter(
+    "trok_telegram_flood_wait_seconds_total", "Seconds every request was held back by FloodWaits and 429s", ("api",))
+
+serialize_seconds = histogram(
+    "trok_serialize_seconds", "Time to serialize a response body", ("endpoint",))
+query_seconds = histogram(
+    "trok_query_seconds", "Time to read a response's messages from the store", ("endpoint",))
+
+prompt_build_seconds = histogram(
+    "trok_prompt_build_seconds", "Time to format messages into an LLM prompt", ("view",))
+llm_request_seconds = histogram(
+    "trok_llm_request_seconds", "LLM request latency", ("model", "outcome"))
+llm_tokens = histogram(
+    "trok_llm_tokens", "Tokens per LLM request", ("model", "kind"), buckets=token_buckets)
+llm_tokens_total = counter(
+    "trok_llm_tokens_total", "Tokens sent to and received from the LLM", ("model", "kind"))
+
+chat_actions_sent = counter(
+    "trok_bot_chat_actions_total", "Chat actions (typing) the bot sent, by outcome", ("outcome",))
+chat_actions_active = gauge(
+    "trok_bot_chat_actions_active", "Chats currently shown a chat action while a request runs")
+
+webhook_updates = counter(
+    "trok_bot_webhook_updates_total", "Updates posted to the bot's webhook, by outcome", ("outcome",))
+webhook_queue_depth = gauge(
+    "trok_bot_webhook_queue_depth", "Webhook updates waiting to be dispatched to the handlers")
+
+job_queue_depth = gauge(
+    "trok_job_queue_depth", "Jobs waiting for a slot", ("queue",))
+jobs_running = gauge(
+    "trok_jobs_running", "Jobs running", ("queue",))
+job_wait_seconds = histogram(
+    "trok_job_wait_seconds", "Time jobs waited in the queue before they started", ("queue",))
+jobs_finished = counter(
+    "trok_jobs_total", "Jobs by outcome: completed, failed, superseded, cancelled or rejected", ("queue", "outcome"))
@@ -0,0 +1,309 @@
+import os
+import re
+from datetime import datetime
+from operator import itemgetter
+from zoneinfo import ZoneInfo
+from text_normalizer import normalize_text
+
+# Tokens of chat messages put into a prompt; capped by the model's context
+# window less prompt_reserved_tokens kept free for the instructions and answer
+prompt_token_budget = int(os.getenv('prompt_token_budget', 30000))
+prompt_reserved_tokens = int(os.getenv('prompt_reserved_tokens', 8192))
+
+# Timezone the message dates are shown in
+prompt_timezone = ZoneInfo(os.getenv('prompt_timezone', 'Asia/Tehran'))
+
+# A message this many hours older than the newest one counts half as recent
+prompt_recency_half_life = float(os.getenv('prompt_recency_half_life', 24))
+
+# How much matching the question outweighs recency
+prompt_relevance_weight = float(os.getenv('prompt_relevance_weight', 2))
+
+# Characters per token of each model family's tokenizer, for ASCII text and
+# for everything else; Persian text costs about twice as many tokens per character
+chars_per_token = {
+    "gemini": (4.0, 2.2),
+    "llama": (3.8, 1.6),
+    "gpt": (4.0, 1.8),
+}
+default_chars_per_token = (3.5, 1.5)
+
+# Context window of each model, in tokens
+model_context_tokens = {
+    "gemini-2.0-flash": 1_048_576,
+    "gemini-1.5-flash": 1_048_576,
+    "gemini-1.5-pro": 2_097_152,
+    "llama": 8192,
+}
+
+# Longest message the Bot API accepts, in UTF-16 code units
+telegram_message_limit = 4096
+
+SEPARATOR = "-------------------\n"
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# /users section, its title and its chat header, per view
+SECTIONS = {
+    "recent": ("most_recent", "📥 Recent Messages:\n", "\nChat with {}\n"),
+    "unread": ("unread", "\n📨 Unread Messages:\n", "\nScene: Unread Chat with {}\n"),
+}
+VIEW_SECTIONS = {"all": ("recent", "unread"), "recent": ("recent",), "unread": ("unread",)}
+
+# Question words that say nothing about which messages matter
+STOPWORDS = frozenset((
+    "the", "and", "what", "who", "when", "where", "which", "how", "did", "does", "was", "were",
+    "about", "with", "from", "that", "this", "have", "has", "for", "are", "you", "any", "all",
+    "است", "این", "آن", "برای", "چه", "چی", "کی", "کجا", "چطور", "آیا", "درباره", "گفت", "بود",
+))
+WORD_PATTERN = re.compile(r"\w+")
+
+
+class TokenEstimator:
+    """Token count of a text from the model's characters per token, without its tokenizer"""
+
+    def __init__(self, ascii_chars_per_token, other_chars_per_token):
+        self.ascii_chars_per_token = ascii_chars_per_token
+        self.other_chars_per_token = other_chars_per_token
+
+    def count(self, text):
+        ascii_chars = len(text.encode("ascii", "ignore"))
+        return int(ascii_chars / self.ascii_chars_per_token
+                   + (len(text) - ascii_chars) / self.other_chars_per_token) + 1
+
+
+def model_family(model_name, table):
+    """The entry of table whose key the model name starts with or contains"""
+    name = model_name.lower()
+    if name in table:
+        return table[name]
+    for key, value in table.items():
+        if key in name:
+            return value
+    return None
+
+
+def estimator_for(model_name):
+    return TokenEstimator(*(model_family(model_name, chars_per_token) or default_chars_per_token))
+
+
+def budget_for(model_name, budget=prompt_token_budget, reserved=prompt_reserved_tokens):
+    """Message tokens a prompt for the model may hold"""
+    context = model_family(model_name, model_context_tokens)
+    if context is None:
+        return budget
+    return max(0, min(budget, context - reserved))
+
+
+def query_terms(question):
+    """Normalized words of a question worth matching messages against"""
+    words = WORD_PATTERN.findall(normalize_text(question or "").lower())
+    return [word for word in dict.fromkeys(words) if len(word) > 1 and word not in STOPWORDS]
+
+
+def relevance(text, terms):
+    """Share of the terms found in the text; substrings, so Persian suffixes still match"""
+    if not terms or not text:
+        return 0.0
+    text = text.lower()
+    return sum([term in text for term in terms]) / len(terms)
+
+
+def split_message(text, limit=telegram_message_limit):
+    """Text cut into messages Telegram accepts: at line breaks, mid-line only for a line too long on its own"""
+    def length(part):
+        return len(part.encode("utf-16-le")) // 2
+
+    if length(text) <= limit:
+        return [text]
+    parts = []
+    current = []
+    size = 0
+    for line in text.splitlines(keepends=True):
+        line_size = length(line)
+        if size + line_size > limit and current:
+            parts.append("".join(current))
+            current = []
+            size = 0
+        while line_size > limit:
+            # Longest prefix within the limit; emoji and other astral characters take two units
+            low, high = 1, limit
+            while low < high:
+                middle = (low + high + 1) // 2
+                if length(line[:middle]) <= limit:
+                    low = middle
+                else:
+                    high = middle - 1
+            cut = low
+            parts.append(line[:cut])
+            line = line[cut:]
+            line_size = length(line)
+        if line:
+            current.append(line)
+            size += line_size
+    if current:
+        parts.append("".join(current))
+    # Telegram refuses blank messages
+    return [part for part in parts if part.strip()]
+
+
+class PromptBuilder:
+    """
+    Packs /users messages, a MessageBatch per chat, into a prompt of at most
+    a token budget. Every message across the chats is scored by how much of
+    the question it mentions and how recent it is, both against the newest
+    message seen and within its own chat, ranked on the batches' epoch
+    timestamps; the best ones are taken until the budget is spent, then shown
+    chat by chat in the order /users serves them. Only the chosen messages
+    get their dates formatted, and the text is joined once.
+    """
+
+    def __init__(self, model_name, budget=None, timezone=prompt_timezone,
+                 half_life=prompt_recency_half_life, relevance_weight=prompt_relevance_weight):
+        self.model_name = model_name
+        self.estimator = estimator_for(model_name)
+        self.budget = budget_for(model_name) if budget is None else budget
+        self.timezone = timezone
+        self.half_life = half_life * 3600
+        self.relevance_weight = relevance_weight
+        # "[date]\n" and the separator after every message
+        self.message_overhead = self.count(f"[{datetime.now(timezone).strftime(DATE_FORMAT)}]\n\n" + SEPARATOR)
+
+    def count(self, text):
+        return self.estimator.count(text)
+
+    def select(self, data, view_type='all', question=None, per_chat_limit=None, reserved=0):
+        """
+        [(section, chat, messages)] fitting the budget less reserved tokens,
+        messages in their /users order; per_chat_limit caps each chat
+        """
+        sections = data.get("messages") or {}
+        terms = query_terms(question)
+        remaining = self.budget - reserved
+
+        chats = []
+        for section in VIEW_SECTIONS.get(view_type, ()):
+            key, title, header = SECTIONS[section]
+            if key not in sections:
+                continue
+            remaining -= self.count(title)
+            for chat, messages in sections[key].items():
+                chats.append((section, chat, messages, messages.dates))
+        newest = max((max(stamps, default=0) for _, _, _, stamps in chats), default=0)
+
+        candidates = []
+        for section, chat, messages, stamps in chats:
+            # The question may name the chat rather than anything said in it
+            chat_relevance = relevance(str(chat), terms) / 2
+            by_age = sorted(range(len(messages)), key=stamps.__getitem__, reverse=True)
+            for rank, index in enumerate(by_age):
+                recency = (0.5 ** ((newest - stamps[index]) / self.half_life) + 1 / (1 + rank)) / 2
+                match = relevance(messages.texts[index], terms) + chat_relevance
+                candidates.append((self.relevance_weight * match + recency, section, chat, index, messages))
+        candidates.sort(key=itemgetter(0), reverse=True)
+
+        chosen = {}
+        for _, section, chat, index, messages in candidates:
+            if remaining <= self.message_overhead:
+                break
+            picked = chosen.get((section, chat))
+            if per_chat_limit is not None and picked is not None and len(picked) >= per_chat_limit:
+                continue
+            sender = messages.senders.get(messages.sender_ids[index], "")
+            cost = self.message_overhead + self.count(f"{sender}: {messages.texts[index]}")
+            if picked is None:
+                cost += self.count(SECTIONS[section][2].format(chat) + SEPARATOR)
+            if cost > remaining:
+                continue
+            remaining -= cost
+            chosen.setdefault((section, chat), []).append(index)
+
+        selected = []
+        for section in VIEW_SECTIONS.get(view_type, ()):
+            key = SECTIONS[section][0]
+            for chat, messages in sections.get(key, {}).items():
+                indexes = chosen.get((section, chat))
+                if indexes:
+                    selected.append((section, chat, [messages.record(index) for index in sorted(indexes)]))
+        return selected
+
+    def render(self, data, view_type, selected):
+        sections = data.get("messages") or {}
+        parts = []
+        for section in VIEW_SECTIONS.get(view_type, ()):
+            key, title, header = SECTIONS[section]
+            if key not in sections:
+                continue
+            parts.append(title)
+            for chat_section, chat, messages in selected:
+                if chat_section != section:
+                    continue
+                parts.append(header.format(chat))
+                parts.append(SEPARATOR)
+                for message in messages:
+                    date = datetime.fromtimestamp(message.date, self.timezone)
+                    parts.append(f"[{date.strftime(DATE_FORMAT)}]\n{message.sender}: {message.text}\n{SEPARATOR}")
+        return "".join(parts)
+
+    def build(self, data, view_type='all', question=None, per_chat_limit=None, reserved=0):
+        """The messages of the view as prompt text, within the budget"""
+        if not data or 'messages' not in data:
+            return "No messages found."
+        selected = self.select(data, view_type, question, per_chat_limit, reserved)
+        return self.render(data, view_type, selected)
+
+
+if __name__ == "__main__":
+    # Pack 30 chats x 1000 messages into prompts of several budgets, against the old += loop over 5 per chat
+    import random
+    import time
+    from datetime import timedelta, timezone
+    from records import users_batches
+
+    random.seed(1)
+    words = ("سلام", "جلسه", "فردا", "قیمت", "تومان", "کتاب", "meeting", "invoice", "project", "deadline",
+             "ok", "thanks", "ساعت", "لطفا", "ارسال", "report")
+    data = {"messages": {
+        "most_recent": {
+            f"Chat{chat}": [
+                {"id": i, "sender_id": chat, "sender": f"Sender {chat}", "ts": 1_700_000_000 - i * 600 - chat * 37,
+                 "text": " ".join(random.choices(words, k=random.randint(3, 30)))}
+                for i in range(1000)
+            ]
+            for chat in range(30)
+        },
+        "unread": {}
+    }}
+    data["messages"]["unread"] = {chat: messages[:20][::-1] for chat, messages in
+                                  list(data["messages"]["most_recent"].items())[:5]}
+
+    def concatenated(data):
+        formatted_text = "📥 Recent Messages:\n"
+        for user_id, messages in data['messages']['most_recent'].items():
+            formatted_text += f"\nChat with {user_id}\n"
+            formatted_text += "-------------------\n"
+            for message in messages[:5]:
+                date = datetime.fromtimestamp(message["ts"], timezone.utc) + timedelta(hours=3, minutes=30)
+                formatted_text += f"[{date.strftime(DATE_FORMAT)}]\n"
+                formatted_text += f"{message['sender']}: {message['text']}\n"
+                formatted_text += "-------------------\n"
+        return formatted_text
+
+    def timed(function, runs=5):
+        function()
+        start = time.perf_counter()
+        for _ in range(runs):
+            result = function()
+        return result, (time.perf_counter() - start) / runs * 1000
+
+    text, elapsed = timed(lambda: concatenated(data))
+    print(f"{'+= loop, 5 per chat':>28}: {elapsed:7.1f} ms, {len(text) / 1024:6.0f} KiB")
+    question = "when is the project deadline meeting?"
+    batches = users_batches(data)
+    for budget in (4000, 30000, 120000):
+        builder = PromptBuilder("gemini-2.0-flash", budget=budget)
+        selected, select_ms = timed(lambda: builder.select(batches, "all", question))
+        text, render_ms = timed(lambda: builder.render(batches, "all", selected))
+        picked = sum(len(messages) for _, _, messages in selected)
+        print(f"{f'budget {budget} tokens':>28}: {select_ms + render_ms:7.1f} ms "
+              f"(select {select_ms:.1f}, render {render_ms:.1f}), {picked} messages from {len(selected)} chats, "
+              f"~{builder.count(text)} tokens, {len(split_message(text))} Telegram messages")
@@ -0,0 +1,68 @@
+import asyncio
+import time
+from telethon.errors import FloodWaitError
+from metrics import telegram_flood_waits, telegram_flood_wait_seconds
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every Telegram API call of a sync.
+    A FloodWaitError from any call blocks all callers until Telegram's wait is over.
+    api labels its backoffs in the metrics: "mtproto" for Telethon, "bot" for the Bot API.
+    """
+
+    def __init__(self, rate, burst=None, max_retries=3, api="mtproto"):
+        self.rate = rate
+        self.api = api
+        self.capacity = burst if burst is not None else max(1, rate)
+        self.max_retries = max_retries
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+        # Counters for reporting
+        self.calls = 0
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0.0
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def backoff(self, seconds):
+        """Block every caller for the given number of seconds"""
+        self.flood_waits += 1
+        self.flood_wait_seconds += seconds
+        telegram_flood_waits.inc(api=self.api)
+        telegram_flood_wait_seconds.inc(seconds, api=self.api)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        # Start again from an empty bucket once the wait is over
+        self.tokens = 0
+
+    async def call(self, func, *args, **kwargs):
+        """Call an async Telegram API function under the rate limit, retrying after FloodWait"""
+        for attempt in range(self.max_retries + 1):
+            await self.acquire()
+            # The metric is counted by the client itself (client_pool.CountingTelegramClient)
+            self.calls += 1
+            try:
+                return await func(*args, **kwargs)
+            except FloodWaitError as e:
+                print(f"FloodWait of {e.seconds} seconds, backing off all requests")
+                if attempt == self.max_retries:
+                    raise
+                self.backoff(e.seconds)
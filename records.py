@@ -0,0 +1,157 @@
+import sys
+from array import array
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+
+def parse_date(value):
+    """Epoch seconds from an API/JSON date string, only used for records without a timestamp"""
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp())
+
+
+@dataclass(slots=True)
+class MessageRecord:
+    """One message as it flows between the scraper, the store, the API and the bot"""
+    id: int
+    chat_id: int
+    sender_id: int
+    date: int
+    text: str
+    sender: str = ""
+    chat: str = ""
+    out: bool = False
+
+    @property
+    def datetime(self):
+        return datetime.fromtimestamp(self.date, timezone.utc)
+
+    @classmethod
+    def from_api(cls, data, chat=""):
+        """Build a record from a /users, /users/{user_id} or /stream JSON message"""
+        timestamp = data.get("ts")
+        if timestamp is None:
+            timestamp = parse_date(data["date"])
+        return cls(
+            id=data.get("id", 0),
+            chat_id=data.get("chat_id", 0),
+            sender_id=data.get("sender_id", 0),
+            date=timestamp,
+            text=data.get("text", ""),
+            sender=data.get("sender", ""),
+            chat=chat
+        )
+
+    def to_dict(self):
+        """Flat JSON shape used for NDJSON exports"""
+        return {
+            "chat_id": self.chat_id,
+            "chat": self.chat,
+            "id": self.id,
+            "sender_id": self.sender_id,
+            "sender": self.sender,
+            "text": self.text,
+            "date": str(self.datetime),
+            "out": self.out
+        }
+
+
+class MessageBatch:
+    """
+    Columnar container for many messages: ids, chat/sender ids and epoch
+    timestamps live in int64 arrays, and each chat or sender name is stored
+    once per batch instead of once per message.
+    """
+
+    __slots__ = ("ids", "chat_ids", "sender_ids", "dates", "outs", "texts", "chats", "senders")
+
+    def __init__(self):
+        self.ids = array('q')
+        self.chat_ids = array('q')
+        self.sender_ids = array('q')
+        self.dates = array('q')
+        self.outs = bytearray()
+        self.texts = []
+        self.chats = {}
+        self.senders = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, record):
+        self.ids.append(record.id)
+        self.chat_ids.append(record.chat_id)
+        self.sender_ids.append(record.sender_id or 0)
+        self.dates.append(record.date)
+        self.outs.append(1 if record.out else 0)
+        self.texts.append(record.text)
+        if record.chat and record.chat_id not in self.chats:
+            self.chats[record.chat_id] = sys.intern(record.chat)
+        if (record.sender_id or 0) not in self.senders:
+            self.senders[record.sender_id or 0] = sys.intern(record.sender)
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+        return self
+
+    def record(self, index):
+        chat_id = self.chat_ids[index]
+        sender_id = self.sender_ids[index]
+        return MessageRecord(
+            id=self.ids[index],
+            chat_id=chat_id,
+            sender_id=sender_id,
+            date=self.dates[index],
+            text=self.texts[index],
+            sender=self.senders.get(sender_id, ""),
+            chat=self.chats.get(chat_id, ""),
+            out=bool(self.outs[index])
+        )
+
+    def __iter__(self):
+        for index in range(len(self.ids)):
+            yield self.record(index)
+
+    @classmethod
+    def from_api(cls, messages, chat=""):
+        """Batch of the JSON messages of one chat, in their order"""
+        return cls().extend(MessageRecord.from_api(message, chat) for message in messages)
+
+
+def users_batches(data):
+    """A /users JSON body with each chat's messages as a MessageBatch, in the same order"""
+    return {"messages": {
+        section: {chat: MessageBatch.from_api(messages, chat) for chat, messages in chats.items()}
+        for section, chats in data["messages"].items()
+    }}
+
+
+if __name__ == "__main__":
+    # Compare memory of 30 chats x 1000 messages as dicts and as a batch
+    import tracemalloc
+
+    senders = [f"Sender {i}" for i in range(30)]
+
+    tracemalloc.start()
+    dicts = [
+        {"name": "Sender " + str(chat), "text": f"message {i}",
+         "date": str(datetime.fromtimestamp(1_700_000_000 + i, timezone.utc))}
+        for chat in range(30) for i in range(1000)
+    ]
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del dicts
+
+    tracemalloc.start()
+    batch = MessageBatch().extend(
+        MessageRecord(i, chat, chat, 1_700_000_000 + i, f"message {i}", senders[chat])
+        for chat in range(30) for i in range(1000)
+    )
+    batch_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f"dicts: {dict_bytes / 1024 / 1024:.2f} MiB, batch: {batch_bytes / 1024 / 1024:.2f} MiB "
+          f"for {len(batch)} messages")
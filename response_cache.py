@@ -0,0 +1,86 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class SnapshotCache:
+    """
+    Per-key snapshots with a TTL. Fresh snapshots are served as is; stale ones
+    are served immediately while one background refresh runs
+    (stale-while-revalidate); concurrent callers share a single in-flight
+    refresh per key. Snapshots older than max_stale are never served and are
+    dropped; past max_entries the least recently used ones are dropped too.
+    """
+
+    def __init__(self, ttl, max_stale=None, max_entries=None):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.inflight = {}
+
+        # Counters for reporting
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    async def get(self, key, loader):
+        """Return the snapshot for key, calling the async loader() when it has to be (re)built"""
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            value, fetched_at = entry
+            age = time.time() - fetched_at
+            if age < self.ttl:
+                self.hits += 1
+                return value
+            if self.max_stale is None or age < self.max_stale:
+                self.stale_hits += 1
+                self.refresh(key, loader)
+                return value
+
+        self.misses += 1
+        # Shielded so a caller giving up does not cancel the refresh other callers wait on
+        return await asyncio.shield(self.refresh(key, loader))
+
+    def refresh(self, key, loader):
+        """Start a refresh for key unless one is already running, and return its task"""
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, loader))
+            task.add_done_callback(self._report_failure)
+            self.inflight[key] = task
+        return task
+
+    async def _load(self, key, loader):
+        try:
+            self.refreshes += 1
+            value = await loader()
+            self.entries[key] = (value, time.time())
+            self.entries.move_to_end(key)
+            self.evict()
+            return value
+        finally:
+            self.inflight.pop(key, None)
+
+    def evict(self):
+        """Drop snapshots too old to serve, then the least recently used ones past max_entries"""
+        if self.max_stale is not None:
+            oldest = time.time() - self.max_stale
+            for key in [key for key, (_, fetched_at) in self.entries.items() if fetched_at <= oldest]:
+                del self.entries[key]
+        while self.max_entries is not None and len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    @staticmethod
+    def _report_failure(task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Error refreshing cached snapshot: {str(task.exception())}")
+
+    def invalidate(self, key=None):
+        """Drop one snapshot, or all of them"""
+        if key is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
@@ -0,0 +1,352 @@
+import asyncio
+import os
+import threading
+import time
+from functools import lru_cache
+from message_store import message_store
+
+try:
+    import numpy as np
+except ImportError:  # Without numpy search falls back to the full-text index only
+    np = None
+
+try:
+    import faiss
+except ImportError:  # numpy computes the similarities instead
+    faiss = None
+
+# Embedding backend: "gemini" (the model LLM_API_Embedding.py uses), "sentence-transformers" or "none"
+embedding_backend = os.getenv('embedding_backend', 'gemini' if os.getenv('GOOGLE_API_KEY') else 'none')
+embedding_batch_size = int(os.getenv('embedding_batch_size', 100))
+embedding_interval = float(os.getenv('embedding_interval', 60))
+
+# Candidates taken from each index before fusion, and the reciprocal rank fusion constant
+search_candidates = int(os.getenv('search_candidates', 50))
+rrf_k = 60
+
+# Vector hits at or below this cosine similarity are not considered matches
+search_min_similarity = float(os.getenv('search_min_similarity', 0))
+
+
+class GeminiEmbeddings:
+    model = os.getenv('gemini_embedding_model', 'models/embedding-001')
+
+    def __init__(self):
+        import google.generativeai as genai
+        genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
+        self.genai = genai
+
+    def embed(self, texts, task_type="RETRIEVAL_DOCUMENT"):
+        result = self.genai.embed_content(model=self.model, content=texts, task_type=task_type)
+        return result['embedding']
+
+    def embed_query(self, text):
+        return self.embed([text], task_type="RETRIEVAL_QUERY")[0]
+
+
+class SentenceTransformerEmbeddings:
+    # Multilingual, the chats are mostly Persian
+    model = os.getenv('sentence_transformer_model', 'paraphrase-multilingual-MiniLM-L12-v2')
+
+    def __init__(self):
+        from sentence_transformers import SentenceTransformer
+        self.encoder = SentenceTransformer(self.model)
+
+    def embed(self, texts):
+        return self.encoder.encode(texts, convert_to_numpy=True)
+
+    def embed_query(self, text):
+        return self.embed([text])[0]
+
+
+@lru_cache(maxsize=1)
+def get_embedder():
+    """The configured embedding backend, None when vector search is off"""
+    if np is None or embedding_backend == 'none':
+        return None
+    backends = {"gemini": GeminiEmbeddings, "sentence-transformers": SentenceTransformerEmbeddings}
+    if embedding_backend not in backends:
+        raise ValueError(f"Unknown embedding backend: {embedding_backend}")
+    try:
+        return backends[embedding_backend]()
+    except ImportError as e:
+        print(f"Embedding backend {embedding_backend} is not installed, searching full-text only: {str(e)}")
+        return None
+
+
+def normalized(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class VectorIndex:
+    """
+    In-memory cosine similarity index over one account's stored embeddings,
+    with the chat, sender and date of each vector kept alongside so filters
+    are applied before ranking. New embeddings are loaded incrementally; a
+    re-embedded (edited) message replaces its old vector in place, and the
+    vectors of deleted messages, or of edited ones not re-embedded yet, are
+    dropped as the store logs their embeddings' deletion. Searches run in
+    threads, so refresh and search hold a lock.
+    """
+
+    def __init__(self, account, model, store=message_store):
+        self.account = account
+        self.model = model
+        self.store = store
+        self.lock = threading.Lock()
+        self.reset()
+        self.last_deletion_id = None
+
+    def reset(self):
+        self.positions = {}
+        self.keys = []
+        self.embedding_ids = {}
+        self.chat_ids = np.zeros(0, dtype=np.int64)
+        self.sender_ids = np.zeros(0, dtype=np.int64)
+        self.dates = np.zeros(0, dtype=np.int64)
+        self.vectors = None
+        self.faiss_index = None
+        self.last_id = 0
+
+    def refresh(self):
+        with self.lock:
+            if self.last_deletion_id is None or self.store.embedding_deletions_expired(self.last_deletion_id):
+                # First load, or deletions this index has not seen were pruned: reload everything
+                self.reset()
+                self.last_deletion_id = self.store.latest_embedding_deletion()
+            else:
+                deletions = self.store.embedding_deletions(self.account, self.last_deletion_id)
+                if deletions:
+                    self.last_deletion_id = deletions[-1]["id"]
+                    # Only the vector of the deleted embedding; a re-embedding loaded since stays
+                    removed = set()
+                    for row in deletions:
+                        key = (row["chat_id"], row["message_id"])
+                        if self.embedding_ids.get(key) == row["embedding_id"]:
+                            removed.add(key)
+                    self.remove(removed)
+            rows = self.store.load_embeddings(self.account, self.model, self.last_id)
+            if rows:
+                self.add(rows)
+            return len(rows)
+
+    def add(self, rows):
+        self.last_id = rows[-1]["id"]
+
+        new_keys = []
+        chat_ids, sender_ids, dates, vectors = [], [], [], []
+        for row in rows:
+            key = (row["chat_id"], row["message_id"])
+            vector = np.frombuffer(row["vector"], dtype=np.float32)
+            self.embedding_ids[key] = row["id"]
+            position = self.positions.get(key)
+            if position is not None:
+                self.vectors[position] = vector
+                continue
+            self.positions[key] = len(self.keys) + len(new_keys)
+            new_keys.append(key)
+            chat_ids.append(row["chat_id"])
+            sender_ids.append(row["sender_id"] or 0)
+            dates.append(row["date"])
+            vectors.append(vector)
+
+        if new_keys:
+            self.keys.extend(new_keys)
+            self.chat_ids = np.concatenate([self.chat_ids, np.array(chat_ids, dtype=np.int64)])
+            self.sender_ids = np.concatenate([self.sender_ids, np.array(sender_ids, dtype=np.int64)])
+            self.dates = np.concatenate([self.dates, np.array(dates, dtype=np.int64)])
+            new_vectors = np.vstack(vectors)
+            self.vectors = new_vectors if self.vectors is None else np.vstack([self.vectors, new_vectors])
+        self.faiss_index = None
+
+    def remove(self, removed):
+        """Drop the vectors of the removed keys"""
+        if not removed:
+            return
+        keep = np.fromiter((key not in removed for key in self.keys), dtype=bool, count=len(self.keys))
+        self.keys = [key for key, kept in zip(self.keys, keep) if kept]
+        self.positions = {key: position for position, key in enumerate(self.keys)}
+        for key in removed:
+            self.embedding_ids.pop(key, None)
+        self.chat_ids = self.chat_ids[keep]
+        self.sender_ids = self.sender_ids[keep]
+        self.dates = self.dates[keep]
+        self.vectors = self.vectors[keep] if self.keys else None
+        self.faiss_index = None
+
+    def mask(self, chat_ids=None, sender_id=None, since=None, until=None):
+        mask = np.ones(len(self.keys), dtype=bool)
+        if chat_ids:
+            mask &= np.isin(self.chat_ids, chat_ids)
+        if sender_id is not None:
+            mask &= self.sender_ids == sender_id
+        if since is not None:
+            mask &= self.dates >= since
+        if until is not None:
+            mask &= self.dates < until
+        return mask
+
+    def search(self, query_vector, limit, **filters):
+        """(key, cosine similarity) of the best matches, best first"""
+        with self.lock:
+            return self.ranked(query_vector, limit, **filters)
+
+    def ranked(self, query_vector, limit, **filters):
+        if self.vectors is None:
+            return []
+        query_vector = normalized(query_vector)
+        if not any(value is not None for value in filters.values()) and faiss is not None:
+            if self.faiss_index is None:
+                self.faiss_index = faiss.IndexFlatIP(self.vectors.shape[1])
+                self.faiss_index.add(self.vectors)
+            scores, indices = self.faiss_index.search(query_vector.reshape(1, -1), limit)
+            return [(self.keys[index], float(score)) for index, score in zip(indices[0], scores[0]) if index >= 0]
+
+        candidates = np.flatnonzero(self.mask(**filters))
+        if len(candidates) == 0:
+            return []
+        scores = self.vectors[candidates] @ query_vector
+        if len(candidates) > limit:
+            top = np.argpartition(-scores, limit)[:limit]
+        else:
+            top = np.arange(len(candidates))
+        top = top[np.argsort(-scores[top])]
+        return [(self.keys[candidates[index]], float(scores[index])) for index in top]
+
+
+class HybridSearch:
+    """
+    Message search combining the store's FTS5 index (bm25) with embedding
+    similarity, merged by reciprocal rank fusion. Without an embedding
+    backend it ranks by full-text alone.
+    """
+
+    def __init__(self, store=message_store):
+        self.store = store
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    @property
+    def embedder(self):
+        return get_embedder()
+
+    def vector_index(self, account):
+        with self.lock:
+            index = self.indexes.get(account)
+            if index is None:
+                index = self.indexes[account] = VectorIndex(account, self.embedder.model, self.store)
+        index.refresh()
+        return index
+
+    def embed_pending(self, account, batch_size=embedding_batch_size):
+        """Embed one batch of messages that have no embedding yet; returns how many were embedded"""
+        embedder = self.embedder
+        if embedder is None:
+            return 0
+        pending = self.store.pending_embeddings(account, embedder.model, batch_size)
+        if not pending:
+            return 0
+        vectors = normalized(embedder.embed([row["text_norm"] for row in pending]))
+        self.store.save_embeddings(account, embedder.model, [
+            (row["chat_id"], row["message_id"], vector.tobytes()) for row, vector in zip(pending, vectors)
+        ])
+        return len(pending)
+
+    @lru_cache(maxsize=256)
+    def embed_query(self, query):
+        return normalized(self.embedder.embed_query(query))
+
+    def search(self, account, query, top_k=10, context=2, chat_ids=None, sender_id=None, since=None, until=None):
+        """
+        Best top_k messages for a free text query, each with its fused score,
+        its rank in each index and up to context messages around it.
+        """
+        filters = {"chat_ids": chat_ids, "sender_id": sender_id, "since": since, "until": until}
+        candidates = max(search_candidates, top_k)
+
+        records = {}
+        fts_ranks = {}
+        for rank, hit in enumerate(self.store.search(account, query, candidates, **filters), 1):
+            key = (hit["record"].chat_id, hit["record"].id)
+            records[key] = hit["record"]
+            fts_ranks[key] = rank
+
+        vector_ranks = {}
+        similarities = {}
+        if self.embedder is not None:
+            try:
+                hits = self.vector_index(account).search(self.embed_query(query), candidates, **filters)
+            except Exception as e:
+                print(f"Error in vector search, using full-text results only: {str(e)}")
+                hits = []
+            hits = [(key, similarity) for key, similarity in hits if similarity > search_min_similarity]
+            for rank, (key, similarity) in enumerate(hits, 1):
+                vector_ranks[key] = rank
+                similarities[key] = similarity
+
+        scores = {}
+        for ranks in (fts_ranks, vector_ranks):
+            for key, rank in ranks.items():
+                scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank)
+
+        # Vector-only hits still need their message; deleted ones drop out here
+        missing = [key for key in scores if key not in records]
+        records.update(self.store.get_messages(account, missing))
+
+        ranked = sorted((key for key in scores if key in records), key=lambda key: scores[key], reverse=True)
+        results = []
+        for key in ranked[:top_k]:
+            record = records[key]
+            results.append({
+                "score": scores[key],
+                "fts_rank": fts_ranks.get(key),
+                "vector_rank": vector_ranks.get(key),
+                "similarity": similarities.get(key),
+                "record": record,
+                "context": self.store.message_context(account, record, context, context) if context else []
+            })
+        return results
+
+    async def run_indexer(self, interval=embedding_interval):
+        """Keep embedding new messages of every account in the background"""
+        while True:
+            try:
+                for account in self.store.accounts():
+                    while await asyncio.to_thread(self.embed_pending, account):
+                        pass
+            except Exception as e:
+                print(f"Error embedding messages: {str(e)}")
+            await asyncio.sleep(interval)
+
+
+# Shared search used by the API
+hybrid_search = HybridSearch()
+
+
+if __name__ == "__main__":
+    # Embed every pending message, then time a few searches: python search_index.py [account] [query]
+    import sys
+    from telegram_sender import default_phone
+
+    account = sys.argv[1] if len(sys.argv) > 1 else default_phone
+    query = sys.argv[2] if len(sys.argv) > 2 else "جلسه فردا"
+
+    start = time.perf_counter()
+    embedded = 0
+    while True:
+        count = hybrid_search.embed_pending(account)
+        if not count:
+            break
+        embedded += count
+        print(f"Embedded {embedded} messages")
+    print(f"Embedding done in {time.perf_counter() - start:.2f}s with backend {embedding_backend}")
+
+    for _ in range(3):
+        start = time.perf_counter()
+        results = hybrid_search.search(account, query)
+        print(f"{len(results)} results in {(time.perf_counter() - start) * 1000:.1f} ms")
+    for result in results:
+        record = result["record"]
+        print(f"{result['score']:.4f} [{record.chat}] {record.sender}: {record.text[:80]}")
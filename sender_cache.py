@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+from message_store import message_store
+from text_normalizer import normalize_text
+
+# Seconds before a cached sender name is refreshed from Telegram
+sender_ttl = float(os.getenv('sender_ttl', 24 * 3600))
+
+
+def display_name(first_name, last_name):
+    """First and last name joined and normalized, interned so every message shares one string"""
+    return sys.intern(normalize_text(" ".join(part for part in (first_name, last_name) if part)))
+
+
+def sender_row(sender):
+    """Sender columns for the message store"""
+    return {
+        "sender_id": sender.id,
+        "first_name": getattr(sender, 'first_name', None),
+        "last_name": getattr(sender, 'last_name', None)
+    }
+
+
+class SenderCache:
+    """
+    Display names keyed by user id. Names are resolved once per TTL and
+    persisted in the store's senders table, so messages only need to keep
+    the sender id and a restart does not start from an empty cache.
+    """
+
+    def __init__(self, store, ttl=sender_ttl):
+        self.store = store
+        self.ttl = ttl
+        self.entries = {}
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """Load the senders persisted by previous runs that are still fresh"""
+        for row in self.store.load_senders(int(time.time() - self.ttl)):
+            self.entries[row["sender_id"]] = (sys.intern(row["name"]), row["updated_at"])
+        self.loaded = True
+
+    def get(self, sender_id):
+        """Cached display name for a sender id, or None when unknown"""
+        if not self.loaded:
+            self.load()
+        entry = self.entries.get(sender_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def is_fresh(self, sender_id):
+        if not self.loaded:
+            self.load()
+        entry = self.entries.get(sender_id)
+        return entry is not None and time.time() - entry[1] < self.ttl
+
+    def stale_rows(self, senders):
+        """Remember sender entities and return store rows for the ones that are new, renamed or stale"""
+        if not self.loaded:
+            self.load()
+        now = time.time()
+        rows = []
+        for sender in senders:
+            if sender is None:
+                continue
+            name = display_name(getattr(sender, 'first_name', None), getattr(sender, 'last_name', None))
+            entry = self.entries.get(sender.id)
+            if entry is not None and entry[0] == name and now - entry[1] < self.ttl:
+                continue
+            self.entries[sender.id] = (name, now)
+            rows.append(sender_row(sender))
+        return rows
+
+    def update(self, senders):
+        """Remember sender entities, persisting the ones that are new, renamed or stale"""
+        rows = self.stale_rows(senders)
+        if rows:
+            self.store.upsert_senders(rows)
+        return len(rows)
+
+    def warm(self, dialogs):
+        """Pre-warm the cache from the dialog list; a private chat's entity is its other sender"""
+        return self.update(dialog.entity for dialog in dialogs if dialog.is_user)
+
+    def name_for(self, message):
+        """Display name of a message's sender, without extra Telethon lookups"""
+        if message.sender is not None and not self.is_fresh(message.sender_id):
+            self.update([message.sender])
+        return self.get(message.sender_id) or ""
+
+
+# Shared cache used by the scraper and the ingest daemon
+sender_cache = SenderCache(message_store)
@@ -0,0 +1,189 @@
+import gzip
+import json
+import time
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:  # Falls back to the standard library encoder
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # Only gzip is offered without it
+    zstandard = None
+
+# Bodies smaller than this are sent uncompressed
+compress_min_size = 1024
+
+
+def dumps(obj):
+    """Serialize to compact UTF-8 JSON bytes, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def format_date(timestamp):
+    """ISO 8601 UTC date for epoch seconds, as the pydantic models rendered it"""
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
+
+
+def messages_to_json(records):
+    """Plain JSON objects for MessageRecords, matching main.Message"""
+    return [
+        {"id": record.id, "sender_id": record.sender_id, "sender": record.sender, "text": record.text,
+         "date": format_date(record.date), "ts": record.date}
+        for record in records
+    ]
+
+
+def users_payload(most_recent, unread, next_cursor=None):
+    """The whole /users response body as JSON bytes, without per-record model validation"""
+    return dumps({
+        "messages": {
+            "most_recent": {chat: messages_to_json(records) for chat, records in most_recent.items()},
+            "unread": {chat: messages_to_json(records) for chat, records in unread.items()}
+        },
+        "next_cursor": next_cursor
+    })
+
+
+def search_payload(query, results):
+    """/search response body for HybridSearch results"""
+    return dumps({
+        "query": query,
+        "results": [
+            {
+                "score": result["score"],
+                "fts_rank": result["fts_rank"],
+                "vector_rank": result["vector_rank"],
+                "similarity": result["similarity"],
+                "chat": result["record"].chat,
+                "chat_id": result["record"].chat_id,
+                **messages_to_json([result["record"]])[0],
+                "context": messages_to_json(result["context"])
+            }
+            for result in results
+        ]
+    })
+
+
+def change_to_json(change):
+    """
+    Stream event for a message_store.changes_since row. new/edit events carry
+    the message; delete events only its id; read events the read marker in id;
+    rename events only the chat whose name, or whose sender's name, changed.
+    """
+    event = {"seq": change["seq"], "type": change["kind"], "chat_id": change["chat_id"],
+             "chat": change["chat"], "id": change["message_id"]}
+    if change["text"] is not None and change["kind"] in ("new", "edit"):
+        event.update(sender_id=change["sender_id"] or 0, sender=change["sender"], text=change["text"],
+                     date=format_date(change["date"]), ts=change["date"], out=bool(change["out"]))
+    return event
+
+
+def accepted_encodings(accept_encoding):
+    """Content codings an Accept-Encoding header allows (q=0 excluded)"""
+    encodings = set()
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        if coding:
+            encodings.add(coding.strip().lower())
+    return encodings
+
+
+def choose_encoding(accept_encoding):
+    """zstd when both sides support it, otherwise gzip, otherwise None"""
+    encodings = accepted_encodings(accept_encoding or "")
+    if zstandard is not None and "zstd" in encodings:
+        return "zstd"
+    if "gzip" in encodings or "*" in encodings:
+        return "gzip"
+    return None
+
+
+def compress(body, encoding):
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    return gzip.compress(body, compresslevel=5, mtime=0)
+
+
+class EncodedBody:
+    """A serialized response body and its compressed variants, each compressed at most once"""
+
+    __slots__ = ("body", "variants")
+
+    def __init__(self, body):
+        self.body = body
+        self.variants = {}
+
+    def encode(self, encoding):
+        """(content, content coding) to send for the negotiated encoding"""
+        if encoding is None or len(self.body) < compress_min_size:
+            return self.body, None
+        content = self.variants.get(encoding)
+        if content is None:
+            content = self.variants[encoding] = compress(self.body, encoding)
+        return content, encoding
+
+
+class JSONBytesResponse(Response):
+    """Response for bodies that are already serialized JSON bytes"""
+    media_type = "application/json"
+
+    def render(self, content):
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
+
+
+if __name__ == "__main__":
+    # Compare the pydantic path the endpoints used with the bulk path on 30 chats x 1000 messages
+    from datetime import datetime
+    from typing import Dict, List, Optional
+    from pydantic import BaseModel
+    from records import MessageRecord
+
+    class Message(BaseModel):
+        sender: str
+        text: str
+        date: datetime
+        ts: Optional[int] = None
+
+    class MessagesResponse(BaseModel):
+        messages: Dict[str, Dict[str, List[Message]]]
+        next_cursor: Optional[str] = None
+
+    chats = {
+        f"Chat{chat}": [
+            MessageRecord(i, chat, chat, 1_700_000_000 + i, f"message number {i} in chat {chat}", f"Sender {chat}")
+            for i in range(1000)
+        ]
+        for chat in range(30)
+    }
+    unread = {chat: records[-10:] for chat, records in list(chats.items())[:5]}
+
+    def model_path():
+        def to_models(records):
+            return [Message(sender=r.sender, text=r.text, date=r.datetime, ts=r.date) for r in records]
+        response = MessagesResponse(messages={
+            "most_recent": {chat: to_models(records) for chat, records in chats.items()},
+            "unread": {chat: to_models(records) for chat, records in unread.items()}
+        })
+        # FastAPI validates the returned model against response_model again before encoding it
+        return MessagesResponse.model_validate(response.model_dump()).model_dump_json().encode("utf-8")
+
+    def bulk_path():
+        return users_payload(chats, unread)
+
+    for name, path in (("pydantic models", model_path), ("bulk", bulk_path)):
+        path()
+        runs = 5
+        start = time.perf_counter()
+        for _ in range(runs):
+            body = path()
+        elapsed = (time.perf_counter() - start) / runs
+        print(f"{name:>16}: {elapsed * 1000:8.1f} ms per response, {len(body) / 1024:.0f} KiB")
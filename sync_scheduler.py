@@ -0,0 +1,135 @@
+import asyncio
+import glob
+import os
+import time
+from rate_limiter import RateLimiter
+from message_store import message_store
+from telegram_sender import client_pool, store_messages, sync_chat, format_time
+
+# Global budget shared by every account
+sync_concurrency = int(os.getenv('sync_concurrency', 4))
+sync_requests_per_second = float(os.getenv('sync_requests_per_second', 5))
+
+# How often each account lists its dialogs and new sessions are looked for
+dialog_list_interval = float(os.getenv('dialog_list_interval', 10 * 60))
+discover_interval = float(os.getenv('discover_interval', 60))
+
+# Per-dialog poll intervals by activity, in seconds
+unread_interval = 30
+active_interval = 60
+recent_interval = 5 * 60
+dormant_interval = 60 * 60
+
+
+def poll_interval(dialog, now):
+    """Dialogs with unread or recent messages are polled more often than dormant ones"""
+    if dialog["unread_count"] > 0:
+        return unread_interval
+    age = now - (dialog["last_message_date"] or 0)
+    if age < 3600:
+        return active_interval
+    if age < 24 * 3600:
+        return recent_interval
+    return dormant_interval
+
+
+def due_dialogs(account, now):
+    """Stored dialogs of an account whose poll interval has passed, most urgent first"""
+    due = []
+    for dialog in message_store.get_dialog_states(account).values():
+        interval = poll_interval(dialog, now)
+        overdue = now - (dialog["synced_at"] or 0) - interval
+        if overdue >= 0:
+            due.append((overdue / interval, dialog))
+    due.sort(key=lambda item: item[0], reverse=True)
+    return [dialog for _, dialog in due]
+
+
+def discover_sessions(sessions_dir="sessions"):
+    """Phone numbers of every session file created by the login flow"""
+    return sorted(
+        os.path.splitext(os.path.basename(path))[0]
+        for path in glob.glob(os.path.join(sessions_dir, "*.session"))
+    )
+
+
+class SyncScheduler:
+    """
+    Keeps every authorized account fresh. Each account lists its dialogs on
+    its own cadence and polls individual dialogs in between, by activity,
+    all under one global concurrency limit and rate limiter.
+    """
+
+    def __init__(self, concurrency=sync_concurrency, requests_per_second=sync_requests_per_second, tick=5):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.limiter = RateLimiter(requests_per_second)
+        self.tick = tick
+        self.accounts = {}
+
+    async def is_authorized(self, phone):
+        try:
+            client = await client_pool.get(phone)
+            return await client.is_user_authorized()
+        except Exception as e:
+            print(f"Error checking session {phone}: {str(e)}")
+            return False
+
+    async def refresh_accounts(self):
+        """Start a sync loop for every newly authorized session"""
+        for phone in discover_sessions(client_pool.sessions_dir):
+            task = self.accounts.get(phone)
+            if task is not None and not task.done():
+                continue
+            if await self.is_authorized(phone):
+                print(f"Scheduling syncs for {phone}")
+                self.accounts[phone] = asyncio.create_task(self.run_account(phone))
+
+    async def poll_dialog(self, phone, dialog):
+        async with self.semaphore:
+            try:
+                return await sync_chat(phone, dialog, self.limiter)
+            except Exception as e:
+                print(f"Error polling chat {dialog['name']} of {phone}: {str(e)}")
+                return 0
+
+    async def run_account(self, phone):
+        next_dialog_list = 0
+        while True:
+            now = time.time()
+            if now >= next_dialog_list:
+                async with self.semaphore:
+                    await store_messages(phone=phone, limiter=self.limiter)
+                next_dialog_list = time.time() + dialog_list_interval
+            else:
+                dialogs = due_dialogs(phone, now)
+                if dialogs:
+                    start_time = time.time()
+                    counts = await asyncio.gather(*(self.poll_dialog(phone, dialog) for dialog in dialogs))
+                    print(f"Polled {len(dialogs)} chats of {phone}, {sum(counts)} new messages "
+                          f"in {format_time(time.time() - start_time)}")
+            await asyncio.sleep(self.tick)
+
+    async def run(self):
+        client_pool.start_maintenance()
+        try:
+            while True:
+                await self.refresh_accounts()
+                message_store.prune_changes()
+                await asyncio.sleep(discover_interval)
+        finally:
+            for task in self.accounts.values():
+                task.cancel()
+            await client_pool.close_all()
+
+
+async def run_scheduler():
+    await SyncScheduler().run()
+
+def main():
+    try:
+        asyncio.run(run_scheduler())
+    except KeyboardInterrupt:
+        print("\nScheduler stopped")
+
+if __name__ == "__main__":
+    main()
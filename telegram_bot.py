@@ -1,12 +1,18 @@
-import telebot
+from telebot.async_telebot import AsyncTeleBot
 from telebot import types
-import requests
+import aiohttp
+import asyncio
 import json
-from datetime import datetime, timedelta
 import os
 import time
-import threading
-from LLM_API_Context import get_LLM_response 
+from LLM_API_Context import get_LLM_response_async, build_prompt, generative_model_name
+from prompt_builder import PromptBuilder, split_message
+from live_view import LiveView
+from records import users_batches
+from chat_actions import ChatActionScheduler
+from bot_webhook import run_webhook, webhook_url
+from job_queue import JobQueue, JobCancelled, QueueFull
+from metrics import prompt_build_seconds, start_http_server
 from dotenv import load_dotenv
 # from LLM import query_chat_messages
 # Load environment variables
@@ -17,10 +23,38 @@ BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 if not BOT_TOKEN:
     raise ValueError("Please set TELEGRAM_BOT_TOKEN in your .env file")
 
-bot = telebot.TeleBot(BOT_TOKEN)
+# Handlers run as asyncio tasks, so one user's slow LLM call does not hold up anyone else
+bot = AsyncTeleBot(BOT_TOKEN)
 
 # Base URL for your API
-API_BASE_URL = "http://localhost:8000"  # Change this to your actual API URL
+API_BASE_URL = os.getenv('api_base_url', "http://localhost:8000")  # Change this to your actual API URL
+
+# Keep-alive connections to the API shared by every handler
+api_connections = int(os.getenv('bot_api_connections', 20))
+api_timeout = float(os.getenv('bot_api_timeout', 120))
+api_session = None
+
+# Connection failures of API calls
+API_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+# "typing..." for every chat with a request in flight, sent from one rate-limited loop
+chat_actions = ChatActionScheduler(bot.send_chat_action)
+
+# Questions are answered llm_max_concurrent at a time, one per user; a newer
+# question of the same user supersedes the one still waiting or running
+question_queue = JobQueue("questions")
+
+# Messages per chat requested from the API; the prompt builder picks the ones
+# that fit its token budget (prompt_token_budget) by relevance and recency
+messages_per_chat = int(os.getenv('bot_messages_per_chat', 200))
+
+# Messages per chat shown by the View Recent/Unread Messages buttons
+view_messages_per_chat = 5
+
+prompt_builder = PromptBuilder(generative_model_name)
+
+# Last /users payload and its ETag, revalidated with If-None-Match instead of downloaded again
+last_users = (None, None)
 
 # Store user states
 user_states = {}
@@ -37,48 +71,108 @@ def get_user_state(user_id):
         user_states[user_id] = UserState()
     return user_states[user_id]
 
-def keep_typing(chat_id, stop_event):
-    """Keep sending typing action until stop_event is set"""
-    while not stop_event.is_set():
-        bot.send_chat_action(chat_id, 'typing')
-        time.sleep(3)  # Send typing action every 3 seconds
+class APIResponse:
+    """Status, headers and body of an API call, read before its connection went back to the pool"""
 
-@bot.message_handler(func=lambda message: message.text != "")
-def get_messages(message):
-    start_time = time.time()
-    stop_typing = threading.Event()
-    typing_thread = threading.Thread(target=keep_typing, args=(message.chat.id, stop_typing))
-    typing_thread.start()
-    
-    try:
+    def __init__(self, status_code, headers, text):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+async def get_api_session():
+    global api_session
+    if api_session is None or api_session.closed:
+        api_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=api_connections, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=api_timeout)
+        )
+    return api_session
+
+# Local /users view kept current by the API's /stream endpoint, over the same
+# session; while it is disconnected the handlers fall back to requesting /users
+live_view = LiveView(API_BASE_URL, messages_per_chat, get_api_session) if os.getenv('bot_live_view', '1') == '1' else None
+
+async def api_request(method, path, **kwargs):
+    session = await get_api_session()
+    async with session.request(method, f"{API_BASE_URL}{path}", **kwargs) as response:
+        return APIResponse(response.status, response.headers, await response.text())
+
+async def api_get(path, **kwargs):
+    return await api_request("GET", path, **kwargs)
+
+async def api_post(path, **kwargs):
+    return await api_request("POST", path, **kwargs)
+
+async def fetch_users():
+    """
+    /users data with a MessageBatch per chat, from the live view or from the
+    API when the view is not connected; None on failure
+    """
+    global last_users
+    if live_view is not None and live_view.ready:
+        return live_view.snapshot()
+    etag, data = last_users
+    headers = {"If-None-Match": etag} if etag else {}
+    response = await api_get("/users", params={"per_chat_limit": messages_per_chat}, headers=headers)
+    print(f"Debug - Response status: {response.status_code}")  # Debug log
+    if response.status_code == 304:
+        return data
+    if response.status_code == 200:
+        data = users_batches(response.json())
+        last_users = (response.headers.get("ETag"), data)
+        return data
+    return None
+
+async def answer_question(message, start_time):
+    async with chat_actions.typing(message.chat.id):
         message_text = message.text
-        response = requests.get(f"{API_BASE_URL}/users")
-        print(f"Debug - Response status in LLM call: {response.status_code}")  # Debug log
+        data = await fetch_users()
             
-        if response.status_code == 200:
-            data = response.json()
-            data_formatted = format_messages(data, "recent")
-            llm_response = get_LLM_response(data_formatted, message_text)
+        if data is not None:
+            # The instructions and the question come out of the same budget
+            reserved = prompt_builder.count(build_prompt("", message_text))
+            data_formatted = format_messages(data, "recent", question=message_text, reserved=reserved)
+            llm_response = await get_LLM_response_async(data_formatted, message_text)
             # llm_response = query_chat_messages(message_text, data)
             processing_time = time.time() - start_time
-            bot.reply_to(message, f"{llm_response}\n\n⏱️ Time: {processing_time:.2f}s")
+            await reply_in_parts(message, f"{llm_response}\n\n⏱️ Time: {processing_time:.2f}s")
         else:
             processing_time = time.time() - start_time
-            bot.reply_to(message, f"Failed to fetch messages. Please try again.\n\n⏱️ Time: {processing_time:.2f}s")
-    finally:
-        stop_typing.set()  # Stop the typing indicator
-        typing_thread.join()  # Wait for the typing thread to finish
+            await bot.reply_to(message, f"Failed to fetch messages. Please try again.\n\n⏱️ Time: {processing_time:.2f}s")
+
+@bot.message_handler(func=lambda message: message.text != "")
+async def get_messages(message):
+    start_time = time.time()
+    user_id = message.from_user.id
+    try:
+        job = question_queue.submit(user_id, lambda: answer_question(message, start_time))
+    except QueueFull:
+        await bot.reply_to(message, "Too many questions right now. Please try again in a minute.")
+        return
+    
+    # Only worth saying when other users' questions are ahead, not just the user's own superseded one
+    position = question_queue.position(job)
+    if position and not question_queue.running_for(user_id):
+        await bot.reply_to(message, f"⏳ Your question is #{position} in line.")
+    try:
+        await question_queue.wait(job)
+    except JobCancelled as e:
+        if e.reason == "superseded":
+            await bot.reply_to(message, "Skipped, answering your newer question instead.")
 
         
 @bot.message_handler(commands=['start'])
-def start(message):
+async def start(message):
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
     login_button = types.KeyboardButton('Login', request_contact=True)
     markup.add(login_button)
-    bot.reply_to(message, "Welcome! Please click the Login button to share your phone number.", reply_markup=markup)
+    await bot.reply_to(message, "Welcome! Please click the Login button to share your phone number.", reply_markup=markup)
 
 @bot.message_handler(content_types=['contact'])
-def handle_contact(message):
+async def handle_contact(message):
     if message.contact is not None:
         phone = message.contact.phone_number
         print(f"Debug - Received phone number from contact: {phone}")  # Debug log
@@ -86,8 +180,7 @@ def handle_contact(message):
         try:
             # Start login process directly
             print(f"Debug - Sending login request to {API_BASE_URL}/start-login")  # Debug log
-            login_response = requests.post(f"{API_BASE_URL}/start-login", 
-                                        json={"phone": phone})
+            login_response = await api_post("/start-login", json={"phone": phone})
             print(f"Debug - Login response status: {login_response.status_code}")  # Debug log
             print(f"Debug - Login response data: {login_response.text}")  # Debug log
             
@@ -96,7 +189,7 @@ def handle_contact(message):
                     response_data = login_response.json()
                     if "error" in response_data:
                         print(f"Debug - Server returned error: {response_data['error']}")  # Debug log
-                        bot.reply_to(message, f"Login failed: {response_data['error']}")
+                        await bot.reply_to(message, f"Login failed: {response_data['error']}")
                         return
                     
                     if response_data.get("status") == "ALREADY_LOGGED_IN":
@@ -104,7 +197,7 @@ def handle_contact(message):
                         user_state.phone = phone
                         user_state.waiting_for_code = False
                         user_state.waiting_for_2fa = False
-                        show_main_menu(message)
+                        await show_main_menu(message)
                         return
                         
                     user_state = get_user_state(message.from_user.id)
@@ -112,14 +205,14 @@ def handle_contact(message):
                     user_state.waiting_for_code = True
                     user_state.code = ""  # Reset code
                     print(f"Debug - Starting verification code input for phone: {phone}")  # Debug log
-                    bot.reply_to(
+                    await bot.reply_to(
                         message,
                         "Please enter the verification code sent to your phone:",
                         reply_markup=create_code_keyboard()
                     )
                 except json.JSONDecodeError as e:
                     print(f"Debug - Error parsing response: {str(e)}")  # Debug log
-                    bot.reply_to(message, "Error processing server response. Please try again.")
+                    await bot.reply_to(message, "Error processing server response. Please try again.")
             else:
                 try:
                     error_data = login_response.json()
@@ -127,10 +220,10 @@ def handle_contact(message):
                 except json.JSONDecodeError:
                     error_message = 'Failed to initiate login. Please try again.'
                 print(f"Debug - Login failed: {error_message}")  # Debug log
-                bot.reply_to(message, error_message)
-        except requests.RequestException as e:
+                await bot.reply_to(message, error_message)
+        except API_ERRORS as e:
             print(f"Debug - Error during login: {str(e)}")  # Debug log
-            bot.reply_to(message, "Connection error. Please try again later.")
+            await bot.reply_to(message, "Connection error. Please try again later.")
 
 def create_code_keyboard():
     markup = types.InlineKeyboardMarkup(row_width=3)
@@ -147,7 +240,7 @@ def create_code_keyboard():
     return markup
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('code_'))
-def handle_code_input(call):
+async def handle_code_input(call):
     user_state = get_user_state(call.from_user.id)
     action = call.data.split('_')[1]
     
@@ -159,7 +252,7 @@ def handle_code_input(call):
     elif action == "submit":
         if len(user_state.code) > 0:
             print(f"Debug - Submitting code: {user_state.code}")  # Debug log
-            submit_verification_code(call.message, user_state.code)
+            await submit_verification_code(call.message, user_state.code)
             return
     else:
         if len(user_state.code) < 5:  # Limit code length to 5 digits
@@ -169,7 +262,7 @@ def handle_code_input(call):
     # Update the message with the current code
     masked_code = "•" * len(user_state.code)
     try:
-        bot.edit_message_text(
+        await bot.edit_message_text(
             f"Enter verification code:\n\n{masked_code}",
             call.message.chat.id,
             call.message.message_id,
@@ -179,12 +272,11 @@ def handle_code_input(call):
     except Exception as e:
         print(f"Debug - Error updating message: {str(e)}")  # Debug log
 
-def submit_verification_code(message, code):
+async def submit_verification_code(message, code):
     user_state = get_user_state(message.chat.id)
     print(f"Debug - Submitting verification code for phone {user_state.phone}: {code}")  # Debug log
     try:
-        response = requests.post(f"{API_BASE_URL}/submit-code",
-                              json={"phone": user_state.phone, "code": code})
+        response = await api_post("/submit-code", json={"phone": user_state.phone, "code": code})
         print(f"Debug - Server response status: {response.status_code}")  # Debug log
         print(f"Debug - Server response data: {response.text}")  # Debug log
 
@@ -194,17 +286,17 @@ def submit_verification_code(message, code):
                 if response_data.get("status") == "NEED_PASSWORD":
                     user_state.waiting_for_2fa = True
                     user_state.waiting_for_code = False
-                    bot.reply_to(message, response_data.get("message", "Please enter your 2FA password:"))
+                    await bot.reply_to(message, response_data.get("message", "Please enter your 2FA password:"))
                 elif response_data.get("status") == "LOGGED_IN":
                     user_state.waiting_for_code = False
                     user_state.waiting_for_2fa = False
-                    show_main_menu(message)
+                    await show_main_menu(message)
                 else:
                     user_state.waiting_for_code = False
-                    show_main_menu(message)
+                    await show_main_menu(message)
             except json.JSONDecodeError as e:
                 print(f"Debug - Error parsing response: {str(e)}")  # Debug log
-                bot.reply_to(message, "Error processing server response. Please try again.")
+                await bot.reply_to(message, "Error processing server response. Please try again.")
         else:
             try:
                 error_data = response.json()
@@ -212,97 +304,60 @@ def submit_verification_code(message, code):
             except json.JSONDecodeError:
                 error_message = 'Invalid code. Please try again.'
             print(f"Debug - Invalid code response: {error_message}")  # Debug log
-            bot.reply_to(message, error_message)
-    except requests.RequestException as e:
+            await bot.reply_to(message, error_message)
+    except API_ERRORS as e:
         print(f"Debug - Error submitting code: {str(e)}")  # Debug log
-        bot.reply_to(message, "Connection error. Please try again later.")
+        await bot.reply_to(message, "Connection error. Please try again later.")
 
-def format_messages(data, view_type='all'):
-    if not data or 'messages' not in data:
-        return "No messages found."
-    
-    formatted_text = ""
-    
-    if view_type == 'all' or view_type == 'recent':
-        # Format most recent messages
-        if 'most_recent' in data['messages']:
-            formatted_text += "📥 Recent Messages:\n"
-            for user_id, messages in data['messages']['most_recent'].items():
-                formatted_text += f"\nChat with {user_id}\n"
-                formatted_text += "-------------------\n"
-                # Take only top 5 messages
-                for msg in messages[:5]:
-                    # Add 3:30 hours to the timestamp
-                    original_date = datetime.fromisoformat(msg['date'])
-                    adjusted_date = original_date + timedelta(hours=3, minutes=30)
-                    date_str = adjusted_date.strftime('%Y-%m-%d %H:%M:%S')
-                    formatted_text += f"[{date_str}]\n"
-                    formatted_text += f"{msg['sender']}: {msg['text']}\n"
-                    formatted_text += "-------------------\n"
-    
-    if view_type == 'all' or view_type == 'unread':
-        # Format unread messages
-        if 'unread' in data['messages']:
-            formatted_text += "\n📨 Unread Messages:\n"
-            for user_id, messages in data['messages']['unread'].items():
-                formatted_text += f"\nScene: Unread Chat with {user_id}\n"
-                formatted_text += "-------------------\n"
-                # Take only top 5 messages
-                for msg in messages[:5]:
-                    # Add 3:30 hours to the timestamp
-                    original_date = datetime.fromisoformat(msg['date'])
-                    adjusted_date = original_date + timedelta(hours=3, minutes=30)
-                    date_str = adjusted_date.strftime('%Y-%m-%d %H:%M:%S')
-                    formatted_text += f"[{date_str}]\n"
-                    formatted_text += f"{msg['sender']}: {msg['text']}\n"
-                    formatted_text += "-------------------\n"
-    
-    return formatted_text
+def format_messages(data, view_type='all', question=None, per_chat_limit=None, reserved=0):
+    with prompt_build_seconds.time(view=view_type):
+        return prompt_builder.build(data, view_type, question, per_chat_limit, reserved)
+
+async def reply_in_parts(message, text):
+    """Reply with text, sent as several messages when it is over Telegram's length limit"""
+    parts = split_message(text)
+    await bot.reply_to(message, parts[0])
+    for part in parts[1:]:
+        await bot.send_message(message.chat.id, part)
 
 @bot.message_handler(func=lambda message: message.text == 'View Recent Messages')
-def view_recent_messages(message):
+async def view_recent_messages(message):
     try:
-        # Send typing status
-        bot.send_chat_action(message.chat.id, 'typing')
-        
-        response = requests.get(f"{API_BASE_URL}/users")
-        print(f"Debug - Response status: {response.status_code}")  # Debug log
+        # Show typing while the messages are fetched
+        async with chat_actions.typing(message.chat.id):
+            data = await fetch_users()
         
-        if response.status_code == 200:
-            data = response.json()
-            messages_text = format_messages(data, view_type='recent')
-            bot.reply_to(message, messages_text)
+        if data is not None:
+            messages_text = format_messages(data, view_type='recent', per_chat_limit=view_messages_per_chat)
+            await reply_in_parts(message, messages_text)
         else:
-            bot.reply_to(message, "Failed to fetch messages. Please try again.")
+            await bot.reply_to(message, "Failed to fetch messages. Please try again.")
     except Exception as e:
         print(f"Debug - Error in view_recent_messages: {str(e)}")  # Debug log
-        bot.reply_to(message, f"An error occurred: {str(e)}")
+        await bot.reply_to(message, f"An error occurred: {str(e)}")
 
 @bot.message_handler(func=lambda message: message.text == 'View Unread Messages')
-def view_unread_messages(message):
+async def view_unread_messages(message):
     try:
-        # Send typing status
-        bot.send_chat_action(message.chat.id, 'typing')
-        
-        response = requests.get(f"{API_BASE_URL}/users")
-        print(f"Debug - Response status: {response.status_code}")  # Debug log
+        # Show typing while the messages are fetched
+        async with chat_actions.typing(message.chat.id):
+            data = await fetch_users()
         
-        if response.status_code == 200:
-            data = response.json()
-            messages_text = format_messages(data, view_type='unread')
+        if data is not None:
+            messages_text = format_messages(data, view_type='unread', per_chat_limit=view_messages_per_chat)
             print(messages_text)
-            bot.reply_to(message, messages_text)
+            await reply_in_parts(message, messages_text)
         else:
-            bot.reply_to(message, "Failed to fetch messages. Please try again.")
+            await bot.reply_to(message, "Failed to fetch messages. Please try again.")
     except Exception as e:
         print(f"Debug - Error in view_unread_messages: {str(e)}")  # Debug log
-        bot.reply_to(message, f"An error occurred: {str(e)}")
+        await bot.reply_to(message, f"An error occurred: {str(e)}")
 
 
 @bot.message_handler(commands=['ask'])
-def get_messages(message):
+async def get_messages(message):
     message_text = message.text
-    response = requests.get(f"{API_BASE_URL}/users")
+    response = await api_get("/users", params={"per_chat_limit": messages_per_chat})
     print(f"Debug - Response status in LLM call: {response.status_code}")  # Debug log
         
     if response.status_code == 200:
@@ -313,13 +368,13 @@ def get_messages(message):
         print(llm_response)
         print("#"*50)
         
-        bot.reply_to(message, llm_response)
+        await bot.reply_to(message, llm_response)
     else:
-        bot.reply_to(message, "Failed to fetch messages. Please try again.")
+        await bot.reply_to(message, "Failed to fetch messages. Please try again.")
 
 
 @bot.message_handler(func=lambda message: not message.text.startswith('/'))
-def handle_message(message):
+async def handle_message(message):
     user_state = get_user_state(message.from_user.id)
     
     # Check if user is logged in and trying to use menu commands
@@ -332,8 +387,7 @@ def handle_message(message):
         password = message.text.strip()
         print(f"Debug - Received 2FA password for phone {user_state.phone}")  # Debug log
         try:
-            response = requests.post(f"{API_BASE_URL}/submit-password",
-                                  json={"phone": user_state.phone, "password": password})
+            response = await api_post("/submit-password", json={"phone": user_state.phone, "password": password})
             print(f"Debug - 2FA response status: {response.status_code}")  # Debug log
             print(f"Debug - 2FA response data: {response.text}")  # Debug log
             
@@ -342,13 +396,13 @@ def handle_message(message):
                     response_data = response.json()
                     if response_data.get("status") == "LOGGED_IN":
                         user_state.waiting_for_2fa = False
-                        show_main_menu(message)
+                        await show_main_menu(message)
                     else:
                         error_message = response_data.get('error', 'Invalid password. Please try again.')
-                        bot.reply_to(message, error_message)
+                        await bot.reply_to(message, error_message)
                 except json.JSONDecodeError as e:
                     print(f"Debug - Error parsing response: {str(e)}")  # Debug log
-                    bot.reply_to(message, "Error processing server response. Please try again.")
+                    await bot.reply_to(message, "Error processing server response. Please try again.")
             else:
                 try:
                     error_data = response.json()
@@ -356,20 +410,44 @@ def handle_message(message):
                 except json.JSONDecodeError:
                     error_message = 'Invalid 2FA password. Please try again.'
                 print(f"Debug - Invalid 2FA password response: {error_message}")  # Debug log
-                bot.reply_to(message, error_message)
-        except requests.RequestException as e:
+                await bot.reply_to(message, error_message)
+        except API_ERRORS as e:
             print(f"Debug - Error submitting 2FA: {str(e)}")  # Debug log
-            bot.reply_to(message, "Connection error. Please try again later.")
+            await bot.reply_to(message, "Connection error. Please try again later.")
 
-def show_main_menu(message):
+async def show_main_menu(message):
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
     recent_messages_btn = types.KeyboardButton('View Recent Messages')
     unread_messages_btn = types.KeyboardButton('View Unread Messages')
     markup.add(recent_messages_btn, unread_messages_btn)
-    bot.reply_to(message, "What would you like to do?", reply_markup=markup)
+    await bot.reply_to(message, "What would you like to do?", reply_markup=markup)
+
 
 
+async def run_bot():
+    """Receive updates on the webhook when bot_webhook_url is set, by polling otherwise or if it fails"""
+    if live_view is not None:
+        live_view.start()
+    try:
+        if webhook_url:
+            try:
+                await run_webhook(bot)
+                return
+            except Exception as e:
+                print(f"Webhook mode failed, falling back to polling: {str(e)}")
+        # Telegram refuses getUpdates while a webhook is set, and would keep
+        # pushing to one nobody serves
+        await bot.delete_webhook()
+        await bot.polling(non_stop=True)
+    finally:
+        if live_view is not None:
+            await live_view.stop()
+        if api_session is not None:
+            await api_session.close()
+        await bot.close_session()
 
 if __name__ == "__main__":
     print("Starting Telegram bot...")
-    bot.polling(none_stop=True)
\ No newline at end of file
+    if os.getenv('bot_metrics_port'):
+        start_http_server(int(os.getenv('bot_metrics_port')))
+    asyncio.run(run_bot())
\ No newline at end of file
@@ -0,0 +1,261 @@
+import asyncio
+import json
+import os
+import sys
+from datetime import datetime, timezone
+from file_lock import FileLock
+from message_store import message_store
+from response_cache import SnapshotCache
+from serialization import dumps
+from telegram_sender import (
+    initiate_login, submit_code, submit_password, store_messages, iter_messages, client_pool
+)
+
+# Unix socket the Telegram owner process listens on; API workers started with
+# telegram_rpc_socket set send every Telegram call there
+rpc_socket_path = os.getenv('telegram_rpc_socket', os.path.join('sessions', 'telegram.sock'))
+rpc_timeout = float(os.getenv('telegram_rpc_timeout', 10 * 60))
+
+# Longest line (one message or result) either side accepts
+rpc_line_limit = 2 ** 24
+
+# One incremental sync per account per sync_ttl seconds, however many workers ask
+sync_ttl = float(os.getenv('users_cache_ttl', 30))
+
+
+class RPCError(Exception):
+    """A Telegram call failed in the owner process, or the owner could not be reached"""
+
+
+class LocalTelegram:
+    """
+    Telegram calls served by this process's client pool: the single worker
+    setup, and what the owner process runs on behalf of every API worker.
+    """
+
+    def __init__(self, sync_ttl=sync_ttl):
+        self.sync_cache = SnapshotCache(ttl=sync_ttl)
+
+    async def initiate_login(self, phone):
+        return await initiate_login(phone)
+
+    async def submit_code(self, phone, code):
+        return await submit_code(phone, code)
+
+    async def submit_password(self, phone, password):
+        return await submit_password(phone, password)
+
+    async def sync_account(self, phone, only_if_empty=False):
+        """
+        Incremental sync of an account; concurrent and repeated calls within
+        sync_ttl share one run. False when it failed, which is not cached, so
+        the next call tries again.
+        """
+        async def sync():
+            if not only_if_empty or not message_store.has_messages(phone):
+                # store_messages reports its errors and returns None
+                if await store_messages(phone=phone) is None:
+                    raise RPCError(f"Sync of {phone} failed")
+            return True
+        try:
+            return await self.sync_cache.get((phone, only_if_empty), sync)
+        except RPCError:
+            return False
+
+    async def sync_chat(self, phone, chat_id):
+        """Fetch one chat into the store; False when it failed"""
+        return await store_messages(chat_id, phone=phone) is not None
+
+    async def iter_messages(self, phone=None, since=None, limit=None):
+        """Messages as dicts while they are downloaded; since is a unix timestamp"""
+        if since is not None:
+            since = datetime.fromtimestamp(since, tz=timezone.utc)
+        async for record in iter_messages(since=since, limit=limit, phone=phone):
+            yield record.to_dict()
+
+    async def client_stats(self):
+        return client_pool.stats()
+
+    def start(self):
+        client_pool.start_maintenance()
+
+    async def close(self):
+        await client_pool.close_all()
+
+
+class RPCServer:
+    """
+    Serves a LocalTelegram over a unix socket, one newline-delimited JSON
+    request per connection: {"method", "params"} in, then {"result"} or
+    {"error"} out, or for streaming methods one {"item"} per value and a
+    closing {"end"}. Only one owner may run per socket; the lock file next
+    to it makes a second one fail at startup instead of stealing the socket.
+    """
+
+    methods = {"initiate_login", "submit_code", "submit_password", "sync_account", "sync_chat", "client_stats"}
+    streams = {"iter_messages"}
+
+    def __init__(self, telegram, path=rpc_socket_path):
+        self.telegram = telegram
+        self.path = path
+        self.lock = FileLock(path + ".lock")
+        self.server = None
+        self.requests = 0
+
+    async def write(self, writer, message):
+        writer.write(dumps(message) + b"\n")
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        self.requests += 1
+        request = None
+        try:
+            request = json.loads(await reader.readline())
+            method = request.get("method")
+            params = request.get("params") or {}
+            if method in self.streams:
+                async for item in getattr(self.telegram, method)(**params):
+                    await self.write(writer, {"item": item})
+                await self.write(writer, {"end": True})
+            elif method in self.methods:
+                result = await getattr(self.telegram, method)(**params)
+                await self.write(writer, {"result": result})
+            else:
+                await self.write(writer, {"error": f"Unknown method: {method}"})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # The worker went away, e.g. its HTTP client disconnected mid-export
+        except Exception as e:
+            print(f"Error serving {request.get('method') if isinstance(request, dict) else 'request'}: {str(e)}")
+            try:
+                await self.write(writer, {"error": str(e)})
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        if not self.lock.acquire():
+            raise RuntimeError(f"Telegram owner process {self.lock.holder()} is already serving {self.path}")
+        # A socket file left behind by an owner that crashed
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(self.handle, path=self.path, limit=rpc_line_limit)
+        os.chmod(self.path, 0o600)
+        self.telegram.start()
+        print(f"Serving Telegram calls on {self.path}")
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        await self.telegram.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.lock.release()
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+
+
+class RPCClient:
+    """
+    The LocalTelegram interface for API workers, each call forwarded to the
+    owner process. Every account's clients, login flows and syncs live
+    there, so any worker can serve any step of any login.
+    """
+
+    def __init__(self, path=rpc_socket_path, timeout=rpc_timeout):
+        self.path = path
+        self.timeout = timeout
+
+    async def open(self, method, params):
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.path, limit=rpc_line_limit)
+        except OSError as e:
+            raise RPCError(f"Telegram owner process is not reachable at {self.path}: {str(e)}")
+        writer.write(dumps({"method": method, "params": params}) + b"\n")
+        await writer.drain()
+        return reader, writer
+
+    async def read(self, reader):
+        line = await asyncio.wait_for(reader.readline(), self.timeout)
+        if not line:
+            raise RPCError("Telegram owner process closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise RPCError(response["error"])
+        return response
+
+    async def call(self, method, **params):
+        reader, writer = await self.open(method, params)
+        try:
+            return (await self.read(reader))["result"]
+        finally:
+            writer.close()
+
+    async def stream(self, method, **params):
+        reader, writer = await self.open(method, params)
+        try:
+            while True:
+                response = await self.read(reader)
+                if "end" in response:
+                    return
+                yield response["item"]
+        finally:
+            writer.close()
+
+    async def initiate_login(self, phone):
+        return await self.call("initiate_login", phone=phone)
+
+    async def submit_code(self, phone, code):
+        return await self.call("submit_code", phone=phone, code=code)
+
+    async def submit_password(self, phone, password):
+        return await self.call("submit_password", phone=phone, password=password)
+
+    async def sync_account(self, phone, only_if_empty=False):
+        return await self.call("sync_account", phone=phone, only_if_empty=only_if_empty)
+
+    async def sync_chat(self, phone, chat_id):
+        return await self.call("sync_chat", phone=phone, chat_id=chat_id)
+
+    def iter_messages(self, phone=None, since=None, limit=None):
+        return self.stream("iter_messages", phone=phone, since=since, limit=limit)
+
+    async def client_stats(self):
+        return await self.call("client_stats")
+
+    def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+async def run_owner(with_scheduler=False):
+    server = RPCServer(LocalTelegram())
+    tasks = [server.serve_forever()]
+    if with_scheduler:
+        # The scheduler needs the same sessions, so it has to share this process's pool
+        from sync_scheduler import SyncScheduler
+        tasks.append(SyncScheduler().run())
+    await asyncio.gather(*tasks)
+
+def main():
+    # python telegram_rpc.py [--scheduler]
+    metrics_port = os.getenv('owner_metrics_port')
+    if metrics_port:
+        import metrics
+        metrics.start_http_server(int(metrics_port))
+    try:
+        asyncio.run(run_owner("--scheduler" in sys.argv[1:]))
+    except KeyboardInterrupt:
+        print("\nTelegram owner process stopped")
+
+if __name__ == "__main__":
+    main()
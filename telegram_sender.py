@@ -1,10 +1,17 @@
-from telethon import TelegramClient
 import asyncio
 import os
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 import time
 import json
+from rate_limiter import RateLimiter
+from client_pool import ClientPool
+from message_store import message_store, to_timestamp
+from sender_cache import sender_cache
+from records import MessageRecord
+from text_normalizer import normalize_text
+import metrics
+from metrics import store_messages_seconds, sync_dialog_seconds, dialogs_skipped
 
 # Load environment variables from .env file
 load_dotenv()
@@ -21,6 +28,10 @@ specific_chat_id = None
 # specific_chat_id = 6836049135
 specific_chat_messages_limit = 100
 
+# Concurrent fetching: dialogs fetched at once and Telegram API requests per second
+fetch_concurrency = int(os.getenv('fetch_concurrency', 5))
+requests_per_second = float(os.getenv('requests_per_second', 5))
+
 # Access the variables
 api_id = os.getenv('api_id')
 api_hash = os.getenv('api_hash')
@@ -31,17 +42,30 @@ if not api_id or not api_hash:
 # Create sessions directory if it doesn't exist
 os.makedirs('sessions', exist_ok=True)
 
-# Store active clients
-clients = {}
+# Account scraped when no phone is given
+default_phone = os.getenv('default_phone', "+989164911318")
+
+# Connected clients shared by the login flow and the scraper
+client_pool = ClientPool(
+    api_id,
+    api_hash,
+    max_clients=int(os.getenv('max_clients', 20)),
+    idle_timeout=float(os.getenv('client_idle_timeout', 30 * 60)),
+    login_timeouts={
+        "code_sent": float(os.getenv('login_code_timeout', 5 * 60)),
+        "password_needed": float(os.getenv('login_password_timeout', 10 * 60))
+    }
+)
+
+metrics.callback("trok_telegram_clients", "Open pooled Telegram clients by login state",
+                 lambda: {(state,): count for state, count in client_pool.stats()["states"].items()}, ("state",))
+metrics.callback("trok_telegram_client_evictions_total", "Pooled clients disconnected, by reason",
+                 lambda: {(reason,): count for reason, count in client_pool.evictions.items()},
+                 ("reason",), kind="counter")
 
 async def get_client(phone):
     """Get or create a client for the given phone number"""
-    if phone not in clients:
-        session_name = f"sessions/{phone}"
-        client = TelegramClient(session_name, api_id, api_hash)
-        await client.connect()
-        clients[phone] = client
-    return clients[phone]
+    return await client_pool.get(phone)
 
 async def initiate_login(phone):
     """Start the login process for a phone number"""
@@ -49,9 +73,12 @@ async def initiate_login(phone):
         client = await get_client(phone)
         
         if await client.is_user_authorized():
+            client_pool.set_login_state(phone, "authorized")
             return {"status": "ALREADY_LOGGED_IN"}
         
+        client_pool.set_login_state(phone, "new")
         await client.send_code_request(phone)
+        client_pool.set_login_state(phone, "code_sent")
         return {"status": "WAITING_FOR_CODE"}
     except Exception as e:
         return {"error": str(e)}
@@ -59,14 +86,19 @@ async def initiate_login(phone):
 async def submit_code(phone, code):
     """Submit the verification code"""
     try:
+        # The code only works on the client that requested it
+        if client_pool.login_state(phone) != "code_sent":
+            return {"error": "Login expired. Please start the login again."}
         client = await get_client(phone)
         
         try:
             await client.sign_in(phone, code)
+            client_pool.set_login_state(phone, "authorized")
             return {"status": "LOGGED_IN"}
         except Exception as e:
             error_msg = str(e)
             if "password" in error_msg.lower():
+                client_pool.set_login_state(phone, "password_needed")
                 return {
                     "status": "NEED_PASSWORD",
                     "message": "Two-factor authentication is enabled. Please enter your Telegram password."
@@ -78,10 +110,13 @@ async def submit_code(phone, code):
 async def submit_password(phone, password):
     """Submit the 2FA password"""
     try:
+        if client_pool.login_state(phone) != "password_needed":
+            return {"error": "Login expired. Please start the login again."}
         client = await get_client(phone)
         
         try:
             await client.sign_in(password=password)
+            client_pool.set_login_state(phone, "authorized")
             return {"status": "LOGGED_IN"}
         except Exception as e:
             return {"error": str(e)}
@@ -90,18 +125,12 @@ async def submit_password(phone, password):
 
 def get_sender_info(message):
     """Fast method to get sender information"""
-    sender = message.sender
-    if not sender:
-        return ""
-        
-    # Get basic info without additional API calls
-    info = []
-    if sender.first_name:
-        info.append(sender.first_name)
-    if sender.last_name:
-        info.append(sender.last_name)
-        
-    return " ".join(info)
+    # Resolved once per sender through the cache, without additional API calls
+    return sender_cache.name_for(message)
+
+def is_private_chat(dialog):
+    """Private chats with people, the only dialogs the scraper reads"""
+    return dialog.is_user and not (hasattr(dialog.entity, 'bot') and dialog.entity.bot)
 
 def format_time(seconds):
     """Format seconds into a human-readable string"""
@@ -114,182 +143,323 @@ def format_time(seconds):
         hours = seconds / 3600
         return f"{hours:.2f} hours"
 
-async def store_messages(chat_id=None):
+def message_row(chat_id, message):
+    """Message columns for the message store"""
+    return {
+        "chat_id": chat_id,
+        "message_id": message.id,
+        "sender_id": message.sender_id,
+        "out": int(bool(message.out)),
+        "text": message.text,
+        "text_norm": normalize_text(message.text),
+        "date": to_timestamp(message.date),
+        "edit_date": to_timestamp(message.edit_date)
+    }
+
+def save_messages(account, chat_id, messages):
+    """Upsert the text messages and their senders into the message store"""
+    rows = []
+    senders = {}
+    for message in messages:
+        try:
+            if message.text:
+                rows.append(message_row(chat_id, message))
+                if message.sender:
+                    senders[message.sender.id] = message.sender
+        except Exception as e:
+            print(f"Error processing message in chat {chat_id}: {str(e)}")
+            continue
+    
+    # Only new, renamed or stale senders are written
+    sender_cache.update(senders.values())
+    if rows:
+        message_store.upsert_messages(account, rows)
+    return len(rows)
+
+def dialog_row(dialog, safe_name, last_message_id):
+    """Dialog columns for the message store"""
+    return {
+        "chat_id": dialog.id,
+        "name": dialog.name,
+        "safe_name": safe_name,
+        "unread_count": dialog.unread_count,
+        "read_inbox_max_id": dialog.dialog.read_inbox_max_id,
+        "top_message_id": dialog.message.id if dialog.message else 0,
+        "last_message_id": last_message_id,
+        "last_message_date": to_timestamp(dialog.date)
+    }
+
+def unread_in(dialog, messages):
+    """The incoming messages of a dialog that are newer than its read marker"""
+    read_inbox_max_id = dialog.dialog.read_inbox_max_id
+    return [message for message in messages if message.id > read_inbox_max_id and not message.out]
+
+async def fetch_missing_unread(client, limiter, account, dialog, latest_messages, min_id):
+    """
+    Fetch unread messages the latest fetch did not reach.
+    Only needed when the dialog has more unread messages than the latest
+    fetch returned and that fetch stopped before reaching the read marker.
+    """
+    wanted = min(dialog.unread_count, unread_messages_limit)
+    found = len(unread_in(dialog, latest_messages))
+    oldest_fetched = min((message.id for message in latest_messages), default=0)
+    floor = max(dialog.dialog.read_inbox_max_id, min_id)
+    
+    if found >= wanted or len(latest_messages) < latest_messages_limit or oldest_fetched <= floor + 1:
+        return
+    
+    print(f"Found {dialog.unread_count} unread messages, fetching {wanted - found} older ones")
+    unread_messages = await limiter.call(
+        client.get_messages,
+        dialog.id,
+        limit=wanted - found,
+        max_id=oldest_fetched,
+        min_id=floor
+    )
+    save_messages(account, dialog.id, unread_messages)
+
+async def sync_dialog(client, limiter, account, dialog, safe_name, previous_state):
+    """
+    Sync one dialog against its high-water mark in the message store.
+    Returns True when the dialog was unchanged and no messages were fetched.
+    """
+    top_message_id = dialog.message.id if dialog.message else 0
+    
+    if previous_state and previous_state["top_message_id"] == top_message_id:
+        # Nothing new in this dialog since the last sync, only refresh its read state
+        message_store.upsert_dialog(account, dialog_row(dialog, safe_name, previous_state["last_message_id"]))
+        return True
+    
+    # Process latest messages, only asking for the ones newer than the high-water mark
+    min_id = previous_state["last_message_id"] if previous_state else 0
+    latest_messages = await limiter.call(
+        client.get_messages,
+        dialog.id,
+        limit=latest_messages_limit,
+        min_id=min_id
+    )
+    
+    save_messages(account, dialog.id, latest_messages)
+    print(f"Processed {len(latest_messages)} latest messages from {dialog.name}")
+    
+    # Unread messages are the latest ones past the read marker, only fetch what that missed
+    if dialog.unread_count > 0:
+        await fetch_missing_unread(client, limiter, account, dialog, latest_messages, min_id)
+    
+    last_message_id = max((message.id for message in latest_messages), default=min_id)
+    message_store.upsert_dialog(account, dialog_row(dialog, safe_name, last_message_id))
+    return False
+
+async def sync_chat(phone, dialog_state, limiter):
+    """
+    Poll one stored dialog for messages newer than its high-water mark,
+    without listing dialogs. Returns the number of new messages.
+    """
+    chat_id = dialog_state["chat_id"]
+    async with client_pool.use(phone) as client:
+        latest_messages = await limiter.call(
+            client.get_messages,
+            chat_id,
+            limit=latest_messages_limit,
+            min_id=dialog_state["last_message_id"]
+        )
+    
+    new_count = 0
+    if latest_messages:
+        # Record the new messages like live updates so the top message and unread count move forward
+        save_messages(phone, chat_id, latest_messages)
+        message_store.write_batch(phone, activity=[
+            {
+                "chat_id": chat_id,
+                "name": dialog_state["name"],
+                "safe_name": dialog_state["safe_name"],
+                "message_id": message.id,
+                "date": to_timestamp(message.date),
+                "incoming": int(not message.out)
+            }
+            for message in latest_messages
+        ])
+        new_count = len(latest_messages)
+    message_store.mark_synced(phone, [chat_id])
+    return new_count
+
+async def store_messages(chat_id=None, phone=None, limiter=None):
     """
     Store messages from a specific chat or process all chats
     chat_id: Optional ID of a specific chat to process. If None, processes all chats as before.
+    phone: Account to read from, defaults to default_phone. Its client stays connected in client_pool.
+    limiter: Optional RateLimiter shared with other syncs; a fresh one is used otherwise.
     """
     start_time = time.time()
     print(f"Starting message collection at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     
+    phone = phone or default_phone
+    
     try:
-        # Initialize the client
-        session_name = "+989164911318"
-        client = TelegramClient(session_name, api_id, api_hash)
-        
-        # Start the client
-        await client.start()
-        
-        # Create messages directory if it doesn't exist
-        os.makedirs('messages', exist_ok=True)
+        with store_messages_seconds.time(mode="all" if chat_id is None else "chat"):
+            async with client_pool.use(phone) as client:
+                if not await client.is_user_authorized():
+                    print(f"Account {phone} is not logged in")
+                    return None
+                
+                return await collect_messages(client, phone, chat_id, start_time, limiter)
+    
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+
+async def collect_messages(client, account, chat_id, start_time, limiter=None):
+    """
+    Collect messages with an already connected and authorized client into the
+    store. Returns a summary, {"chats", "messages"} for one chat and
+    {"chats", "skipped"} for all of them; readers load from the store.
+    """
+    if chat_id is not None:
+        # Process specific chat
+        try:
+            messages = await client.get_messages(chat_id, limit=specific_chat_messages_limit)
+            if messages:
+                save_messages(account, chat_id, messages)
+            summary = {"chats": 1, "messages": len(messages or [])}
+            
+        except Exception as e:
+            print(f"Error processing chat {chat_id}: {str(e)}")
+            summary = None
+            
+    else:
+        # Regular process for all chats
+        # High-water marks from the previous sync
+        sync_state = message_store.get_dialog_states(account)
         
-        # Initialize JSON structure
-        messages_data = {
-            "messages": {
-                "most_recent": {},
-                "unread": {}
-            }
-        }
+        # Collect the top chats first, then fetch them concurrently
+        dialogs = []
         
-        if chat_id is not None:
-            # Process specific chat
-            try:
-                messages_data = []
-                # Get the chat entity
-                safe_name = "".join(c for c in str(chat_id) if c.isalnum()).rstrip()
-                # safe_name = "".join(c for c in str(chat_id) if c.isalnum() or c in (' ', '-', '_')).rstrip()
+        # Get all dialogs (chats, channels, groups)
+        async for dialog in client.iter_dialogs():
+            if len(dialogs) >= max(unread_chats_limit, latest_chats_limit):
+                break
                 
-                # Get all messages
-                messages = await client.get_messages(chat_id, limit=specific_chat_messages_limit)
+            # Skip non-private chats and bots
+            if not is_private_chat(dialog):
+                continue
                 
-                if messages:
-                    # Initialize chat messages array
-                    # messages_data[safe_name] = []
-                    
-                    for message in messages[::-1]:
-                        try:
-                            sender_info = get_sender_info(message)
-                            if message.text:
-                                message_data = {
-                                    "sender": sender_info,
-                                    "message": message.text,
-                                    "date": str(message.date)
-                                }
-                                messages_data.append(message_data)
-                                # messages_data[safe_name].append(message_data)
-                        except Exception as e:
-                            print(f"Error processing message: {str(e)}")
-                            continue
-                    
-                    # Write to JSON file
-                    filename = f"messages/{safe_name}.json"
-                    with open(filename, 'w', encoding='utf-8') as f:
-                        json.dump(messages_data, f, ensure_ascii=False, indent=4)
-                return messages_data
-                
-            except Exception as e:
-                print(f"Error processing chat {chat_id}: {str(e)}")
-                
-        else:
-            # Regular process for all chats
-            # Counter for top chats
-            chat_count = 0
-            
-            # Get all dialogs (chats, channels, groups)
-            async for dialog in client.iter_dialogs():
-                if chat_count >= max(unread_chats_limit, latest_chats_limit):
-                    break
-                    
+            safe_name = "".join(c for c in dialog.name if c.isalnum()).rstrip()
+            # safe_name = "".join(c for c in dialog.name if c.isalnum() or c in (' ', '-', '_')).rstrip()
+            dialogs.append((dialog, safe_name))
+        
+        # Every private chat's entity is one of its senders
+        sender_cache.warm(dialog for dialog, _ in dialogs)
+        
+        limiter = limiter or RateLimiter(requests_per_second)
+        semaphore = asyncio.Semaphore(fetch_concurrency)
+        
+        async def process_dialog(dialog, safe_name):
+            async with semaphore:
+                dialog_start = time.time()
                 try:
-                    # Skip non-private chats and bots
-                    if not dialog.is_user or (hasattr(dialog.entity, 'bot') and dialog.entity.bot):
-                        continue
-                        
-                    safe_name = "".join(c for c in dialog.name if c.isalnum()).rstrip()
-                    # safe_name = "".join(c for c in dialog.name if c.isalnum() or c in (' ', '-', '_')).rstrip()
-                    
-                    # Process unread messages
-                    if dialog.unread_count > 0:
-                        print(f"Found {dialog.unread_count} unread messages")
-                        
-                        # Get unread messages
-                        unread_messages = await client.get_messages(
-                            dialog.id,
-                            limit=min(dialog.unread_count, unread_messages_limit)
-                        )
-                        
-                        if unread_messages:
-                            # Initialize unread messages array for this chat
-                            messages_data["messages"]["unread"][safe_name] = []
-                            
-                            for message in unread_messages[::-1]:
-                                try:
-                                    sender_info = get_sender_info(message)
-                                    if message.text:
-                                        message_data = {
-                                            "sender": sender_info,
-                                            "text": message.text,
-                                            "date": str(message.date)
-                                        }
-                                        messages_data["messages"]["unread"][safe_name].append(message_data)
-                                except Exception as e:
-                                    print(f"Error processing unread message in {dialog.name}: {str(e)}")
-                                    continue
-                            
-                            print(f"Processed {len(unread_messages)} unread messages from {dialog.name}")
-                    
-                    # Process latest messages
-                    latest_messages = await client.get_messages(
-                        dialog.id,
-                        limit=latest_messages_limit
+                    skipped = await sync_dialog(
+                        client, limiter, account, dialog, safe_name, sync_state.get(dialog.id)
                     )
-                    
-                    if latest_messages:
-                        # Initialize most recent messages array for this chat
-                        messages_data["messages"]["most_recent"][safe_name] = []
-                        
-                        for message in latest_messages[::-1]:
-                            try:
-                                sender_info = get_sender_info(message)
-                                if message.text:
-                                    message_data = {
-                                        "name": sender_info,
-                                        "text": message.text,
-                                        "date": str(message.date)
-                                    }
-                                    messages_data["messages"]["most_recent"][safe_name].append(message_data)
-                            except Exception as e:
-                                print(f"Error processing latest message in {dialog.name}: {str(e)}")
-                                continue
-                        
-                        print(f"Processed {len(latest_messages)} latest messages from {dialog.name}")
-                    
-                    chat_count += 1
-                        
                 except Exception as e:
                     print(f"Error processing chat {dialog.name}: {str(e)}")
-                    continue
-            
-            # Write all messages to a single JSON file
-            filename = "messages/all_messages.json"
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(messages_data, f, ensure_ascii=False, indent=4)
+                    skipped = False
+                elapsed = time.time() - dialog_start
+                sync_dialog_seconds.observe(elapsed)
+                if skipped:
+                    dialogs_skipped.inc()
+                return skipped, elapsed
         
-        # Disconnect the client
-        await client.disconnect()
+        results = await asyncio.gather(*(process_dialog(dialog, safe_name) for dialog, safe_name in dialogs))
         
-        # Calculate and display total time
-        end_time = time.time()
-        total_time = end_time - start_time
-        print(f"\nProcess completed at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        print(f"Total execution time: {format_time(total_time)}")
-        print("All messages have been stored in JSON format")
-        return messages_data
+        skipped_count = sum(skipped for skipped, _ in results)
+        dialog_times = [(dialog.name, elapsed) for (dialog, _), (_, elapsed) in zip(dialogs, results)]
+        
+        print(f"Skipped {skipped_count} unchanged chats")
+        print(f"Telegram API calls: {limiter.calls}, FloodWaits: {limiter.flood_waits} "
+              f"({format_time(limiter.flood_wait_seconds)})")
+        for name, elapsed in sorted(dialog_times, key=lambda item: item[1], reverse=True):
+            print(f"  {name}: {format_time(elapsed)}")
+        
+        summary = {"chats": len(dialogs), "skipped": skipped_count}
     
-    except Exception as e:
-        print(f"An error occurred: {str(e)}")
-    finally:
-        # Ensure the client is disconnected
-        if 'client' in locals():
-            await client.disconnect()
+    # Calculate and display total time
+    end_time = time.time()
+    total_time = end_time - start_time
+    print(f"\nProcess completed at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    print(f"Total execution time: {format_time(total_time)}")
+    print(f"All messages have been stored in {message_store.path}")
+    return summary
+
+async def iter_messages(dialog_filter=None, since=None, limit=None, phone=None):
+    """
+    Yield MessageRecords dialog by dialog as they are downloaded, newest first within each chat.
+    dialog_filter: Optional callable taking a dialog, defaults to private chats with people.
+    since: Optional timezone-aware datetime, older messages are not fetched.
+    limit: Maximum messages per chat, defaults to latest_messages_limit.
+    Only one page of messages is held in memory at a time.
+    """
+    phone = phone or default_phone
+    limit = latest_messages_limit if limit is None else limit
+    dialog_filter = dialog_filter or is_private_chat
     
+    async with client_pool.use(phone) as client:
+        if not await client.is_user_authorized():
+            print(f"Account {phone} is not logged in")
+            return
+        
+        chat_count = 0
+        async for dialog in client.iter_dialogs():
+            if chat_count >= max(unread_chats_limit, latest_chats_limit):
+                break
+            if not dialog_filter(dialog):
+                continue
+            chat_count += 1
+            
+            # The whole dialog is older than requested
+            if since is not None and dialog.date and dialog.date < since:
+                continue
+            
+            async for message in client.iter_messages(dialog.id, limit=limit):
+                if since is not None and message.date < since:
+                    break
+                if not message.text:
+                    continue
+                yield MessageRecord(
+                    id=message.id,
+                    chat_id=dialog.id,
+                    sender_id=message.sender_id or 0,
+                    date=to_timestamp(message.date),
+                    text=message.text,
+                    sender=get_sender_info(message),
+                    chat=dialog.name,
+                    out=bool(message.out)
+                )
+
+async def write_ndjson(records, path):
+    """Write MessageRecords from an async iterator to an NDJSON file as they arrive"""
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        async for record in records:
+            f.write(json.dumps(record.to_dict(), ensure_ascii=False))
+            f.write("\n")
+            count += 1
+    return count
+
+async def run_once(chat_id=None):
+    """Run a single sync and disconnect the pooled clients afterwards"""
+    try:
+        return await store_messages(chat_id)
+    finally:
+        await client_pool.close_all()
+
 def main():
     # Run the async function to store messages
     # For specific chat:
-    # asyncio.run(store_messages(chat_id=123456789))  # Replace with actual chat ID
+    # asyncio.run(run_once(chat_id=123456789))  # Replace with actual chat ID
     # For all chats:
-    asyncio.run(store_messages(specific_chat_id))
-    # asyncio.run(store_messages())
+    asyncio.run(run_once(specific_chat_id))
+    # asyncio.run(run_once())
+    # Stream every chat to an NDJSON file instead:
+    # asyncio.run(write_ndjson(iter_messages(), "messages/messages.ndjson"))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
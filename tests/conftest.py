@@ -0,0 +1,14 @@
+import os
+import sys
+import tempfile
+
+# The modules read their settings when imported: point the store at a scratch
+# directory and give Telethon dummy credentials before any test imports them
+store_dir = tempfile.mkdtemp(prefix="trok-tests-")
+os.environ.setdefault("message_store_path", os.path.join(store_dir, "messages.db"))
+os.environ.setdefault("api_id", "1")
+os.environ.setdefault("api_hash", "test")
+os.environ.setdefault("embedding_backend", "none")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
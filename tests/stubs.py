@@ -0,0 +1,81 @@
+import types
+from datetime import datetime, timedelta, timezone
+
+start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+class Sender:
+    def __init__(self, sender_id):
+        self.id = sender_id
+        self.first_name = f"User{sender_id}"
+        self.last_name = None
+        self.bot = False
+
+
+class Message:
+    def __init__(self, message_id, chat_id, out=False, text=None):
+        self.id = message_id
+        self.chat_id = chat_id
+        self.sender_id = chat_id
+        self.sender = Sender(chat_id)
+        self.text = text or f"hello {message_id}"
+        self.out = out
+        self.date = start + timedelta(minutes=message_id)
+        self.edit_date = None
+
+
+class Dialog:
+    def __init__(self, chat_id, messages, unread_count):
+        self.id = chat_id
+        self.name = f"Chat{chat_id}"
+        self.is_user = True
+        self.entity = Sender(chat_id)
+        self.unread_count = unread_count
+        self.message = messages[-1] if messages else None
+        self.date = self.message.date if self.message else None
+        self.dialog = types.SimpleNamespace(read_inbox_max_id=len(messages) - unread_count)
+
+
+class FakeClient:
+    """Telethon client stand-in serving chats of numbered messages and recording get_messages calls"""
+
+    def __init__(self):
+        self.chats = {}
+        self.unread = {}
+        self.calls = []
+
+    def add(self, chat_id, count, unread=0):
+        self.chats[chat_id] = [Message(message_id, chat_id) for message_id in range(1, count + 1)]
+        self.unread[chat_id] = unread
+
+    def append(self, chat_id, count=1):
+        messages = self.chats[chat_id]
+        for _ in range(count):
+            messages.append(Message(len(messages) + 1, chat_id))
+
+    async def iter_dialogs(self, limit=None):
+        for chat_id, messages in list(self.chats.items())[:limit]:
+            yield Dialog(chat_id, messages, self.unread[chat_id])
+
+    async def get_messages(self, chat, limit=100, min_id=0, max_id=0, ids=None):
+        self.calls.append({"chat": chat, "limit": limit, "min_id": min_id, "max_id": max_id})
+        messages = [m for m in self.chats[chat] if m.id > min_id and (not max_id or m.id < max_id)]
+        return list(reversed(messages))[:limit]
+
+    async def connect(self):
+        pass
+
+    async def start(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+    def is_connected(self):
+        return True
+
+    async def is_user_authorized(self):
+        return True
+
+    async def get_me(self):
+        return Sender(1)
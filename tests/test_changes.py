@@ -0,0 +1,28 @@
+import time
+from message_store import MessageStore, changes_retention
+
+
+def add_change(store, age):
+    with store.connect() as connection:
+        connection.execute(
+            "INSERT INTO changes (account, kind, chat_id, message_id, created_at) VALUES ('+1', 'new', 1, 1, ?)",
+            (int(time.time()) - age,)
+        )
+
+
+def change_count(store):
+    return store.connect().execute("SELECT COUNT(*) FROM changes").fetchone()[0]
+
+
+def test_change_log_is_pruned_while_running(tmp_path):
+    store = MessageStore(str(tmp_path / "messages.db"))
+    add_change(store, changes_retention + 60)
+    add_change(store, 0)
+
+    # Pruned at most once per changes_prune_interval after the prune on connect
+    assert store.prune_changes() == 0
+    store.pruned_at -= 24 * 3600
+    assert store.prune_changes() == 1
+    assert change_count(store) == 1
+    assert store.cursor_expired(0)
+    store.close()
@@ -0,0 +1,26 @@
+import asyncio
+from chat_actions import ChatActionScheduler
+from metrics import telegram_flood_waits
+
+
+class TooManyRequests(Exception):
+    error_code = 429
+    result_json = {"parameters": {"retry_after": 1}}
+
+
+def test_bot_api_429_is_not_counted_as_a_flood_wait():
+    mtproto_before = telegram_flood_waits.get(api="mtproto")
+    bot_before = telegram_flood_waits.get(api="bot")
+
+    async def send(chat_id, action):
+        raise TooManyRequests()
+
+    async def run():
+        scheduler = ChatActionScheduler(send, rate=100)
+        async with scheduler.typing(1):
+            await asyncio.sleep(0.05)
+        return scheduler.limiter.flood_waits
+
+    assert asyncio.run(run()) == 1
+    assert telegram_flood_waits.get(api="bot") == bot_before + 1
+    assert telegram_flood_waits.get(api="mtproto") == mtproto_before
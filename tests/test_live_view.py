@@ -0,0 +1,70 @@
+import asyncio
+import json
+import aiohttp
+from aiohttp import web
+from live_view import LiveView
+
+
+def event(seq, kind, chat, message_id, text=None, out=False):
+    data = {"type": kind, "chat": chat, "id": message_id, "out": out,
+            "sender": "Sender", "text": text, "date": "2024-01-01 12:00:00+00:00", "ts": 1704110400 + message_id}
+    return f"id: {seq}\nevent: {kind}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+
+
+def test_follows_the_stream_over_the_shared_session():
+    streams = []
+    done = None
+
+    async def read_users(request):
+        body = {"messages": {
+            "most_recent": {"Chat": [{"id": 1, "sender": "Sender", "text": "one",
+                                      "date": "2024-01-01 12:00:00+00:00", "ts": 1704110401}]},
+            "unread": {"Chat": [{"id": 1, "sender": "Sender", "text": "one",
+                                 "date": "2024-01-01 12:00:00+00:00", "ts": 1704110401}]},
+        }}
+        return web.json_response(body, headers={"X-Stream-Cursor": "7"})
+
+    async def stream(request):
+        streams.append(request.query["cursor"])
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await response.write(b": keep-alive\n\n")
+        await response.write(event(8, "new", "Chat", 2, "two"))
+        await response.write(event(9, "edit", "Chat", 1, "one, edited"))
+        await response.write(event(10, "read", "Chat", 1))
+        await done.wait()
+        return response
+
+    async def run():
+        nonlocal done
+        done = asyncio.Event()
+        app = web.Application()
+        app.router.add_get("/users", read_users)
+        app.router.add_get("/stream", stream)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        async with aiohttp.ClientSession() as session:
+            async def get_session():
+                return session
+
+            view = LiveView(f"http://127.0.0.1:{port}", 5, get_session, reconnect_delay=0.1)
+            view.start()
+            for _ in range(100):
+                if view.cursor == 10:
+                    break
+                await asyncio.sleep(0.02)
+            snapshot = view.snapshot()["messages"]
+            await view.stop()
+        done.set()
+        await runner.cleanup()
+        return view, snapshot
+
+    view, snapshot = asyncio.run(run())
+    assert streams == ["7"]
+    assert view.ready
+    assert [message.text for message in snapshot["most_recent"]["Chat"]] == ["two", "one, edited"]
+    assert [message.id for message in snapshot["unread"]["Chat"]] == [2]
@@ -0,0 +1,70 @@
+import asyncio
+from fastapi.testclient import TestClient
+from telethon import TelegramClient
+from telethon.sessions import StringSession
+from telethon.tl.functions.help import GetConfigRequest
+from telethon.tl.functions.updates import GetStateRequest
+import main
+from client_pool import CountingTelegramClient
+from metrics import Counter, Gauge, Histogram, Registry, content_type, telegram_api_calls
+
+
+def test_render_follows_the_text_exposition_format():
+    registry = Registry()
+    calls = registry.register(Counter("test_calls_total", "Calls made", ("method",)))
+    depth = registry.register(Gauge("test_depth", "Queue depth"))
+    calls.inc(method='say "hi"\n')
+    calls.inc(2, method="plain")
+    depth.set(1.5)
+
+    assert registry.render() == (
+        "# HELP test_calls_total Calls made\n"
+        "# TYPE test_calls_total counter\n"
+        'test_calls_total{method="say \\"hi\\"\\n"} 1\n'
+        'test_calls_total{method="plain"} 2\n'
+        "# HELP test_depth Queue depth\n"
+        "# TYPE test_depth gauge\n"
+        "test_depth 1.5\n"
+    )
+
+
+def test_histogram_buckets_are_cumulative_and_inclusive():
+    registry = Registry()
+    latency = registry.register(Histogram("test_seconds", "Latency", ("endpoint",), buckets=(0.1, 1, 10)))
+    for value in (0.05, 0.1, 0.5, 1, 20):
+        latency.observe(value, endpoint="users")
+
+    lines = registry.render().splitlines()
+    assert lines[1] == "# TYPE test_seconds histogram"
+    assert lines[2:] == [
+        'test_seconds_bucket{endpoint="users",le="0.1"} 2',
+        'test_seconds_bucket{endpoint="users",le="1"} 4',
+        'test_seconds_bucket{endpoint="users",le="10"} 4',
+        'test_seconds_bucket{endpoint="users",le="+Inf"} 5',
+        'test_seconds_sum{endpoint="users"} 21.65',
+        'test_seconds_count{endpoint="users"} 5',
+    ]
+    assert latency.get(endpoint="users") == (5, 21.65)
+
+
+def test_metrics_endpoint():
+    with TestClient(main.app) as client:
+        response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == content_type
+    assert "# TYPE trok_telegram_api_calls_total counter" in response.text
+    assert "# TYPE trok_query_seconds histogram" in response.text
+
+
+def test_every_client_request_is_counted(monkeypatch):
+    async def sent(self, request, ordered=False, flood_sleep_threshold=None):
+        return request
+
+    monkeypatch.setattr(TelegramClient, "__call__", sent)
+    client = CountingTelegramClient(StringSession(), 1, "hash")
+    before = telegram_api_calls.get(method="GetConfigRequest"), telegram_api_calls.get(method="GetStateRequest")
+
+    asyncio.run(client(GetConfigRequest()))
+    asyncio.run(client([GetConfigRequest(), GetStateRequest()]))
+    assert telegram_api_calls.get(method="GetConfigRequest") == before[0] + 2
+    assert telegram_api_calls.get(method="GetStateRequest") == before[1] + 1
@@ -0,0 +1,126 @@
+import time
+import pytest
+from fastapi.testclient import TestClient
+import client_pool
+import main
+import telegram_sender
+from main import UsersQuery, build_page
+from message_store import message_store, decode_cursor
+from stubs import FakeClient
+
+account = "+10000000001"
+chat_id = 42
+
+
+@pytest.fixture(autouse=True)
+def sessions_dir(tmp_path, monkeypatch):
+    """Session files of the API's clients go to a scratch directory, not sessions/"""
+    monkeypatch.setattr(telegram_sender.client_pool, "sessions_dir", str(tmp_path))
+
+
+def store_chat(count):
+    message_store.write_batch(
+        account,
+        senders=[{"sender_id": chat_id, "first_name": "Ali", "last_name": None}],
+        messages=[
+            {"chat_id": chat_id, "message_id": message_id, "sender_id": chat_id, "out": 0,
+             "text": f"hello {message_id}", "text_norm": f"hello {message_id}",
+             "date": 1_700_000_000 + message_id * 60, "edit_date": None}
+            for message_id in range(1, count + 1)
+        ],
+        activity=[{"chat_id": chat_id, "name": "Ali", "safe_name": "Ali", "message_id": count,
+                   "date": 1_700_000_000 + count * 60, "incoming": 1}]
+    )
+
+
+def page_ids(query):
+    most_recent, _, next_cursor = build_page(account, query)
+    return [record.id for record in most_recent.get("Ali", [])], next_cursor
+
+
+def test_users_pages_forward_without_overlap():
+    store_chat(10)
+    ids, cursor = page_ids(UsersQuery(limit=3, chat=chat_id, after=(0, 0, 0)))
+    seen = []
+    while True:
+        assert ids == sorted(ids, reverse=True)
+        seen.extend(reversed(ids))
+        if cursor is None:
+            break
+        ids, cursor = page_ids(UsersQuery(limit=3, chat=chat_id, after=decode_cursor(cursor)))
+    assert seen == list(range(1, 11))
+
+
+def test_users_pages_backward_without_overlap():
+    store_chat(10)
+    ids, cursor = page_ids(UsersQuery(limit=4, chat=chat_id))
+    seen = list(ids)
+    while cursor is not None:
+        ids, cursor = page_ids(UsersQuery(limit=4, chat=chat_id, before=decode_cursor(cursor)))
+        seen.extend(ids)
+    assert seen == list(range(10, 0, -1))
+
+
+def test_user_next_cursor_pages_forward():
+    store_chat(10)
+    with TestClient(main.app) as client:
+        response = client.get(f"/users/{chat_id}", params={"phone": account, "limit": 4, "after": "0_0_0"})
+        seen = []
+        while True:
+            seen.extend(reversed([message["id"] for message in response.json()]))
+            cursor = response.headers.get("x-next-cursor")
+            if cursor is None:
+                break
+            response = client.get(f"/users/{chat_id}", params={"phone": account, "limit": 4, "after": cursor})
+    assert seen == list(range(1, 11))
+
+
+def test_cursor_pages_are_not_cached(monkeypatch):
+    # /users syncs the account first, against a client with nothing new
+    monkeypatch.setattr(client_pool, "CountingTelegramClient", lambda *args, **kwargs: FakeClient())
+    store_chat(10)
+    main.users_cache.invalidate()
+    with TestClient(main.app) as client:
+        first = client.get("/users", params={"phone": account, "chat": chat_id, "limit": 3})
+        cursor = first.json()["next_cursor"]
+        for _ in range(3):
+            response = client.get("/users", params={"phone": account, "chat": chat_id, "limit": 3, "before": cursor})
+            cursor = response.json()["next_cursor"]
+    assert [key for key in main.users_cache.entries if key[0] == account] == [
+        (account, UsersQuery(limit=3, chat=chat_id))
+    ]
+
+
+def revalidated(client, params, etag):
+    """First response with a body after the cached snapshot, served stale once, is refreshed"""
+    for _ in range(50):
+        response = client.get("/users", params=params, headers={"If-None-Match": etag})
+        if response.status_code == 200:
+            return response
+        time.sleep(0.02)
+    return response
+
+
+def test_renames_change_the_etag(monkeypatch):
+    monkeypatch.setattr(client_pool, "CountingTelegramClient", lambda *args, **kwargs: FakeClient())
+    store_chat(3)
+    main.users_cache.invalidate()
+    with TestClient(main.app) as client:
+        params = {"phone": account, "chat": chat_id}
+        etag = client.get("/users", params=params).headers["etag"]
+        assert client.get("/users", params=params, headers={"If-None-Match": etag}).status_code == 304
+
+        message_store.upsert_senders([{"sender_id": chat_id, "first_name": "Ali", "last_name": "Rezaei"}])
+        response = revalidated(client, params, etag)
+        assert response.status_code == 200 and response.headers["etag"] != etag
+        assert {message["sender"] for message in response.json()["messages"]["most_recent"]["Ali"]} == {"Ali Rezaei"}
+
+        etag = response.headers["etag"]
+        with message_store.connect() as connection:
+            connection.execute(
+                "UPDATE dialogs SET name = 'Ali R', safe_name = 'AliR' WHERE account = ? AND chat_id = ?",
+                (account, chat_id)
+            )
+        response = revalidated(client, params, etag)
+        assert response.status_code == 200 and response.headers["etag"] != etag
+        assert list(response.json()["messages"]["most_recent"]) == ["AliR"]
@@ -0,0 +1,28 @@
+from zoneinfo import ZoneInfo
+from prompt_builder import PromptBuilder
+from records import users_batches
+
+
+def users_body():
+    return {"messages": {
+        "most_recent": {"Alice": [
+            {"id": 2, "sender_id": 1, "sender": "Me", "text": "see you at the meeting", "date": "2024-01-01T12:10:00Z",
+             "ts": 1704111000},
+            {"id": 1, "sender_id": 7, "sender": "Alice", "text": "lunch tomorrow?", "date": "2024-01-01T12:00:00Z"},
+        ]},
+        "unread": {},
+    }}
+
+
+def test_users_batches_keep_order_senders_and_timestamps():
+    batch = users_batches(users_body())["messages"]["most_recent"]["Alice"]
+    assert [(record.id, record.sender, record.chat) for record in batch] == [(2, "Me", "Alice"), (1, "Alice", "Alice")]
+    # A message without ts has its date parsed once, into the batch's int64 column
+    assert list(batch.dates) == [1704111000, 1704110400]
+
+
+def test_prompt_is_built_from_batches():
+    builder = PromptBuilder("gemini-2.0-flash", budget=1000, timezone=ZoneInfo("UTC"))
+    text = builder.build(users_batches(users_body()), "recent", question="meeting")
+    assert "[2024-01-01 12:00:00]\nAlice: lunch tomorrow?\n" in text
+    assert text.index("Me: see you at the meeting") < text.index("Alice: lunch tomorrow?")
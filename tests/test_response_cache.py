@@ -0,0 +1,26 @@
+import asyncio
+import time
+from response_cache import SnapshotCache
+
+
+def test_least_recently_used_snapshots_are_dropped():
+    async def run():
+        cache = SnapshotCache(ttl=60, max_entries=2)
+        for key in ("a", "b"):
+            await cache.get(key, lambda key=key: asyncio.sleep(0, key))
+        await cache.get("a", lambda: asyncio.sleep(0, "a"))
+        await cache.get("c", lambda: asyncio.sleep(0, "c"))
+        return list(cache.entries)
+
+    assert asyncio.run(run()) == ["a", "c"]
+
+
+def test_snapshots_past_max_stale_are_dropped():
+    async def run():
+        cache = SnapshotCache(ttl=1, max_stale=10)
+        await cache.get("old", lambda: asyncio.sleep(0, "old"))
+        cache.entries["old"] = ("old", time.time() - 20)
+        await cache.get("new", lambda: asyncio.sleep(0, "new"))
+        return list(cache.entries)
+
+    assert asyncio.run(run()) == ["new"]
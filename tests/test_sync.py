@@ -0,0 +1,107 @@
+import asyncio
+import itertools
+import telegram_sender
+from message_store import message_store
+from rate_limiter import RateLimiter
+from stubs import FakeClient
+
+accounts = itertools.count(1)
+
+
+def new_account():
+    return f"+2000000{next(accounts):04d}"
+
+
+def sync(client, account, chat_id):
+    """One incremental sync of the chat against what the store has for the account"""
+    async def run():
+        dialog = [dialog async for dialog in client.iter_dialogs() if dialog.id == chat_id][0]
+        state = message_store.get_dialog_states(account).get(chat_id)
+        return await telegram_sender.sync_dialog(client, RateLimiter(1000), account, dialog, dialog.name, state)
+    return asyncio.run(run())
+
+
+def stored(account, chat_id):
+    rows = message_store.chat_messages(account, chat_id, 10000)
+    return sorted((row["message_id"], row["text"], row["date"]) for row in rows)
+
+
+def full_fetch(client, chat_id):
+    """What a sync into an empty store keeps"""
+    account = new_account()
+    sync(client, account, chat_id)
+    return account
+
+
+def test_unchanged_dialog_makes_no_calls():
+    client = FakeClient()
+    client.add(10, 5)
+    account = new_account()
+    sync(client, account, 10)
+    client.calls.clear()
+
+    assert sync(client, account, 10) is True
+    assert client.calls == []
+    assert stored(account, 10) == stored(full_fetch(client, 10), 10)
+
+
+def test_new_message_is_fetched_past_the_high_water_mark():
+    client = FakeClient()
+    client.add(10, 5)
+    account = new_account()
+    sync(client, account, 10)
+    client.calls.clear()
+    client.append(10, 2)
+
+    assert sync(client, account, 10) is False
+    assert [call["min_id"] for call in client.calls] == [5]
+    assert stored(account, 10) == stored(full_fetch(client, 10), 10)
+
+
+def test_truncated_unread_is_fetched_separately(monkeypatch):
+    monkeypatch.setattr(telegram_sender, "latest_messages_limit", 3)
+    client = FakeClient()
+    client.add(10, 20, unread=8)
+    account = new_account()
+
+    sync(client, account, 10)
+
+    assert [(call["min_id"], call["max_id"], call["limit"]) for call in client.calls] == [(0, 0, 3), (12, 18, 5)]
+    unread = message_store.unread_messages(account, 10, 12, 8)
+    assert sorted(row["message_id"] for row in unread) == list(range(13, 21))
+
+
+def test_collect_messages_returns_a_summary():
+    client = FakeClient()
+    client.add(10, 5)
+    client.add(11, 3, unread=1)
+    account = new_account()
+
+    assert asyncio.run(telegram_sender.collect_messages(client, account, None, 0)) == {"chats": 2, "skipped": 0}
+    assert asyncio.run(telegram_sender.collect_messages(client, account, None, 0)) == {"chats": 2, "skipped": 2}
+    assert asyncio.run(telegram_sender.collect_messages(client, account, 11, 0)) == {"chats": 1, "messages": 3}
+    assert len(stored(account, 10)) == 5
+
+
+def test_failed_account_sync_is_reported_and_not_cached(monkeypatch):
+    import telegram_rpc
+
+    results = [None, {"chats": 1, "skipped": 0}]
+
+    async def store_messages(chat_id=None, phone=None, limiter=None):
+        return results.pop(0)
+
+    monkeypatch.setattr(telegram_rpc, "store_messages", store_messages)
+    telegram = telegram_rpc.LocalTelegram()
+
+    account = new_account()
+
+    async def run():
+        return [await telegram.sync_account(account), await telegram.sync_account(account)]
+
+    # The failure is not cached for sync_ttl, the second call syncs again
+    assert asyncio.run(run()) == [False, True]
+    assert results == []
+
+    results.append(None)
+    assert asyncio.run(telegram.sync_chat(account, 10)) is False
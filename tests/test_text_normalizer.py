@@ -0,0 +1,37 @@
+import sqlite3
+from message_store import MessageStore
+from text_normalizer import normalize_text
+
+
+def test_emoji_are_stripped():
+    assert normalize_text("hi 😀👍🏽 ❤️ 👨‍👩‍👧 🇮🇷 ✅ ⭐ 🟠 done") == "hi done"
+
+
+def test_cjk_hangul_and_arabic_presentation_forms_are_kept():
+    assert normalize_text("你好 한국어 ۱۰۰ ﷼ تومان ﻻ") == "你好 한국어 100 ﷼ تومان ﻻ"
+
+
+def test_persian_normalization():
+    assert normalize_text("مي‌‌خواهم كتاب ٢٣") == "می‌خواهم کتاب 23"
+
+
+def test_store_renormalizes_text_of_an_older_normalizer(tmp_path):
+    path = str(tmp_path / "messages.db")
+    store = MessageStore(path)
+    store.upsert_messages("+1", [{
+        "chat_id": 1, "message_id": 1, "sender_id": 1, "out": 0, "text": "你好 ﷼ 500 😀",
+        "date": 1_700_000_000, "edit_date": None
+    }])
+    store.close()
+
+    # What the old emoji ranges stored
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute("UPDATE messages SET text_norm = '500'")
+        connection.execute("PRAGMA user_version = 1")
+    connection.close()
+
+    store = MessageStore(path)
+    assert store.connect().execute("SELECT text_norm FROM messages").fetchone()[0] == "你好 ﷼ 500"
+    assert [row["record"].id for row in store.search("+1", "你好", 5)] == [1]
+    store.close()
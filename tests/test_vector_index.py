@@ -0,0 +1,108 @@
+import numpy as np
+from message_store import MessageStore
+from search_index import VectorIndex
+
+account = "+1"
+model = "test-model"
+
+
+def store_messages(store, texts):
+    store.upsert_messages(account, [
+        {"chat_id": 1, "message_id": message_id, "sender_id": 1, "out": 0, "text": text,
+         "date": 1_700_000_000 + message_id, "edit_date": None}
+        for message_id, text in texts.items()
+    ])
+
+
+def embed(store, vectors):
+    store.save_embeddings(account, model, [
+        (1, message_id, np.asarray(vector, dtype=np.float32).tobytes()) for message_id, vector in vectors.items()
+    ])
+
+
+def test_deleted_and_edited_messages_leave_the_index(tmp_path):
+    store = MessageStore(str(tmp_path / "messages.db"))
+    store_messages(store, {1: "one", 2: "two", 3: "three"})
+    embed(store, {1: [1, 0], 2: [0, 1], 3: [1, 1]})
+    index = VectorIndex(account, model, store)
+    index.refresh()
+    assert {key for key, _ in index.search([1, 0], 10)} == {(1, 1), (1, 2), (1, 3)}
+
+    store.write_batch(account, deleted=[(1, 2)])
+    store_messages(store, {3: "three, edited"})
+    index.refresh()
+    assert [key for key, _ in index.search([1, 0], 10)] == [(1, 1)]
+    assert [key for key, _ in index.search([1, 0], 10, chat_ids=[1])] == [(1, 1)]
+
+    # Re-embedded after the edit
+    embed(store, {3: [1, 0]})
+    index.refresh()
+    assert {key for key, _ in index.search([1, 0], 10)} == {(1, 1), (1, 3)}
+    store.close()
+
+
+def test_re_embedding_loaded_before_its_deletion_stays(tmp_path):
+    store = MessageStore(str(tmp_path / "messages.db"))
+    store_messages(store, {1: "one"})
+    embed(store, {1: [1, 0]})
+    index = VectorIndex(account, model, store)
+    index.refresh()
+
+    # Edited and re-embedded between two refreshes: the deletion and the new vector arrive together
+    store_messages(store, {1: "one, edited"})
+    embed(store, {1: [0, 1]})
+    index.refresh()
+    assert [key for key, _ in index.search([0, 1], 10)] == [(1, 1)]
+    assert index.search([0, 1], 10)[0][1] > 0.99
+    store.close()
+
+
+def test_pruned_deletions_reload_the_index(tmp_path, monkeypatch):
+    store = MessageStore(str(tmp_path / "messages.db"))
+    store_messages(store, {1: "one", 2: "two"})
+    embed(store, {1: [1, 0], 2: [0, 1]})
+    index = VectorIndex(account, model, store)
+    index.refresh()
+
+    store.write_batch(account, deleted=[(1, 2)])
+    monkeypatch.setattr("message_store.changes_retention", -1)
+    store.prune_changes(force=True)
+    assert store.embedding_deletions_expired(index.last_deletion_id)
+    index.refresh()
+    assert [key for key, _ in index.search([1, 1], 10)] == [(1, 1)]
+    store.close()
+
+
+def test_concurrent_refresh_and_search(tmp_path):
+    import threading
+
+    store = MessageStore(str(tmp_path / "messages.db"))
+    index = VectorIndex(account, model, store)
+    errors = []
+
+    def writer():
+        for message_id in range(1, 201):
+            store_messages(store, {message_id: f"message {message_id}"})
+            embed(store, {message_id: [1, message_id % 3]})
+            if message_id % 4 == 0:
+                store.write_batch(account, deleted=[(1, message_id - 1)])
+
+    def reader():
+        try:
+            for _ in range(200):
+                index.refresh()
+                index.search([1, 0], 5)
+                index.search([1, 0], 5, chat_ids=[1])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    index.refresh()
+    live = {key for key, _ in index.search([1, 0], 1000)}
+    assert live == {(1, message_id) for message_id in range(1, 201) if message_id % 4 != 3}
+    store.close()
@@ -0,0 +1,111 @@
+import asyncio
+import socket
+import aiohttp
+import pytest
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from bot_webhook import UpdateDispatcher, run_webhook
+from fake_bot_api import FakeBotAPI
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class RecordingBot:
+    """Stands in for AsyncTeleBot, keeping the batches the dispatcher hands over"""
+
+    def __init__(self):
+        self.batches = []
+
+    async def process_new_updates(self, updates):
+        self.batches.append(list(updates))
+
+
+@pytest.fixture
+def api(monkeypatch):
+    api = FakeBotAPI().start()
+    monkeypatch.setattr(asyncio_helper, "API_URL", api.api_url)
+    yield api
+    api.stop()
+
+
+def test_dispatcher_batches_queued_updates():
+    async def run():
+        bot = RecordingBot()
+        dispatcher = UpdateDispatcher(bot, batch_size=10, batch_delay=0.05)
+        for update in range(25):
+            assert dispatcher.put(update)
+        dispatcher.start()
+        await asyncio.sleep(0.2)
+        await dispatcher.stop()
+        return bot.batches
+
+    batches = asyncio.run(run())
+    assert [len(batch) for batch in batches] == [10, 10, 5]
+    assert [update for batch in batches for update in batch] == list(range(25))
+
+
+def test_dispatcher_refuses_updates_past_max_queue():
+    async def run():
+        dispatcher = UpdateDispatcher(RecordingBot(), max_queue=2)
+        return [dispatcher.put(update) for update in range(3)]
+
+    assert asyncio.run(run()) == [True, True, False]
+
+
+def test_webhook_delivers_updates_and_rejects_a_wrong_secret(api):
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/telegram"
+
+    async def run():
+        bot = AsyncTeleBot("1:test")
+        answered = []
+
+        @bot.message_handler(func=lambda message: True)
+        async def record(message):
+            answered.append(message.chat.id)
+
+        serving = asyncio.create_task(run_webhook(bot, url, "right-secret", "127.0.0.1", port))
+        while api.webhook is None:
+            await asyncio.sleep(0.05)
+        for user_id in range(20):
+            api.push_message(100 + user_id, "hello")
+        async with aiohttp.ClientSession() as session:
+            async with session.post(url, json={"update_id": 1}, headers={
+                "X-Telegram-Bot-Api-Secret-Token": "wrong-secret"
+            }) as response:
+                status = response.status
+            for _ in range(100):
+                if len(answered) == 20:
+                    break
+                await asyncio.sleep(0.05)
+            async with session.get(f"http://127.0.0.1:{port}/health") as response:
+                health = await response.json()
+        serving.cancel()
+        await asyncio.gather(serving, return_exceptions=True)
+        await bot.close_session()
+        return status, sorted(answered), health
+
+    status, answered, health = asyncio.run(run())
+    assert status == 403
+    assert answered == list(range(100, 120))
+    assert health["dispatched"] == 20 and health["batches"] <= 20
+    assert api.calls_to("setWebhook")[0]["secret_token"] == "right-secret"
+
+
+def test_webhook_is_not_set_when_the_port_is_taken(api):
+    async def run():
+        bot = AsyncTeleBot("1:test")
+        with socket.socket() as taken:
+            taken.bind(("127.0.0.1", 0))
+            taken.listen()
+            port = taken.getsockname()[1]
+            with pytest.raises(RuntimeError):
+                await run_webhook(bot, f"http://127.0.0.1:{port}/telegram", "secret", "127.0.0.1", port)
+        await bot.close_session()
+
+    asyncio.run(run())
+    assert api.calls_to("setWebhook") == []